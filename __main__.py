@@ -2,13 +2,17 @@ import logging
 import asyncio
 
 from bot.db.database import init_bot_db
-from max.db.max_repo import init_max_db
+from max.db.max_repo import MaxRepository, init_max_db
 
 from bot.bot_file import bot
 from bot.db.db_dependency import DBDependency
 from bot.run_bot import start_bot
+from bot.services.delivery import get_delivery_manager
 
 from core.message_handler import handle_from_bot, handle_from_ws
+from core.metrics import get_metrics, start_metrics_server
+from core.outbox import get_outbox
+from core.queue_manager import get_queue_manager
 
 from max.clients_manager import MaxManager
 
@@ -30,8 +34,29 @@ async def main():
     await init_bot_db(bot_db_dependency.engine)
     await init_max_db(max_db_dependency.engine)
 
+    # Load chat → group routes, forwarding doesn't query the DB after that
+    async with max_db_dependency.db_session() as session:
+        await MaxRepository(session).load_routing_index()
+
+    queue_manager = get_queue_manager()
+
+    # Undelivered messages of the previous run are queued again before anything new
+    await queue_manager.to_bot_backpressure.restore()
+
+    if config.outbox.enabled:
+        await get_outbox().start(sink=queue_manager.to_bot_backpressure.put)
+        queue_manager.outbox = get_outbox()
+
     max_manager = MaxManager(max_db_dependency)
 
+    metrics_runner = None
+
+    if config.metrics.enabled:
+        get_metrics().add_collector(max_manager.collect_metrics)
+        metrics_runner = await start_metrics_server(
+            config.metrics.host, config.metrics.port
+        )
+
     tasks = [
         asyncio.create_task(
             start_bot(
@@ -44,6 +69,7 @@ async def main():
                 bot=bot,
                 max_manager=max_manager,
                 db_dependency=max_db_dependency,
+                bot_db_dependency=bot_db_dependency,
             )
         ),
         asyncio.create_task(
@@ -74,13 +100,25 @@ async def main():
         # Wait for cancellation to complete
         await asyncio.gather(*tasks, return_exceptions=True)
 
+        await get_delivery_manager().shutdown()
+
+        # Cleanup max_manager if it has a shutdown method.
+        # Before the backpressure, so nothing is spilled after it's closed
+        if hasattr(max_manager, "shutdown"):
+            await max_manager.shutdown()
+
+        await queue_manager.to_bot_backpressure.close()
+
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+
         # Cleanup resources
         await bot_db_dependency.dispose()
         await max_db_dependency.dispose()
 
-        # Cleanup max_manager if it has a shutdown method
-        if hasattr(max_manager, "shutdown"):
-            await max_manager.shutdown()
+        # Last, so messages received while shutting down are kept for the next run
+        if config.outbox.enabled:
+            await get_outbox().close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+"""
+Saving an account's chat list: one transaction per chat vs one bulk upsert
+
+    python -m benchmarks.chat_persistence_bench [--sizes 40 500 5000]
+
+Runs against a fresh SQLite file for every case. "insert" saves into an empty
+table, "update" saves the same list again (every row conflicts).
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+
+from pathlib import Path
+
+from bot.db.db_dependency import DBDependency
+from max.db.max_repo import MaxRepository, init_max_db
+
+from core.message_models import FetchChatsMessage
+
+from .frames import opcode19_dict
+
+OWNER_ID = 1
+
+
+def make_chats(count: int) -> list[FetchChatsMessage]:
+    return [
+        FetchChatsMessage(
+            user_id=OWNER_ID,
+            chat_id=chat["id"],
+            chat_title=chat["title"],
+            messages_count=chat["messagesCount"],
+            last_message_id=chat["lastMessage"]["id"],
+        )
+        for chat in opcode19_dict(count)["payload"]["chats"]
+    ]
+
+
+async def save_one_by_one(db: MaxRepository, chats: list[FetchChatsMessage]) -> None:
+    for chat in chats:
+        await db.save_user_chat(
+            owner_id=chat.user_id,
+            chat_id=chat.chat_id,
+            chat_title=chat.chat_title,
+            messages_count=chat.messages_count,
+            last_message_id=chat.last_message_id,
+        )
+
+
+async def save_bulk(db: MaxRepository, chats: list[FetchChatsMessage]) -> None:
+    await db.save_user_chats(owner_id=OWNER_ID, chats=chats)
+
+
+async def measure(save, chats: list[FetchChatsMessage], workdir: Path) -> tuple:
+    db_path = workdir / f"{save.__name__}_{len(chats)}.db"
+    db_dependency = DBDependency(db_url=f"sqlite+aiosqlite:///{db_path}")
+
+    try:
+        await init_max_db(db_dependency.engine)
+
+        timings = []
+
+        for _ in ("insert", "update"):
+            async with db_dependency.db_session() as session:
+                db = MaxRepository(session)
+
+                started_at = time.perf_counter()
+                await save(db, chats)
+                timings.append(time.perf_counter() - started_at)
+
+        return tuple(timings)
+    finally:
+        await db_dependency.dispose()
+
+
+async def run(sizes: list[int]) -> None:
+    print(f"{'chats':>6}  {'mode':<12}{'insert':>10}{'update':>10}{'chats/s':>12}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in sizes:
+            chats = make_chats(size)
+
+            for save in (save_one_by_one, save_bulk):
+                insert_time, update_time = await measure(save, chats, Path(workdir))
+
+                print(
+                    f"{size:>6}  {save.__name__.removeprefix('save_'):<12}"
+                    f"{insert_time:>9.3f}s{update_time:>9.3f}s"
+                    f"{size / insert_time:>12,.0f}"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[40, 500, 5000])
+
+    asyncio.run(run(parser.parse_args().sizes))
@@ -0,0 +1,189 @@
+"""
+Egress to Telegram: forwarded messages per second and delivery latency
+
+    python -m benchmarks.egress_bench [--messages 2000] [--chats 20] [--groups 2]
+                                      [--latency 0.05] [--jitter 0.02] [--flood 0.01]
+
+Runs the Bot API stand-in (`benchmarks/fake_telegram_server.py`) and a real `Bot`
+pointed at it. Every MAX chat is routed to `groups` Telegram groups. The same
+messages (mostly text, every 10th a photo, every 20th an album of 3) are pushed through
+
+- forward:     `build_send_plan()` + `forward_message_to_group()`
+- send_to_bot: the whole `send_to_bot()` path, with routing and dedup
+
+Latency is from submitting a message to the stand-in accepting the send,
+so it includes queueing in the delivery actors and 429 retries.
+"""
+
+import argparse
+import asyncio
+import logging
+import re
+import statistics
+import time
+
+from aiogram import Bot
+
+from bot.bot_file import create_bot
+from bot.services.delivery import get_delivery_manager
+from bot.services.mailing_manager import forward_message_to_group
+from bot.services.send_plan import build_send_plan
+
+from core.message_handler import send_to_bot
+from core.message_models import Attach, ChatMsgMessage
+
+from max.db.routing_index import get_routing_index
+
+from .fake_telegram_server import FakeTelegramServer
+
+
+BENCH_TOKEN = "123456:bench"
+OWNER_ID = 1
+FIRST_GROUP_ID = -1001000000000
+
+MARKER = re.compile(r"#(\d+)")
+
+
+def chat_id_of(index: int) -> int:
+    return -68956055956057 - index
+
+
+def make_message(index: int, chats: int) -> ChatMsgMessage:
+    if index % 20 == 0:
+        attaches = tuple(
+            Attach(base_url=f"https://i.oneme.ru/{index}/{n}.jpg") for n in range(3)
+        )
+    elif index % 10 == 5:
+        attaches = (Attach(base_url=f"https://i.oneme.ru/{index}.jpg"),)
+    else:
+        attaches = ()
+
+    return ChatMsgMessage(
+        user_id=OWNER_ID,
+        chat_id=chat_id_of(index % chats),
+        sender_id=91540825,
+        message_id=str(115485943389094002 + index),
+        timestamp=int(time.time() * 1000),
+        text=f"#{index}",
+        attaches=attaches,
+    )
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+
+    return statistics.quantiles(values, n=100)[q - 1]
+
+
+async def run_mode(
+    bot: Bot,
+    server: FakeTelegramServer,
+    mode: str,
+    first: int,
+    messages: int,
+    chats: int,
+    groups: dict[int, list[int]],
+) -> None:
+    server.reset()
+    submitted: dict[int, float] = {}
+
+    started_at = time.perf_counter()
+
+    for index in range(first, first + messages):
+        msg = make_message(index, chats)
+        submitted[index] = time.time()
+
+        if mode == "forward":
+            await forward_message_to_group(
+                bot=bot, tg_group_ids=groups[msg.chat_id], plan=build_send_plan(msg)
+            )
+        else:
+            await send_to_bot(bot, None, msg, None)
+
+    submit_time = time.perf_counter() - started_at
+
+    await get_delivery_manager().join()
+
+    elapsed = time.perf_counter() - started_at
+
+    latencies = [
+        (delivery.received_at - submitted[int(MARKER.search(delivery.text)[1])]) * 1000
+        for delivery in server.deliveries
+    ]
+    sends = len(server.deliveries)
+
+    print(
+        f"{mode:<12}{sends:>8}{submit_time:>9.2f}s{elapsed:>9.2f}s{sends / elapsed:>9.0f}"
+        f"{percentile(latencies, 50):>9.1f}ms{percentile(latencies, 99):>9.1f}ms"
+        f"{server.flooded:>7}"
+    )
+
+
+async def run(
+    messages: int,
+    chats: int,
+    groups_per_chat: int,
+    latency: float,
+    jitter: float,
+    flood: float,
+) -> None:
+    server = FakeTelegramServer(latency=latency, jitter=jitter, flood=flood, seed=1)
+    bot = create_bot(BENCH_TOKEN, await server.start())
+
+    routing = get_routing_index()
+    groups: dict[int, list[int]] = {}
+
+    for chat in range(chats):
+        chat_id = chat_id_of(chat)
+        groups[chat_id] = [
+            FIRST_GROUP_ID - chat * groups_per_chat - n for n in range(groups_per_chat)
+        ]
+
+        for group_id in groups[chat_id]:
+            routing.add(OWNER_ID, group_id, chat_id)
+
+    print(
+        f"{messages} messages, {chats} chats x {groups_per_chat} groups, "
+        f"latency {latency * 1000:g}+{jitter * 1000:g}ms, {flood:.0%} answered with 429"
+    )
+    print(
+        f"{'mode':<12}{'sends':>8}{'submit':>10}{'total':>10}{'sends/s':>9}"
+        f"{'p50':>11}{'p99':>11}{'429s':>7}"
+    )
+
+    try:
+        for first, mode in enumerate(("forward", "send_to_bot")):
+            # Message IDs differ between modes, dedup would drop repeats
+            await run_mode(
+                bot, server, mode, first * messages, messages, chats, groups
+            )
+    finally:
+        await get_delivery_manager().shutdown()
+        await bot.session.close()
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--groups", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--flood", type=float, default=0.01)
+    args = parser.parse_args()
+
+    # Flood control warnings of the delivery actors are expected here
+    logging.basicConfig(level=logging.ERROR)
+
+    asyncio.run(
+        run(
+            args.messages,
+            args.chats,
+            args.groups,
+            args.latency,
+            args.jitter,
+            args.flood,
+        )
+    )
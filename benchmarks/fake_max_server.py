@@ -0,0 +1,221 @@
+"""
+Local stand-in for the MAX WebSocket edge, for load tests without the real server
+
+    python -m benchmarks.fake_max_server [--port 8765] [--rate 1] [--chats 40]
+
+Understands the frames `max/templates/payloads.py` sends and answers the way
+`max/utils/process_opcodes.py` expects:
+
+- 6   handshake, answered with the location info
+- 19  token login, answered with the chat list. Starts the pushes
+- 17  start auth, answered with a short token
+- 18  check code, answered with the final token ("000000" is a wrong code)
+- 49  history, answered with a page of messages before `from`
+- 75  subscribe and 1 ping, acknowledged
+
+After the login every connection gets `rate` pushed messages (opcode 128) per second,
+spread over its chats. The text of a pushed message is the `time.time()` it was
+sent at, so a consumer can measure the end-to-end latency.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+
+from collections import Counter
+from typing import Any, Optional
+
+import websockets
+
+from .frames import encode, opcode19_dict
+
+
+class FakeMaxServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        rate: float = 0.0,
+        chats: int = 40,
+    ):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.chats = chats
+
+        self.connections = 0
+        self.received: Counter[int] = Counter()
+        self.pushed = 0
+
+        self._server: Optional[websockets.Server] = None
+        self._accounts = itertools.count()
+        self._message_ids = itertools.count(115485943389094002)
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    async def start(self) -> str:
+        self._server = await websockets.serve(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.url
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    def chat_ids(self, account: int) -> list[int]:
+        """Every account has its own chats"""
+
+        first = -68956055956057 - account * self.chats
+        return [first - i for i in range(self.chats)]
+
+    async def _handle(self, ws: websockets.ServerConnection) -> None:
+        self.connections += 1
+        account = next(self._accounts)
+        pusher: Optional[asyncio.Task] = None
+
+        try:
+            async for raw in ws:
+                request = json.loads(raw)
+                opcode = request.get("opcode")
+                payload = request.get("payload") or {}
+                self.received[opcode] += 1
+
+                match opcode:
+                    case 6:
+                        await self._reply(ws, request, {"location": "RU"})
+
+                    case 19:
+                        await self._reply(ws, request, self._chat_list(account))
+
+                        if self.rate > 0 and pusher is None:
+                            pusher = asyncio.create_task(self._push(ws, account))
+
+                    case 17:
+                        await self._reply(ws, request, {"token": f"short-{account}"})
+
+                    case 18:
+                        if payload.get("verifyCode") == "000000":
+                            await self._reply(
+                                ws,
+                                request,
+                                {
+                                    "error": "verify.code.wrong",
+                                    "localizedMessage": "Неверный код",
+                                    "message": "Wrong code",
+                                },
+                            )
+                        else:
+                            await self._reply(
+                                ws,
+                                request,
+                                {"tokenAttrs": {"LOGIN": {"token": f"token-{account}"}}},
+                            )
+
+                    case 49:
+                        await self._reply(ws, request, self._history(payload))
+
+                    case 1 | 75:
+                        await self._reply(ws, request, {})
+
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if pusher is not None:
+                pusher.cancel()
+
+    async def _reply(
+        self, ws: websockets.ServerConnection, request: dict, payload: dict
+    ) -> None:
+        await ws.send(
+            encode(
+                {
+                    "ver": 11,
+                    "cmd": 1,
+                    "seq": request.get("seq"),
+                    "opcode": request.get("opcode"),
+                    "payload": payload,
+                }
+            ).decode()
+        )
+
+    def _chat_list(self, account: int) -> dict[str, Any]:
+        payload = opcode19_dict(self.chats)["payload"]
+
+        for chat, chat_id in zip(payload["chats"], self.chat_ids(account)):
+            chat["id"] = chat_id
+
+        return payload
+
+    def _message(self, sent_at: float) -> dict[str, Any]:
+        return {
+            "sender": 91540825,
+            "id": str(next(self._message_ids)),
+            "time": int(sent_at * 1000),
+            "text": f"{sent_at:.6f}",
+            "type": "USER",
+            "attaches": [],
+        }
+
+    def _history(self, payload: dict[str, Any]) -> dict[str, Any]:
+        before = payload.get("from", int(time.time() * 1000)) / 1000
+        count = payload.get("backward", 30)
+
+        return {
+            "messages": [self._message(before - i - 1) for i in reversed(range(count))]
+        }
+
+    async def _push(self, ws: websockets.ServerConnection, account: int) -> None:
+        chats = itertools.cycle(self.chat_ids(account))
+        interval = 1 / self.rate
+        next_at = time.monotonic()
+
+        while True:
+            next_at += interval
+            await asyncio.sleep(max(next_at - time.monotonic(), 0))
+
+            frame = {
+                "ver": 11,
+                "cmd": 0,
+                "seq": 0,
+                "opcode": 128,
+                "payload": {
+                    "chatId": next(chats),
+                    "unread": 1,
+                    "message": self._message(time.time()),
+                },
+            }
+
+            try:
+                await ws.send(encode(frame).decode())
+            except websockets.ConnectionClosed:
+                return
+
+            self.pushed += 1
+
+
+async def serve(port: int, rate: float, chats: int) -> None:
+    server = FakeMaxServer(port=port, rate=rate, chats=chats)
+    print(f"Fake MAX server on {await server.start()}")
+
+    try:
+        await asyncio.Future()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--rate", type=float, default=1.0)
+    parser.add_argument("--chats", type=int, default=40)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.port, args.rate, args.chats))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,173 @@
+"""
+Local stand-in for the Telegram Bot API, for load tests without Telegram
+
+    python -m benchmarks.fake_telegram_server [--port 8081] [--latency 0.05] [--flood 0.01]
+
+Point the bot at it with `bot.api_server: http://127.0.0.1:8081` in `shared/config.yaml`.
+
+Accepts sendMessage, sendPhoto, sendDocument, sendVideo and sendMediaGroup. Every
+request waits `latency` s (plus up to `jitter` s). A `flood` share of the requests
+is answered with 429 and `retry_after`, like Telegram flood control.
+Every accepted send is recorded with the time it was received.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from aiohttp import web
+
+
+MEDIA_FIELDS = {"sendPhoto": "photo", "sendDocument": "document", "sendVideo": "video"}
+
+
+@dataclass(frozen=True, slots=True)
+class Delivery:
+    method: str
+    chat_id: int
+    # Text, or the caption of the media (the first one of a media group)
+    text: str
+    received_at: float
+
+
+class FakeTelegramServer:
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        flood: float = 0.0,
+        retry_after: int = 1,
+        seed: Optional[int] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.flood = flood
+        self.retry_after = retry_after
+
+        self.deliveries: list[Delivery] = []
+        self.requests: Counter[str] = Counter()
+        self.flooded = 0
+
+        self._random = random.Random(seed)
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+
+        self.port = self._runner.addresses[0][1]
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def reset(self) -> None:
+        self.deliveries.clear()
+        self.requests.clear()
+        self.flooded = 0
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        self.requests[method] += 1
+
+        delay = self.latency + self._random.uniform(0, self.jitter)
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.flood and self._random.random() < self.flood:
+            self.flooded += 1
+
+            return web.json_response(
+                {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            )
+
+        chat_id = int(data.get("chat_id", 0))
+
+        match method:
+            case "sendMessage":
+                text = data.get("text", "")
+                result = self._message(chat_id, text=text)
+
+            case "sendMediaGroup":
+                media = json.loads(data.get("media", "[]"))
+                text = media[0].get("caption", "") if media else ""
+                result = [self._message(chat_id, caption=m.get("caption")) for m in media]
+
+            case _ if method in MEDIA_FIELDS:
+                text = data.get("caption", "")
+                result = self._message(chat_id, caption=text)
+
+            case _:
+                return web.json_response(
+                    {
+                        "ok": False,
+                        "error_code": 404,
+                        "description": "Not Found: method not found",
+                    }
+                )
+
+        self.deliveries.append(Delivery(method, chat_id, text, time.time()))
+
+        return web.json_response({"ok": True, "result": result})
+
+    def _message(self, chat_id: int, **fields: Any) -> dict[str, Any]:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "supergroup", "title": "bench"},
+            **{key: value for key, value in fields.items() if value is not None},
+        }
+
+
+async def serve(port: int, latency: float, jitter: float, flood: float) -> None:
+    server = FakeTelegramServer(port=port, latency=latency, jitter=jitter, flood=flood)
+    print(f"Fake Bot API server on {await server.start()}")
+
+    try:
+        await asyncio.Future()
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--flood", type=float, default=0.0)
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.port, args.latency, args.jitter, args.flood))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,134 @@
+"""
+Sample inbound MAX frames shaped like the real ones (see `max/templates/payloads.py`)
+
+Used by the benchmarks, so numbers are measured on realistic sizes:
+opcode 19 carries a 40-chat list, opcode 49 carries 30 messages of history
+and opcode 128 is a single pushed message with a photo and a reply.
+"""
+
+import json
+import random
+
+from typing import Any
+
+
+_rnd = random.Random(128)
+
+_WORDS = [
+    "привет",
+    "завтра",
+    "пара",
+    "расписание",
+    "домашка",
+    "ок",
+    "когда",
+    "кабинет",
+    "перенесли",
+    "спасибо",
+]
+
+
+def _text(words: int) -> str:
+    return " ".join(_rnd.choice(_WORDS) for _ in range(words))
+
+
+def _message(index: int, with_photo: bool = False) -> dict[str, Any]:
+    msg = {
+        "sender": 91540825 + index % 7,
+        "reactionInfo": {},
+        "id": str(115485943389094002 + index),
+        "time": 1762175649858 + index * 1000,
+        "text": _text(12),
+        "type": "USER",
+        "cid": 1762175667916 + index * 1000,
+        "attaches": [],
+    }
+
+    if with_photo:
+        msg["attaches"].append(
+            {
+                "_type": "PHOTO",
+                "baseUrl": f"https://i.oneme.ru/i?r=BTGBPUwtwgYUeoFhO7rESmr8{index}",
+                "photoToken": "IPMhKzbq6MsrPJ3jYxLp7ZbT" * 2,
+                "width": 1280,
+                "height": 960,
+                "photoId": 6006418480 + index,
+            }
+        )
+
+    return msg
+
+
+def opcode19_dict(chats_count: int = 40) -> dict[str, Any]:
+    chats = []
+
+    for i in range(chats_count):
+        chats.append(
+            {
+                "id": -68956055956057 - i,
+                "type": "CHAT",
+                "status": "ACTIVE",
+                "title": f"Группа {_text(2)} {i}",
+                "owner": 91540825,
+                "participants": {str(91540825 + p): 1762175649858 for p in range(8)},
+                "messagesCount": 1200 + i,
+                "lastMessage": _message(i),
+                "modified": 1762175649858,
+                "cid": 1762175077637,
+            }
+        )
+
+    return {
+        "ver": 11,
+        "cmd": 1,
+        "seq": 1,
+        "opcode": 19,
+        "payload": {
+            "profile": {"contact": {"id": 91540825, "names": [{"name": "имя"}]}},
+            "chats": chats,
+            "contacts": [],
+            "presence": {},
+            "time": 1762175649858,
+        },
+    }
+
+
+def opcode49_dict(messages_count: int = 30) -> dict[str, Any]:
+    return {
+        "ver": 11,
+        "cmd": 1,
+        "seq": 10,
+        "opcode": 49,
+        "payload": {"messages": [_message(i) for i in range(messages_count)]},
+    }
+
+
+def opcode128_dict() -> dict[str, Any]:
+    message = _message(0, with_photo=True)
+    message["link"] = {"type": "REPLY", "message": _message(1)}
+
+    return {
+        "ver": 11,
+        "cmd": 0,
+        "seq": 42,
+        "opcode": 128,
+        "payload": {
+            "chatId": -68956055956057,
+            "unread": 1,
+            "mark": 1762175649858,
+            "message": message,
+        },
+    }
+
+
+def encode(frame: dict[str, Any]) -> bytes:
+    """Encode like the server does: compact UTF-8 JSON"""
+
+    return json.dumps(frame, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+FRAMES: dict[str, bytes] = {
+    "opcode 19": encode(opcode19_dict()),
+    "opcode 49": encode(opcode49_dict()),
+    "opcode 128": encode(opcode128_dict()),
+}
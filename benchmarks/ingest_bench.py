@@ -0,0 +1,170 @@
+"""
+Ingest of live MAX messages: N accounts, each receiving M messages per second
+
+    python -m benchmarks.ingest_bench [--accounts 50] [--rate 10] [--duration 10] [--workers 0]
+
+Starts the local MAX stand-in (`benchmarks/fake_max_server.py`), saves N accounts
+into a temporary database and runs a real `MaxManager` against it, with the
+bot side replaced by a consumer that only drains the `to_bot` queue.
+
+Reports the chat messages per second that reached the queue, the queue depth
+sampled every 100 ms, and the latency from the server sending a message
+to the message leaving the queue. Nothing goes over the network.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from bot.db.db_dependency import DBDependency
+
+from core.message_models import ChatMsgMessage
+from core.queue_manager import get_queue_manager
+
+from max.clients_manager import MaxManager
+from max.db.max_repo import MaxRepository, init_max_db
+
+from config import config
+
+from .fake_max_server import FakeMaxServer
+
+
+SAMPLE_INTERVAL = 0.1
+
+
+class Consumer:
+    """Stands in for `handle_from_bot`"""
+
+    def __init__(self):
+        self.received = 0
+        self.latencies: list[float] = []
+        self.depths: list[int] = []
+        self.measuring = False
+
+    async def drain(self) -> None:
+        queue = get_queue_manager().to_bot
+
+        while True:
+            item = await queue.get()
+
+            if self.measuring and isinstance(item, ChatMsgMessage):
+                self.received += 1
+                self.latencies.append(time.time() - float(item.text))
+
+            queue.task_done()
+
+    async def sample(self) -> None:
+        queue = get_queue_manager().to_bot
+
+        while True:
+            if self.measuring:
+                self.depths.append(queue.qsize())
+
+            await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+def percentile(values: list[float], q: int) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+
+    return statistics.quantiles(values, n=100)[q - 1]
+
+
+async def save_accounts(db_dependency: DBDependency, accounts: int) -> None:
+    await init_max_db(db_dependency.engine)
+
+    async with db_dependency.db_session() as session:
+        db = MaxRepository(session)
+
+        for tg_id in range(1, accounts + 1):
+            await db.save_account(user_tg_id=tg_id, token=f"token-{tg_id}")
+
+
+async def run(accounts: int, rate: float, duration: float, workers: int) -> None:
+    server = FakeMaxServer(rate=rate)
+    config.ws.url = await server.start()
+
+    # Connect everything at once, the bench measures the steady state
+    config.max.startup_rate = max(accounts, 1) * max(workers, 1)
+    config.max.startup_burst = accounts
+    config.max.startup_jitter = 0
+    config.max.startup_max_in_flight = accounts
+
+    with tempfile.TemporaryDirectory() as tmp:
+        config.max.db_url = f"sqlite+aiosqlite:///{os.path.join(tmp, 'max.db')}"
+
+        db_dependency = DBDependency(db_url=config.max.db_url)
+        await save_accounts(db_dependency, accounts)
+
+        consumer = Consumer()
+        tasks = [
+            asyncio.create_task(consumer.drain()),
+            asyncio.create_task(consumer.sample()),
+        ]
+
+        manager = MaxManager(db_dependency, workers=workers)
+
+        started_at = time.perf_counter()
+        await manager.startup()
+
+        while server.received[19] < accounts:
+            await asyncio.sleep(0.05)
+
+        connect_time = time.perf_counter() - started_at
+
+        # Skip the startup burst of chat lists
+        await asyncio.sleep(1)
+
+        pushed_before = server.pushed
+        cpu_before = time.process_time()
+        consumer.measuring = True
+
+        await asyncio.sleep(duration)
+
+        consumer.measuring = False
+        cpu = time.process_time() - cpu_before
+        pushed = server.pushed - pushed_before
+
+        await manager.shutdown()
+        await server.stop()
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await db_dependency.dispose()
+
+    latencies = [latency * 1000 for latency in consumer.latencies]
+
+    print(
+        f"accounts {accounts} x {rate:g} msg/s, {workers} workers, "
+        f"connected in {connect_time:.2f}s, measured for {duration:g}s"
+    )
+    print(
+        f"{'pushed/s':>10}{'ingested/s':>12}{'p50':>10}{'p95':>10}{'p99':>10}"
+        f"{'queue avg':>11}{'queue max':>11}{'main cpu':>10}"
+    )
+    print(
+        f"{pushed / duration:>10.0f}{consumer.received / duration:>12.0f}"
+        f"{percentile(latencies, 50):>8.1f}ms{percentile(latencies, 95):>8.1f}ms"
+        f"{percentile(latencies, 99):>8.1f}ms"
+        f"{statistics.fmean(consumer.depths or [0]):>11.1f}{max(consumer.depths or [0]):>11}"
+        f"{cpu / duration:>9.0%}"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--accounts", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=10)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    asyncio.run(run(args.accounts, args.rate, args.duration, args.workers))
@@ -0,0 +1,41 @@
+"""
+Compare the JSON backends of `max.utils.json_codec` on real-sized MAX frames
+
+    python -m benchmarks.json_codec_bench [--number N]
+
+Decoding takes the raw `bytes` of a frame, like `MaxClient` does,
+encoding produces the `bytes` that are sent to the socket.
+"""
+
+import argparse
+import timeit
+
+from max.utils.json_codec import available_codecs
+
+from .frames import FRAMES
+
+
+def run(number: int) -> None:
+    codecs = available_codecs()
+    decoded = {name: codecs["json"].loads(raw) for name, raw in FRAMES.items()}
+
+    print(f"{'frame':<12}{'size':>9}  {'backend':<9}{'loads/s':>12}{'dumps/s':>12}")
+
+    for frame_name, raw in FRAMES.items():
+        for codec in codecs.values():
+            loads_time = timeit.timeit(lambda: codec.loads(raw), number=number)
+            dumps_time = timeit.timeit(
+                lambda: codec.dumps(decoded[frame_name]), number=number
+            )
+
+            print(
+                f"{frame_name:<12}{len(raw):>8}B  {codec.name:<9}"
+                f"{number / loads_time:>12,.0f}{number / dumps_time:>12,.0f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=2000)
+
+    run(parser.parse_args().number)
@@ -0,0 +1,122 @@
+"""
+Keepalive and subscription pings: a task per client and ping vs one timer wheel
+
+    python -m benchmarks.keepalive_bench [--clients 1000 10000]
+
+Every simulated client has a 30 s keepalive and a 60 s subscription ping, all
+of them created at the same moment, like after a mass startup. For both models
+the bench reports the number of tasks, the memory they take, and the peak number
+of pings in one second. For the wheel it also reports the CPU time of a full 60 s round.
+"""
+
+import argparse
+import asyncio
+import gc
+import time
+import tracemalloc
+
+from collections import Counter
+
+from max.client import PING_INTERVAL, SUBSCRIPTION_PING_INTERVAL
+from max.utils.timer_wheel import TimerWheel
+
+
+async def send_ping() -> None:
+    pass
+
+
+async def ping_loop(interval: float) -> None:
+    # Same shape as the old `MaxClient._send_ping` / `_chat_subscription_ping`
+    while True:
+        await asyncio.sleep(interval)
+        await send_ping()
+
+
+async def measure_tasks(clients: int) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+
+    started_at = time.perf_counter()
+
+    tasks = [
+        asyncio.create_task(ping_loop(interval))
+        for _ in range(clients)
+        for interval in (PING_INTERVAL, SUBSCRIPTION_PING_INTERVAL)
+    ]
+    # Let every task reach its first sleep
+    await asyncio.sleep(0)
+
+    setup = time.perf_counter() - started_at
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    task_count = len(asyncio.all_tasks()) - 1
+
+    for task in tasks:
+        task.cancel()
+
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Started together, the pings of every client fall into the same second
+    return task_count, memory, setup, clients, None
+
+
+async def measure_wheel(clients: int) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+
+    started_at = time.perf_counter()
+
+    wheel = TimerWheel()
+    timers = [
+        wheel.every(interval, send_ping)
+        for _ in range(clients)
+        for interval in (PING_INTERVAL, SUBSCRIPTION_PING_INTERVAL)
+    ]
+    await asyncio.sleep(0)
+
+    setup = time.perf_counter() - started_at
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    task_count = len(asyncio.all_tasks()) - 1
+
+    # Ticks are advanced by hand from here on
+    wheel.stop()
+
+    keepalives = Counter(t.expires % PING_INTERVAL for t in timers[::2])
+    peak = max(keepalives.values())
+
+    started_at = time.perf_counter()
+
+    for _ in range(SUBSCRIPTION_PING_INTERVAL):
+        wheel.advance()
+        await asyncio.sleep(0)
+
+    round_time = time.perf_counter() - started_at
+
+    return task_count, memory, setup, peak, round_time
+
+
+async def run(sizes: list[int]) -> None:
+    print(
+        f"{'clients':>8}  {'model':<8}{'tasks':>8}{'memory':>12}"
+        f"{'setup':>10}{'peak/s':>9}{'60s round':>11}"
+    )
+
+    for size in sizes:
+        for name, measure in (("tasks", measure_tasks), ("wheel", measure_wheel)):
+            task_count, memory, setup, peak, round_time = await measure(size)
+
+            print(
+                f"{size:>8}  {name:<8}{task_count:>8}{memory / 2**20:>10.1f}MB"
+                f"{setup:>9.3f}s{peak:>9}"
+                + (f"{round_time:>10.3f}s" if round_time is not None else f"{'-':>11}")
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1000, 10000])
+
+    asyncio.run(run(parser.parse_args().clients))
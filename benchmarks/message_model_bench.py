@@ -0,0 +1,180 @@
+"""
+Cost of a chat message on the bridge hot path: the pydantic model it used to be
+against the slotted `ChatMsgMessage` it is now
+
+    python -m benchmarks.message_model_bench [--messages N] [--number N]
+
+Messages are shaped like opcode 128 (a photo and a replied message) and opcode 49
+history (plain text). Per message it measures:
+
+- build:    building it from the raw MAX message
+- dispatch: what `send_to_bot` does before routing. The pydantic one was
+            dumped and validated again, the slotted one is only type-checked
+- pickle:   a pickle round trip, like the outbox, the spill file and the worker pipes do
+- memory:   the size of N queued messages / N, the strings are shared with the raw
+            frames, so it's the overhead of the objects themselves
+"""
+
+import argparse
+import pickle
+import timeit
+import tracemalloc
+
+from typing import Any, Literal, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+from core.message_models import Attach, ChatMsgMessage
+from core.tracing import Trace
+
+from .frames import opcode49_dict, opcode128_dict
+
+
+CHAT_ID = -68956055956057
+USER_ID = 1
+
+
+class LegacyAttach(BaseModel):
+    base_url: str
+    type: Literal["photo"] = "photo"
+
+
+class LegacyChatMsgMessage(BaseModel):
+    """`ChatMsgMessage` before it became a slotted dataclass"""
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    type: Literal["new_chat_message"] = "new_chat_message"
+    user_id: int
+    sender_id: int
+    chat_id: int
+    message_id: str
+    timestamp: int
+    sender_name: Optional[str] = None
+    text: Optional[str] = None
+    attaches: Optional[list[LegacyAttach]] = None
+    replied_msg: Optional["LegacyChatMsgMessage"] = None
+    trace: Optional[Trace] = None
+    outbox_id: Optional[int] = None
+
+
+def photo_urls(data: dict[str, Any]) -> list[str]:
+    return [a["baseUrl"] for a in data.get("attaches", []) if a.get("_type") == "PHOTO"]
+
+
+def build_legacy(data: dict[str, Any]) -> LegacyChatMsgMessage:
+    replied_msg = None
+    attaches = [LegacyAttach(base_url=url) for url in photo_urls(data)]
+    replied_raw = data.get("link", {}).get("message")
+
+    if replied_raw:
+        replied_msg = LegacyChatMsgMessage(
+            user_id=USER_ID,
+            chat_id=CHAT_ID,
+            sender_id=replied_raw.get("sender"),
+            message_id=replied_raw.get("id"),
+            timestamp=replied_raw.get("time"),
+            text=replied_raw.get("text"),
+        )
+        attaches.extend(LegacyAttach(base_url=url) for url in photo_urls(replied_raw))
+
+    return LegacyChatMsgMessage(
+        user_id=USER_ID,
+        chat_id=CHAT_ID,
+        sender_id=data.get("sender"),
+        message_id=data.get("id"),
+        timestamp=data.get("time"),
+        text=data.get("text"),
+        attaches=attaches,
+        replied_msg=replied_msg,
+    )
+
+
+def build_slotted(data: dict[str, Any]) -> ChatMsgMessage:
+    replied_msg = None
+    attaches = [Attach(base_url=url) for url in photo_urls(data)]
+    replied_raw = data.get("link", {}).get("message")
+
+    if replied_raw:
+        replied_msg = ChatMsgMessage.from_max(replied_raw, CHAT_ID, USER_ID)
+        attaches.extend(Attach(base_url=url) for url in photo_urls(replied_raw))
+
+    return ChatMsgMessage.from_max(data, CHAT_ID, USER_ID, tuple(attaches), replied_msg)
+
+
+def dispatch_legacy(msg: LegacyChatMsgMessage) -> Any:
+    return LegacyChatMsgMessage.model_validate(msg.model_dump())
+
+
+def dispatch_slotted(msg: ChatMsgMessage) -> Any:
+    return msg if isinstance(msg, ChatMsgMessage) else None
+
+
+MODELS = {
+    "pydantic": (build_legacy, dispatch_legacy),
+    "slotted": (build_slotted, dispatch_slotted),
+}
+
+
+def raw_messages(kind: str, count: int) -> list[dict[str, Any]]:
+    """`count` distinct raw messages, so nothing is shared between the built ones"""
+
+    if kind == "opcode 128":
+        return [opcode128_dict()["payload"]["message"] for _ in range(count)]
+
+    return opcode49_dict(count)["payload"]["messages"]
+
+
+def per_message_us(func, arg, number: int) -> float:
+    return timeit.timeit(lambda: func(arg), number=number) / number * 1e6
+
+
+def memory_per_message(build, raws: list[dict[str, Any]]) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    queued = [build(data) for data in raws]
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    assert len(queued) == len(raws)
+    return (after - before) / len(raws)
+
+
+def run(messages: int, number: int) -> None:
+    print(
+        f"{'message':<12}{'model':<10}{'build µs':>10}{'dispatch µs':>13}"
+        f"{'pickle µs':>11}{'memory B':>10}{'pickled B':>11}"
+    )
+
+    for kind in ("opcode 128", "opcode 49"):
+        sample = raw_messages(kind, 1)[0]
+        raws = raw_messages(kind, messages)
+
+        for name, (build, dispatch) in MODELS.items():
+            msg = build(sample)
+            payload = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+
+            build_us = per_message_us(build, sample, number)
+            dispatch_us = per_message_us(dispatch, msg, number)
+            pickle_us = per_message_us(
+                lambda m: pickle.loads(pickle.dumps(m, pickle.HIGHEST_PROTOCOL)),
+                msg,
+                number,
+            )
+
+            print(
+                f"{kind:<12}{name:<10}{build_us:>10.2f}{dispatch_us:>13.2f}"
+                f"{pickle_us:>11.2f}{memory_per_message(build, raws):>10.0f}"
+                f"{len(payload):>11}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--number", type=int, default=20_000)
+
+    args = parser.parse_args()
+    run(args.messages, args.number)
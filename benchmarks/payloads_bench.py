@@ -0,0 +1,239 @@
+"""
+Outbound frames: precompiled templates vs building a dict and encoding it
+
+    python -m benchmarks.payloads_bench [--number N]
+
+"before" rebuilds the nested dict on every call and encodes it with the codec,
+like `max/templates/payloads.py` did. "after" is the current implementation:
+a template for ping, user agent and history, the codec for the rest.
+Both outputs are compared byte for byte before timing.
+"""
+
+import argparse
+import re
+import timeit
+
+from max.templates import payloads
+from max.utils.json_codec import dumps, get_codec
+
+
+TOKEN = "An_Sx6HQ9HDi" * 8
+CHAT_ID = -68956055956057
+MESSAGE_ID = "115486269922292864"
+TIMESTAMP = 1762180632359
+DEVICE_ID = "0b7f7e2a-3c1d-4c55-9a53-3c0c4f1f5a11"
+
+
+def before_ping(seq: int) -> bytes:
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 0,
+            "seq": seq,
+            "opcode": 1,
+            "payload": {"interactive": False},
+        }
+    )
+
+
+def before_useragent(useragent: str, device_id: str) -> bytes:
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 0,
+            "seq": 0,
+            "opcode": 6,
+            "payload": {
+                "userAgent": {
+                    "deviceType": "WEB",
+                    "locale": "ru",
+                    "deviceLocale": "ru",
+                    "osVersion": "Windows",
+                    "deviceName": "Edge",
+                    "headerUserAgent": useragent,
+                    "appVersion": "25.11.1",
+                    "screen": "1080x1920 1.0x",
+                    "timezone": "Europe/Moscow",
+                },
+                "deviceId": device_id,
+            },
+        }
+    )
+
+
+def before_token(token: str, seq: int) -> bytes:
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 0,
+            "seq": seq,
+            "opcode": 19,
+            "payload": {
+                "interactive": True,
+                "token": token,
+                "chatsCount": 40,
+                "chatsSync": 0,
+                "contactsSync": 0,
+                "presenceSync": 0,
+                "draftsSync": 0,
+            },
+        }
+    )
+
+
+def before_subscribe(state: bool, chat_id: int, seq: int) -> bytes:
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 0,
+            "seq": seq,
+            "opcode": 75,
+            "payload": {"chatId": chat_id, "subscribe": state},
+        }
+    )
+
+
+def before_read_last_message(
+    chat_id: int, message_id: str, timestamp: int, seq: int
+) -> bytes:
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 0,
+            "seq": seq,
+            "opcode": 50,
+            "payload": {
+                "type": "READ_MESSAGE",
+                "chatId": chat_id,
+                "messageId": message_id,
+                "mark": timestamp,
+            },
+        }
+    )
+
+
+def before_messages(chat_id: int, timestamp: int, seq: int) -> bytes:
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 0,
+            "seq": seq,
+            "opcode": 49,
+            "payload": {
+                "chatId": chat_id,
+                "from": timestamp,
+                "forward": 0,
+                "backward": 30,
+                "getMessages": True,
+            },
+        }
+    )
+
+
+def before_start_auth(phone: str, seq: int) -> bytes:
+    if not re.match(r"^\+7\d{10}$", phone):
+        raise ValueError(f"Phone number must be in format +7xxxxxxxxxx, got: {phone}")
+
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 0,
+            "seq": seq,
+            "opcode": 17,
+            "payload": {"phone": phone, "type": "START_AUTH", "language": "ru"},
+        }
+    )
+
+
+def before_check_code(token: str, code: str, seq: int) -> bytes:
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 0,
+            "seq": seq,
+            "opcode": 18,
+            "payload": {
+                "token": token,
+                "verifyCode": code,
+                "authTokenType": "CHECK_CODE",
+            },
+        }
+    )
+
+
+def before_received_message_response(seq: int, chat_id: int, message_id: str) -> bytes:
+    return dumps(
+        {
+            "ver": 11,
+            "cmd": 1,
+            "seq": seq,
+            "opcode": 128,
+            "payload": {"chatId": chat_id, "messageId": message_id},
+        }
+    )
+
+
+CASES = {
+    "ping (1)": (
+        lambda: before_ping(1234),
+        lambda: payloads.get_ping_json(1234),
+    ),
+    "useragent (6)": (
+        lambda: before_useragent('Mozilla/5.0 "Edge"', DEVICE_ID),
+        lambda: payloads._USERAGENT_HEADER.render('Mozilla/5.0 "Edge"', DEVICE_ID),
+    ),
+    "token (19)": (
+        lambda: before_token(TOKEN, 1),
+        lambda: payloads.get_token_json(TOKEN, 1),
+    ),
+    "subscribe (75)": (
+        lambda: before_subscribe(True, CHAT_ID, 77),
+        lambda: payloads.get_subscribe_json(True, CHAT_ID, 77),
+    ),
+    "read (50)": (
+        lambda: before_read_last_message(CHAT_ID, MESSAGE_ID, TIMESTAMP, 9),
+        lambda: payloads.get_read_last_message_json(
+            CHAT_ID, MESSAGE_ID, TIMESTAMP, 9
+        ),
+    ),
+    "history (49)": (
+        lambda: before_messages(CHAT_ID, TIMESTAMP, 10),
+        lambda: payloads.get_messages_json(CHAT_ID, TIMESTAMP, 10),
+    ),
+    "start auth (17)": (
+        lambda: before_start_auth("+71111111111", 8),
+        lambda: payloads.get_start_auth_json("+71111111111", 8),
+    ),
+    "check code (18)": (
+        lambda: before_check_code(TOKEN, "123456", 16),
+        lambda: payloads.get_check_code_json(TOKEN, "123456", 16),
+    ),
+    "received (128)": (
+        lambda: before_received_message_response(3, CHAT_ID, MESSAGE_ID),
+        lambda: payloads.get_received_message_response_json(3, CHAT_ID, MESSAGE_ID),
+    ),
+}
+
+
+def run(number: int) -> None:
+    print(f"JSON backend: {get_codec().name}")
+    print(f"{'frame':<18}{'before/s':>12}{'after/s':>12}{'speedup':>9}")
+
+    for name, (before, after) in CASES.items():
+        if before() != after():
+            raise AssertionError(f"{name}: {before()!r} != {after()!r}")
+
+        before_time = timeit.timeit(before, number=number)
+        after_time = timeit.timeit(after, number=number)
+
+        print(
+            f"{name:<18}{number / before_time:>12,.0f}{number / after_time:>12,.0f}"
+            f"{before_time / after_time:>8.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100_000)
+
+    run(parser.parse_args().number)
@@ -1,15 +1,30 @@
+from typing import Optional
+
 from aiogram import Bot
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 
-# from aiogram.client.session.aiohttp import AiohttpSession
+from config import config, env
+
+
+def create_bot(token: str, api_server: Optional[str] = None) -> Bot:
+    """Bot talking to the official Bot API, or to `api_server` if it is set"""
+
+    session = None
+
+    if api_server:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api_server))
+
+    return Bot(
+        token=token,
+        default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+        session=session,
+    )
 
-from config import env
 
-bot = Bot(
-    token=env.bot_token.get_secret_value(),
-    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
-)
+bot = create_bot(env.bot_token.get_secret_value(), config.bot.api_server)
 
 # PYTHONANYWHERE
 # session = AiohttpSession(proxy="http://proxy.server:3128")
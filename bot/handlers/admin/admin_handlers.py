@@ -1,13 +1,16 @@
+import asyncio
 import logging
 
 from aiogram import Router
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
 from aiogram.types import Message
 
 from bot.db.database import Database
 from bot.filters.is_admin import IsAdmin
 from bot.utils.phrases import AdminPhrases, ErrorPhrases
 
+from core.tracing import get_tracer
+
 
 router = Router()
 logger = logging.getLogger(__name__)
@@ -29,3 +32,21 @@ async def admin_max_get_subscribed_groups(message: Message, db: Database) -> Non
         f"{group.title}: {group.group_id} | {group.tg_id}" for group in groups
     )
     await message.answer(output if output else "No subscribed groups found.")
+
+
+@router.message(Command(AdminPhrases.command_traces), IsAdmin())
+async def admin_traces(message: Message, command: CommandObject) -> None:
+    """
+    Per-stage forwarding time of the traced messages
+    """
+
+    try:
+        minutes = int(command.args) if command.args else 60
+    except ValueError:
+        await message.answer(ErrorPhrases.invalid())
+        return
+
+    # Reading the trace files may take a while
+    summary = await asyncio.to_thread(get_tracer().summarize, minutes * 60)
+
+    await message.answer(AdminPhrases.traces_summary(minutes, summary))
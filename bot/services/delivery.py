@@ -0,0 +1,204 @@
+"""
+Per-destination delivery of forwarded messages
+
+Every Telegram chat gets its own actor with a bounded queue, so messages keep
+their order inside a chat while a slow or rate-limited chat doesn't hold back
+the others. The number of requests in flight is capped globally.
+"""
+
+import asyncio
+import logging
+import time
+
+from typing import Any, Awaitable, Callable, Optional
+
+from aiogram.exceptions import (
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+
+from config import config
+
+
+logger = logging.getLogger(__name__)
+
+# Performs one send to the given chat ID
+DeliveryJob = Callable[[int], Awaitable[Any]]
+# Called with the result once the job is delivered or given up on
+DeliveryCallback = Callable[[bool], None]
+
+
+class DestinationStats:
+    """Delivery stats of one chat. Latency is from submitting to delivered, in seconds"""
+
+    __slots__ = ("delivered", "failed", "retried", "latency_total", "latency_max")
+
+    def __init__(self):
+        self.delivered = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def add_latency(self, latency: float) -> None:
+        self.delivered += 1
+        self.latency_total += latency
+
+        if latency > self.latency_max:
+            self.latency_max = latency
+
+    @property
+    def latency_avg(self) -> float:
+        return self.latency_total / self.delivered if self.delivered else 0.0
+
+
+class DeliveryActor:
+    """Sends jobs to one chat, one at a time, in the order they were submitted"""
+
+    def __init__(self, chat_id: int, manager: "DeliveryManager"):
+        self.chat_id = chat_id
+        self.manager = manager
+        self.queue: asyncio.Queue[
+            tuple[float, DeliveryJob, Optional[DeliveryCallback]]
+        ] = asyncio.Queue(maxsize=manager.queue_size)
+        self.task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        stats = self.manager.stats_for(self.chat_id)
+
+        while True:
+            try:
+                submitted_at, job, on_done = await asyncio.wait_for(
+                    self.queue.get(), self.manager.idle_timeout
+                )
+            except TimeoutError:
+                # Nothing was submitted while waiting, the actor is recreated on demand
+                if self.queue.empty():
+                    self.manager.actors.pop(self.chat_id, None)
+
+                    logger.info(
+                        "Chat %s idle | delivered %s | failed %s | latency avg %.3fs max %.3fs",
+                        self.chat_id,
+                        stats.delivered,
+                        stats.failed,
+                        stats.latency_avg,
+                        stats.latency_max,
+                    )
+                    return
+                continue
+
+            try:
+                delivered = await self._deliver(job, stats)
+
+                if delivered:
+                    stats.add_latency(time.monotonic() - submitted_at)
+                else:
+                    stats.failed += 1
+
+                if on_done is not None:
+                    on_done(delivered)
+            finally:
+                self.queue.task_done()
+
+    async def _deliver(self, job: DeliveryJob, stats: DestinationStats) -> bool:
+        for attempt in range(self.manager.max_retries + 1):
+            try:
+                async with self.manager.semaphore:
+                    await job(self.chat_id)
+                return True
+
+            except TelegramRetryAfter as e:
+                delay = e.retry_after
+                logger.warning(
+                    "Telegram flood control for chat %s, retry in %ss",
+                    self.chat_id,
+                    delay,
+                )
+
+            except (TelegramNetworkError, TelegramServerError) as e:
+                delay = 2**attempt
+                logger.warning("Failed to deliver to chat %s: %s", self.chat_id, e)
+
+            except Exception as e:
+                logger.error("Failed to deliver to chat %s: %s", self.chat_id, e)
+                return False
+
+            if attempt < self.manager.max_retries:
+                stats.retried += 1
+                await asyncio.sleep(delay)
+
+        logger.error("Giving up delivering to chat %s", self.chat_id)
+        return False
+
+
+class DeliveryManager:
+    def __init__(
+        self,
+        queue_size: int = 100,
+        max_concurrency: int = 20,
+        idle_timeout: float = 300,
+        max_retries: int = 3,
+    ):
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.max_retries = max_retries
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.actors: dict[int, DeliveryActor] = {}
+        self.stats: dict[int, DestinationStats] = {}
+
+    def stats_for(self, chat_id: int) -> DestinationStats:
+        stats = self.stats.get(chat_id)
+
+        if stats is None:
+            stats = self.stats[chat_id] = DestinationStats()
+
+        return stats
+
+    async def submit(
+        self,
+        chat_id: int,
+        job: DeliveryJob,
+        on_done: Optional[DeliveryCallback] = None,
+    ) -> None:
+        """Queue a job for the chat. Waits only if the chat's queue is full"""
+
+        actor = self.actors.get(chat_id)
+
+        if actor is None:
+            actor = self.actors[chat_id] = DeliveryActor(chat_id, self)
+
+        await actor.queue.put((time.monotonic(), job, on_done))
+
+    async def join(self) -> None:
+        """Wait until everything submitted so far is delivered"""
+
+        for actor in list(self.actors.values()):
+            await actor.queue.join()
+
+    async def shutdown(self) -> None:
+        for actor in self.actors.values():
+            actor.task.cancel()
+
+        await asyncio.gather(
+            *(actor.task for actor in self.actors.values()), return_exceptions=True
+        )
+        self.actors.clear()
+
+
+_delivery_manager: Optional[DeliveryManager] = None
+
+
+def get_delivery_manager() -> DeliveryManager:
+    global _delivery_manager
+
+    if _delivery_manager is None:
+        _delivery_manager = DeliveryManager(
+            queue_size=config.bridge.delivery_queue_size,
+            max_concurrency=config.bridge.delivery_concurrency,
+            idle_timeout=config.bridge.delivery_idle_timeout,
+            max_retries=config.bridge.delivery_max_retries,
+        )
+
+    return _delivery_manager
@@ -1,156 +1,82 @@
-from typing import Union
+from typing import Callable, Optional, Union
 import logging
+import time
 
 from aiogram import Bot
-from aiogram.utils.media_group import MediaGroupBuilder
 
-from core.message_models import Attach
-from bot.utils.phrases import ErrorPhrases, Phrases
+from bot.services.delivery import get_delivery_manager
+from bot.services.send_plan import SendPlan
+
+from core.metrics import get_metrics
+from core.tracing import Trace, get_tracer
 
 logger = logging.getLogger(__name__)
 
+SEND_SECONDS = get_metrics().histogram(
+    "max2tg_telegram_send_seconds",
+    "Time of a successful Bot API send",
+    ("method",),
+)
+SEND_ERRORS = get_metrics().counter(
+    "max2tg_telegram_send_errors_total",
+    "Failed Bot API sends, retried ones included",
+    ("method", "error"),
+)
+
 
 async def forward_message_to_group(
     bot: Bot,
     tg_group_ids: Union[int, list[int]],
-    sender_name: str,
-    max_chat: str,
-    message_text: str = None,
-    replied_sender_name: str = None,
-    replied_text: str = None,
-    medias: list[Attach] = None,
+    plan: SendPlan,
+    trace: Optional[Trace] = None,
+    on_done: Optional[Callable[[bool], None]] = None,
 ):
     """Forward a single message to numerous group.
+    Sends are queued per group and delivered concurrently, the call doesn't wait for them
 
     Args:
         bot (Bot): Bot object to perform sending
         tg_group_ids (Union[int, list[int]]): Target group ID or list of group IDs
-        sender_name (str): Sender name
-        max_chat (str): Chat name
-        message_text (str): Source message text
-        replied_sender_name (str, optional): Replied sender name. Defaults to None.
-        replied_text (str, optional): Replied text. Defaults to None.
-        medias (list[Attach], optional): List of media to forward. Max up to 10. Defaults to None.
-    """  # if message has attached media
-
-    many_files = False
-    single_media = None
-
-    if medias:
-        # If media is in plural
-
-        many_files = is_in_plural(medias)
-
-        if many_files:
-            media_group = MediaGroupBuilder(
-                caption=Phrases.max_forwarded_message_template(
-                    max_chat,
-                    sender_name,
-                    message_text,
-                    replied_sender_name,
-                    replied_text,
-                )
-            )
-
-            max_files = min(len(medias), 10)
-
-            for media in medias[:max_files]:
-                match media.type:
-                    case "photo":
-                        media_group.add_photo(media.base_url)
-                    case "doc":
-                        media_group.add_document(media.base_url)
-                    case "video":
-                        media_group.add_video(media.base_url)
-                    case _:
-                        logger.error(f"Unsupported media type: {media.type}")
-        else:
-            # Otherwise if it has only one file
-
-            # Assign the first object of this list to a single variable
-            single_media = medias[0]
+        plan (SendPlan): Pre-rendered message, see `build_send_plan()`
+        trace (Optional[Trace]): Trace of a sampled message, gets every send
+        on_done (Optional[Callable]): Called once every group is delivered or given up on,
+            with True if every group got the message
+    """
 
     if isinstance(tg_group_ids, int):
         tg_group_ids = [tg_group_ids]
 
+    async def send(group_id: int) -> None:
+        started_at = time.perf_counter()
+
+        try:
+            await plan.send(bot, group_id)
+        except Exception as e:
+            SEND_ERRORS.inc(plan.method, type(e).__name__)
+            raise
+
+        elapsed = time.perf_counter() - started_at
+        SEND_SECONDS.observe(elapsed, plan.method)
+
+        if trace is not None:
+            get_tracer().send_done(trace, elapsed)
+
+    # Every group has its own delivery queue, a slow group doesn't delay the others
+    delivery = get_delivery_manager()
+
+    group_done = None
+
+    if on_done is not None:
+        remaining = len(tg_group_ids)
+        all_delivered = True
+
+        def group_done(delivered: bool) -> None:
+            nonlocal remaining, all_delivered
+            remaining -= 1
+            all_delivered = all_delivered and delivered
+
+            if remaining == 0:
+                on_done(all_delivered)
+
     for group_id in tg_group_ids:
-        if many_files:
-            # Send media group with caption if its in plural
-
-            await bot.send_media_group(
-                chat_id=group_id,
-                media=media_group.build(),
-            )
-
-        elif single_media:
-            # Send single media with caption
-
-            match single_media.type:
-                case "photo":
-                    await bot.send_photo(
-                        chat_id=group_id,
-                        photo=single_media.base_url,
-                        caption=Phrases.max_forwarded_message_template(
-                            max_chat,
-                            sender_name,
-                            message_text,
-                            replied_sender_name,
-                            replied_text,
-                        ),
-                    )
-
-                case "doc":
-                    await bot.send_document(
-                        chat_id=group_id,
-                        document=single_media.base_url,
-                        caption=Phrases.max_forwarded_message_template(
-                            max_chat,
-                            sender_name,
-                            message_text,
-                            replied_sender_name,
-                            replied_text,
-                        ),
-                    )
-
-                case "video":
-                    await bot.send_video(
-                        chat_id=group_id,
-                        video=single_media.base_url,
-                        caption=Phrases.max_forwarded_message_template(
-                            max_chat,
-                            sender_name,
-                            message_text,
-                            replied_sender_name,
-                            replied_text,
-                        ),
-                    )
-
-                case _:
-                    logger.error(f"Unsupported media type: {single_media.type}")
-
-        elif not many_files and not single_media:
-            # Send text message otherwise
-
-            await bot.send_message(
-                chat_id=group_id,
-                text=Phrases.max_forwarded_message_template(
-                    max_chat,
-                    sender_name,
-                    message_text,
-                    replied_sender_name,
-                    replied_text,
-                ),
-            )
-
-        else:
-            logger.error(ErrorPhrases.something_went_wrong())
-
-
-def is_in_plural(files: list[str]) -> bool:
-    if isinstance(files, str):
-        return False
-
-    elif isinstance(files, list) and len(files) == 1:
-        return False
-
-    return len(files) > 1
+        await delivery.submit(group_id, send, group_done)
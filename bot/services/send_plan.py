@@ -0,0 +1,109 @@
+"""
+Render-once preparation of forwarded messages
+
+A `ChatMsgMessage` is turned into an immutable `SendPlan` once: the text or caption
+is rendered, the media list is built and the Bot API method is chosen.
+Sending the plan to N groups only does network I/O.
+"""
+
+import logging
+
+from dataclasses import dataclass
+from typing import Any, Literal, Optional
+
+from aiogram import Bot
+from aiogram.utils.media_group import MediaGroupBuilder
+
+from core.message_models import Attach, ChatMsgMessage
+from bot.utils.phrases import Phrases
+
+logger = logging.getLogger(__name__)
+
+# Telegram accepts up to 10 files in a media group
+MAX_MEDIA_GROUP_SIZE = 10
+
+SendMethod = Literal[
+    "send_message", "send_photo", "send_document", "send_video", "send_media_group"
+]
+
+
+@dataclass(frozen=True, slots=True)
+class SendPlan:
+    method: SendMethod
+    # Message text for `send_message`, caption for everything else
+    text: str
+    # File URL for single media
+    file: Optional[str] = None
+    # Built media for `send_media_group`, the caption is already attached
+    media: tuple[Any, ...] = ()
+
+    async def send(self, bot: Bot, chat_id: int) -> None:
+        match self.method:
+            case "send_message":
+                await bot.send_message(chat_id=chat_id, text=self.text)
+            case "send_photo":
+                await bot.send_photo(chat_id=chat_id, photo=self.file, caption=self.text)
+            case "send_document":
+                await bot.send_document(
+                    chat_id=chat_id, document=self.file, caption=self.text
+                )
+            case "send_video":
+                await bot.send_video(chat_id=chat_id, video=self.file, caption=self.text)
+            case "send_media_group":
+                await bot.send_media_group(chat_id=chat_id, media=list(self.media))
+
+
+_SINGLE_MEDIA_METHODS: dict[str, SendMethod] = {
+    "photo": "send_photo",
+    "doc": "send_document",
+    "video": "send_video",
+}
+
+
+def build_send_plan(msg: ChatMsgMessage) -> SendPlan:
+    """Render a MAX chat message into a plan that can be sent to any number of groups"""
+
+    replied = msg.replied_msg
+
+    text = Phrases.max_forwarded_message_template(
+        msg.chat_id,
+        msg.sender_id,
+        msg.text,
+        replied.sender_id if replied else None,
+        replied.text if replied else None,
+    )
+
+    medias = msg.attaches
+
+    if len(medias) > 1:
+        return SendPlan(
+            method="send_media_group", text=text, media=_build_media_group(text, medias)
+        )
+
+    if len(medias) == 1:
+        method = _SINGLE_MEDIA_METHODS.get(medias[0].type)
+
+        if method is not None:
+            return SendPlan(method=method, text=text, file=medias[0].base_url)
+
+        # The text is still forwarded
+        logger.error(f"Unsupported media type: {medias[0].type}")
+
+    return SendPlan(method="send_message", text=text)
+
+
+def _build_media_group(caption: str, medias: tuple[Attach, ...]) -> tuple[Any, ...]:
+    media_group = MediaGroupBuilder(caption=caption)
+
+    for media in medias[:MAX_MEDIA_GROUP_SIZE]:
+        match media.type:
+            case "photo":
+                media_group.add_photo(media.base_url)
+            case "doc":
+                media_group.add_document(media.base_url)
+            case "video":
+                media_group.add_video(media.base_url)
+            case _:
+                logger.error(f"Unsupported media type: {media.type}")
+
+    return tuple(media_group.build())
@@ -24,11 +24,11 @@ class Phrases:
         text: str,
         replied_msg_sender_name: str = None,
         replied_msg_text: str = None,
-    ) -> str | tuple[str, str]:
+    ) -> str:
         if replied_msg_sender_name and replied_msg_text:
             return (
-                f"↪️ Forwarded {replied_msg_sender_name}: {replied_msg_text}",
-                f"☁️ {chat_name} | {sender_name}: {text}",
+                f"↪️ Forwarded {replied_msg_sender_name}: {replied_msg_text}\n"
+                f"☁️ {chat_name} | {sender_name}: {text}"
             )
         else:
             return f"☁️ {chat_name} | {sender_name}: {text}"
@@ -116,6 +116,24 @@ class AdminPhrases:
             f"/{AdminPhrases.command_adm_deactivate_max} [group_id] - отписать группу от рассылки\n"
             f"/{AdminPhrases.command_add_listening_chat_max} [max_chat_id] - добавить чат для прослушивания\n"
             f"/{AdminPhrases.command_remove_listening_chat_max} [max_chat_id] - удалить чат для прослушивания\n"
+            f"/{AdminPhrases.command_traces} [минуты] - время пересылки по этапам (p50/p95/p99), по умолчанию за 60 минут\n"
+        )
+
+    @staticmethod
+    def traces_summary(
+        minutes: int, summary: dict[str, tuple[int, tuple[float, ...]]]
+    ) -> str:
+        if not summary:
+            return f"Нет трассировок за {minutes} мин. Включите <code>tracing.sample_rate</code>"
+
+        rows = "\n".join(
+            f"{stage:<8}{count:>6}{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}"
+            for stage, (count, (p50, p95, p99)) in summary.items()
+        )
+
+        return (
+            f"⏱ Трассировки за {minutes} мин, мс\n"
+            f"<pre>{'stage':<8}{'count':>6}{'p50':>9}{'p95':>9}{'p99':>9}\n{rows}</pre>"
         )
 
     # region Admin Commands, Buttons
@@ -150,6 +168,8 @@ class AdminPhrases:
     command_add_listening_chat_max: str = "add_listening_chat"
     command_remove_listening_chat_max: str = "remove_listening_chat"
 
+    command_traces: str = "traces"
+
     # endregion
 
 
@@ -193,6 +213,10 @@ class ErrorPhrases:
     def network_issues() -> str:
         return "❌ something went wrong with server. Please try again later"
 
+    @staticmethod
+    def chats_not_fetched() -> str:
+        return "⚠️ Вход выполнен, но список чатов не загрузился. Он обновится при следующем подключении"
+
 
 class ButtonPhrases:
     lessons_command: str = "lessons"
@@ -1,6 +1,6 @@
 from pathlib import Path
 
-from typing import List, Literal
+from typing import List, Literal, Optional
 
 from pydantic import BaseModel, SecretStr, Field
 from pydantic_settings import BaseSettings, SettingsConfigDict, YamlConfigSettingsSource
@@ -19,10 +19,108 @@ class BotSettings(BaseModel):
     db_url: str = Field(...)
     ttl_default: int = Field(...)
 
+    # Base URL of a self-hosted or local Bot API server, e.g. http://127.0.0.1:8081.
+    # Empty means the official api.telegram.org
+    api_server: Optional[str] = None
+
 
 class MaxSettings(BaseModel):
     db_url: str = Field(..., alias="max_db_url")
 
+    # Saved accounts are connected concurrently at startup:
+    # `startup_rate` connections per second (bursts up to `startup_burst`),
+    # each delayed by a random 0..`startup_jitter` s, at most `startup_max_in_flight` handshakes at once
+    startup_rate: float = 5
+    startup_burst: int = 10
+    startup_jitter: float = 0.5
+    startup_max_in_flight: int = 20
+    # Connections not closed in time on shutdown are aborted
+    shutdown_timeout: float = 10
+
+    # Dropped connections are restored with exponential backoff and jitter,
+    # no more than `reconnect_rate` reconnects per second across all accounts
+    reconnect_base_delay: float = 1
+    reconnect_max_delay: float = 60
+    reconnect_rate: float = 10
+    reconnect_burst: int = 20
+
+    # Seconds to wait for the reply to a request (auth, chat list, history)
+    request_timeout: float = 10
+
+    # Run MAX clients in N worker processes, accounts are sharded by TG ID.
+    # 0 runs them in the main process
+    workers: int = 0
+
+    # Messages missed while disconnected are fetched by pages of `catch_up_page_size`,
+    # up to `catch_up_max_messages` per chat, and forwarded at `catch_up_rate` messages
+    # per second across all accounts. Catch-up pauses while the bot queue is
+    # more than `catch_up_queue_share` full, so live messages go first
+    catch_up_page_size: int = 30
+    catch_up_max_messages: int = 300
+    catch_up_rate: float = 5
+    catch_up_queue_share: float = 0.5
+
+
+class BridgeSettings(BaseModel):
+    # Workers forwarding MAX messages to Telegram, messages of one chat stay in order
+    workers: int = 8
+    # A full worker queue parks the rest, up to `shard_queue_size * workers` in total
+    shard_queue_size: int = 100
+    # Log per-worker stats every N seconds, 0 to disable
+    stats_interval: int = 300
+    # Every TG chat has its own delivery queue, requests in flight are capped globally
+    delivery_queue_size: int = 100
+    delivery_concurrency: int = 20
+    delivery_idle_timeout: int = 300
+    delivery_max_retries: int = 3
+    # Messages received by several accounts are forwarded once:
+    # up to `dedup_size` recent messages are remembered for `dedup_ttl` seconds
+    dedup_size: int = 10000
+    dedup_ttl: int = 600
+
+
+class QueueSettings(BaseModel):
+    to_bot_size: int = 1000
+    # What to do with a message when `to_bot` is full, by message type, `default` for the rest:
+    # block (wait up to `block_timeout` s, then drop), drop_oldest (drop the oldest queued message
+    # of the chat), coalesce (replace a queued copy), spill (write to `spill_file`, fed back later)
+    policies: dict[str, Literal["block", "drop_oldest", "coalesce", "spill"]] = {
+        "new_chat_message": "spill",
+        "fetch_chats": "coalesce",
+        "error": "coalesce",
+        "default": "block",
+    }
+    block_timeout: float = 5
+    spill_file: str = "logs/to_bot.spill"
+
+
+class OutboxSettings(BaseModel):
+    # Chat messages are kept in a SQLite outbox until they are delivered,
+    # undelivered ones are forwarded again after a restart
+    enabled: bool = True
+    path: str = "max/outbox.db"
+    # One commit per `flush_interval` s or `batch_size` messages
+    batch_size: int = 500
+    flush_interval: float = 0.02
+    # Delivered messages are deleted after N seconds
+    retention: int = 3600
+
+
+class MetricsSettings(BaseModel):
+    # Prometheus text format on http://host:port/metrics
+    enabled: bool = False
+    host: str = "127.0.0.1"
+    port: int = 9108
+
+
+class TracingSettings(BaseModel):
+    # Share of received chat messages traced through every stage, 0 disables tracing.
+    # Traces are appended to `file`, rotated at `max_bytes` keeping `backup_count` old files
+    sample_rate: float = 0
+    file: str = "logs/traces.jsonl"
+    max_bytes: int = 10_000_000
+    backup_count: int = 3
+
 
 class LoggingConfig(BaseModel):
     log_level: Literal[
@@ -39,6 +137,7 @@ class LoggingConfig(BaseModel):
 
 class WebSocket(BaseModel):
     url: str = Field(...)
+    json_backend: Literal["auto", "orjson", "msgspec", "json"] = "auto"
 
 
 class Settings(BaseSettings):
@@ -53,6 +152,11 @@ class Settings(BaseSettings):
     max: MaxSettings
     logging: LoggingConfig
     ws: WebSocket
+    bridge: BridgeSettings = BridgeSettings()
+    queues: QueueSettings = QueueSettings()
+    outbox: OutboxSettings = OutboxSettings()
+    metrics: MetricsSettings = MetricsSettings()
+    tracing: TracingSettings = TracingSettings()
 
     @classmethod
     def settings_customise_sources(cls, settings_cls, **kwargs):
@@ -0,0 +1,317 @@
+"""
+Overflow policies of the bot queue
+
+MAX clients put everything they receive into `to_bot`. When Telegram slows down the
+queue fills up, and a plain `put()` would stop every client's receive loop: pings
+stop and MAX drops the sockets. Instead, a full queue is handled per message type
+(`queues.policies`):
+
+- block:       wait up to `queues.block_timeout` s for room, then drop the message
+- drop_oldest: drop the oldest queued message of the same chat (or the oldest chat
+               message at all) to make room
+- coalesce:    replace a queued message with the same key (the same chat list, the same
+               message received by several accounts), otherwise block
+- spill:       write the message to `queues.spill_file`, it is fed back in order
+               when there is room again. What is still spilled on shutdown stays in
+               the file and is fed back by `restore()` on the next start
+
+Messages a policy drops are passed to `on_dropped`, the queue manager marks them
+delivered in the outbox, they would be replayed on every start otherwise.
+Spilled messages that are in the outbox aren't restored, the outbox replays them.
+
+What every policy did is counted in `max2tg_queue_overflow_total`.
+"""
+
+import asyncio
+import logging
+import os
+import pickle
+
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Hashable, Literal, Optional
+
+from core.message_models import ChatMsgMessage, ErrorMessage, FetchChatsMessage
+from core.metrics import get_metrics
+
+if TYPE_CHECKING:
+    from core.queue_manager import MonitoredQueue
+
+
+logger = logging.getLogger(__name__)
+
+Policy = Literal["block", "drop_oldest", "coalesce", "spill"]
+
+OVERFLOWS = get_metrics().counter(
+    "max2tg_queue_overflow_total",
+    "Messages that met a full bot queue, by what the overflow policy did",
+    ("type", "outcome"),
+)
+
+
+def message_type(item: Any) -> str:
+    if isinstance(item, list):
+        return item[0].type if item else "empty"
+
+    return getattr(item, "type", type(item).__name__)
+
+
+def coalesce_key(item: Any) -> Optional[Hashable]:
+    """Queued items with the same key carry the same thing, the newest one is enough"""
+
+    if isinstance(item, list):
+        if item and isinstance(item[0], FetchChatsMessage):
+            return ("fetch_chats", item[0].user_id)
+        return None
+
+    if isinstance(item, ChatMsgMessage):
+        return ("new_chat_message", item.chat_id, item.message_id)
+
+    if isinstance(item, ErrorMessage):
+        return ("error", item.user_id, item.message)
+
+    return None
+
+
+class SpillFile:
+    """Pickled items appended to a file and read back in the same order"""
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        self.pending = 0
+
+        self._writer = None
+        self._reader = None
+
+    def load(self) -> list[Any]:
+        """Items left by the previous run, the file is removed after reading"""
+
+        items = []
+
+        if not self.path.exists():
+            return items
+
+        with self.path.open("rb") as f:
+            while True:
+                try:
+                    items.append(pickle.load(f))
+                except EOFError:
+                    break
+                except Exception as e:
+                    # The last write was cut off
+                    logger.error("Broken spill file %s, the rest is dropped: %s", self.path, e)
+                    break
+
+        os.remove(self.path)
+        return items
+
+    def append(self, item: Any) -> None:
+        if self._writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # What the previous run left was loaded before
+            self._writer = self.path.open("wb")
+            self._reader = self.path.open("rb")
+
+        pickle.dump(item, self._writer, protocol=pickle.HIGHEST_PROTOCOL)
+        self._writer.flush()
+        self.pending += 1
+
+    def pop(self) -> Any:
+        item = pickle.load(self._reader)
+        self.pending -= 1
+
+        # Start over, the file doesn't grow forever
+        if self.pending == 0:
+            self._reader.seek(0)
+            self._writer.seek(0)
+            self._writer.truncate()
+
+        return item
+
+    def close(self, keep: list[Any] = ()) -> int:
+        """Leave only the pending items (after `keep`) in the file, returns how many"""
+
+        items = list(keep)
+
+        if self.pending:
+            items.extend(pickle.load(self._reader) for _ in range(self.pending))
+
+        for f in (self._writer, self._reader):
+            if f is not None:
+                f.close()
+
+        self._writer = self._reader = None
+        self.pending = 0
+
+        if items:
+            with self.path.open("wb") as f:
+                for item in items:
+                    pickle.dump(item, f, protocol=pickle.HIGHEST_PROTOCOL)
+        elif self.path.exists():
+            os.remove(self.path)
+
+        return len(items)
+
+
+class Backpressure:
+    """Puts items into a bounded queue without blocking the producer for long"""
+
+    def __init__(
+        self,
+        queue: "MonitoredQueue",
+        policies: dict[str, Policy],
+        block_timeout: float = 5,
+        spill_file: str = "logs/to_bot.spill",
+        on_dropped: Optional[Callable[[Any], None]] = None,
+    ):
+        self.queue = queue
+        self.policies = policies
+        self.block_timeout = block_timeout
+        self.on_dropped = on_dropped
+
+        self._spill = SpillFile(spill_file)
+        self._unspill_task: Optional[asyncio.Task] = None
+        # Taken from the file, not in the queue yet
+        self._unspilling: Optional[Any] = None
+
+        self._handlers: dict[Policy, Callable[[Any, str], Any]] = {
+            "block": self._block,
+            "drop_oldest": self._drop_oldest,
+            "coalesce": self._coalesce,
+            "spill": self._spill_item,
+        }
+
+    @property
+    def spilling(self) -> bool:
+        return self._unspill_task is not None and not self._unspill_task.done()
+
+    def policy_of(self, kind: str) -> Policy:
+        return self.policies.get(kind) or self.policies.get("default", "block")
+
+    async def put(self, item: Any) -> None:
+        kind = message_type(item)
+        policy = self.policy_of(kind)
+
+        # Spilled items go first, everything after them is spilled too to keep the order
+        if policy == "spill" and self.spilling:
+            self._spill_item(item, kind)
+            return
+
+        if not self.queue.full():
+            self.queue.put_nowait(item)
+            return
+
+        result = self._handlers[policy](item, kind)
+
+        if asyncio.iscoroutine(result):
+            await result
+
+    async def restore(self) -> None:
+        """Put back what was still spilled when the previous run stopped"""
+
+        try:
+            items = self._spill.load()
+        except OSError as e:
+            logger.error("Failed to read the spill file %s: %s", self._spill.path, e)
+            return
+
+        # The outbox replays its own messages
+        items = [item for item in items if getattr(item, "outbox_id", None) is None]
+
+        if items:
+            logger.info("🚰 Restoring %s spilled messages of the previous run", len(items))
+
+        for item in items:
+            await self.put(item)
+
+    async def close(self) -> None:
+        """Stop feeding spilled items back, the ones left are kept for the next start"""
+
+        if self._unspill_task is not None:
+            self._unspill_task.cancel()
+            await asyncio.gather(self._unspill_task, return_exceptions=True)
+
+        keep = [self._unspilling] if self._unspilling is not None else []
+        self._unspilling = None
+
+        try:
+            kept = self._spill.close(keep)
+        except (OSError, pickle.PickleError, EOFError) as e:
+            logger.error("Failed to keep spilled messages in %s: %s", self._spill.path, e)
+            return
+
+        if kept:
+            logger.warning(
+                "🚰 %s spilled messages kept in %s for the next start", kept, self._spill.path
+            )
+
+    def _dropped(self, item: Any) -> None:
+        if self.on_dropped is not None:
+            self.on_dropped(item)
+
+    async def _block(self, item: Any, kind: str) -> None:
+        OVERFLOWS.inc(kind, "blocked")
+
+        try:
+            await asyncio.wait_for(self.queue.put(item), self.block_timeout)
+        except TimeoutError:
+            OVERFLOWS.inc(kind, "timed_out")
+            logger.warning("Bot queue is full for %ss, %s dropped", self.block_timeout, kind)
+            self._dropped(item)
+
+    def _drop_oldest(self, item: Any, kind: str) -> Any:
+        chat_id = getattr(item, "chat_id", None)
+
+        evicted = self.queue.evict(
+            lambda queued: isinstance(queued, ChatMsgMessage) and queued.chat_id == chat_id
+        )
+
+        if evicted is None:
+            evicted = self.queue.evict(lambda queued: isinstance(queued, ChatMsgMessage))
+
+        # Nothing to drop, wait for room instead
+        if evicted is None:
+            return self._block(item, kind)
+
+        OVERFLOWS.inc(kind, "evicted")
+        self._dropped(evicted)
+        self.queue.put_nowait(item)
+
+    def _coalesce(self, item: Any, kind: str) -> Any:
+        key = coalesce_key(item)
+
+        if key is not None:
+            replaced = self.queue.replace(lambda queued: coalesce_key(queued) == key, item)
+
+            if replaced is not None:
+                OVERFLOWS.inc(kind, "coalesced")
+                self._dropped(replaced)
+                return None
+
+        return self._block(item, kind)
+
+    def _spill_item(self, item: Any, kind: str) -> None:
+        try:
+            self._spill.append(item)
+        except (OSError, pickle.PicklingError) as e:
+            OVERFLOWS.inc(kind, "spill_failed")
+            logger.error("Failed to spill %s: %s", kind, e)
+            self._dropped(item)
+            return
+
+        OVERFLOWS.inc(kind, "spilled")
+
+        if not self.spilling:
+            self._unspill_task = asyncio.create_task(self._unspill())
+
+    async def _unspill(self) -> None:
+        """Feed spilled items back as soon as there is room"""
+
+        logger.warning("🚰 Bot queue is full, spilling messages to %s", self._spill.path)
+
+        while self._spill.pending:
+            self._unspilling = item = self._spill.pop()
+            await self.queue.put(item)
+            self._unspilling = None
+            OVERFLOWS.inc(message_type(item), "unspilled")
+
+        logger.info("🚰 All spilled messages are back in the bot queue")
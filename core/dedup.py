@@ -0,0 +1,95 @@
+"""
+De-duplication of MAX messages received by several accounts
+
+When bridged accounts share a MAX chat, every account's socket delivers
+the same message. The first copy is forwarded to the groups of all bridged
+members of the chat, later copies only to groups that didn't get it yet.
+
+Hits (copies with nothing left to send) and misses are exported as metrics.
+"""
+
+from typing import Optional
+
+from cachetools import TTLCache
+
+from core.metrics import family, get_metrics
+
+from config import config
+
+
+class DedupStore:
+    """Bounded, time-windowed store of forwarded messages, keyed by (chat ID, message ID)"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 600):
+        # (MAX chat ID, message ID) -> TG groups the message was forwarded to
+        self._seen: TTLCache[tuple[int, str], set[int]] = TTLCache(
+            maxsize=maxsize, ttl=ttl
+        )
+
+        self.hits = 0
+        self.misses = 0
+
+    def claim(self, chat_id: int, message_id: str, group_ids: set[int]) -> set[int]:
+        """Groups that still have to receive the message. They are marked as done"""
+
+        key = (chat_id, message_id)
+        sent = self._seen.get(key)
+
+        if sent is None:
+            self.misses += 1
+            self._seen[key] = set(group_ids)
+            return group_ids
+
+        # A member account joined after the first copy was forwarded
+        missing = group_ids - sent
+
+        if not missing:
+            self.hits += 1
+            return missing
+
+        self.misses += 1
+        sent |= missing
+        return missing
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+_dedup_store: Optional[DedupStore] = None
+
+
+def get_dedup_store() -> DedupStore:
+    global _dedup_store
+
+    if _dedup_store is None:
+        _dedup_store = DedupStore(
+            maxsize=config.bridge.dedup_size,
+            ttl=config.bridge.dedup_ttl,
+        )
+
+    return _dedup_store
+
+
+def _collect_dedup():
+    if _dedup_store is None:
+        return []
+
+    return [
+        family(
+            "max2tg_dedup_total",
+            "Copies of MAX messages checked for duplicates: hit (nothing left to send), miss",
+            {
+                (("result", "hit"),): _dedup_store.hits,
+                (("result", "miss"),): _dedup_store.misses,
+            },
+            type="counter",
+        ),
+        family(
+            "max2tg_dedup_size",
+            "Forwarded messages remembered for de-duplication",
+            {(): len(_dedup_store)},
+        ),
+    ]
+
+
+get_metrics().add_collector(_collect_dedup)
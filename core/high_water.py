@@ -0,0 +1,94 @@
+"""
+High-water marks of forwarded MAX messages
+
+For every (account, chat) we remember the newest message that was forwarded.
+After a reconnect the client asks MAX only for the messages above the mark.
+
+The outbox (`core/outbox.py`) saves the marks with its commits and loads them on start,
+so messages sent while the bridge was down are caught up on too.
+With `outbox.enabled` off the marks live in memory only and a restart forgets them
+"""
+
+from typing import Callable, Optional
+
+
+# (message time in ms, message ID), compared as a tuple
+Position = tuple[int, int]
+
+
+def message_position(timestamp: int, message_id: str) -> Position:
+    """Position of a message in its chat. MAX message IDs grow with time"""
+
+    try:
+        return timestamp, int(message_id)
+    except (TypeError, ValueError):
+        return timestamp, 0
+
+
+class HighWaterMarks:
+    def __init__(self):
+        # (owner TG ID, MAX chat ID) -> position of the last forwarded message
+        self._marks: dict[tuple[int, int], Position] = {}
+
+        # Moved since they were last saved
+        self._dirty: set[tuple[int, int]] = set()
+
+        # Called with (owner TG ID, MAX chat ID, position) when a mark moves
+        self.on_advance: Optional[Callable[[int, int, Position], None]] = None
+
+    def advance(self, owner_id: int, chat_id: int, position: Position) -> None:
+        """Move the mark forward. Older positions are ignored"""
+
+        key = (owner_id, chat_id)
+        mark = self._marks.get(key)
+
+        if mark is None or position > mark:
+            self._marks[key] = position
+            self._dirty.add(key)
+
+            if self.on_advance is not None:
+                self.on_advance(owner_id, chat_id, position)
+
+    def load(self, marks: dict[tuple[int, int], Position]) -> None:
+        """Marks saved before, the ones already moved further are kept"""
+
+        for key, position in marks.items():
+            mark = self._marks.get(key)
+
+            if mark is None or position > mark:
+                self._marks[key] = position
+
+    def pop_dirty(self) -> list[tuple[int, int, Position]]:
+        """(owner TG ID, MAX chat ID, position) of the marks moved since the last call"""
+
+        dirty = [(owner, chat, self._marks[owner, chat]) for owner, chat in self._dirty]
+        self._dirty.clear()
+
+        return dirty
+
+    def items(self) -> dict[tuple[int, int], Position]:
+        return dict(self._marks)
+
+    def get(self, owner_id: int, chat_id: int) -> Optional[Position]:
+        return self._marks.get((owner_id, chat_id))
+
+    def chats(self, owner_id: int) -> dict[int, Position]:
+        """Marks of all chats forwarded from the account"""
+
+        return {
+            chat_id: mark
+            for (owner, chat_id), mark in self._marks.items()
+            if owner == owner_id
+        }
+
+
+_high_water_marks = None
+
+
+def get_high_water_marks() -> HighWaterMarks:
+    global _high_water_marks
+
+    if _high_water_marks is None:
+        _high_water_marks = HighWaterMarks()
+
+    return _high_water_marks
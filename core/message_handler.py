@@ -1,4 +1,6 @@
+import asyncio
 import logging
+import time
 from typing import Union
 
 from aiogram import Bot
@@ -6,13 +8,21 @@ from aiogram import Bot
 from bot.db.database import Database
 from bot.db.db_dependency import DBDependency
 from bot.services.mailing_manager import forward_message_to_group
+from bot.services.send_plan import build_send_plan
 from bot.utils.phrases import Phrases, ErrorPhrases
 
 from max.db.max_repo import MaxRepository
+from max.db.routing_index import ANY_CHAT_CODE, get_routing_index
 from max.clients_manager import MaxManager
+from max.utils.pending_requests import MaxRequestError
 from max.utils.user_keyboard import max_chats_inline_kb
 
+from core.dedup import get_dedup_store
+from core.high_water import get_high_water_marks, message_position
+from core.outbox import get_outbox
+from core.tracing import get_tracer
 from core.queue_manager import get_queue_manager
+from core.sharded_consumer import ShardedConsumer
 from core.message_models import (
     DTO,
     SubscribeGroupDTO,
@@ -27,55 +37,83 @@ from core.message_models import (
     ErrorMessage,
 )
 
+from config import config
+
 
 logger = logging.getLogger(__name__)
 
+# Commands handled in their own task
+AUTH_COMMANDS = ("start_auth", "verify_code")
+
 
 async def handle_from_bot(
-    bot: Bot, max_manager: MaxManager, db_dependency: DBDependency
+    bot: Bot,
+    max_manager: MaxManager,
+    db_dependency: DBDependency,
+    bot_db_dependency: DBDependency,
 ) -> None:
     """Listen for commands from the bot and send them to the MAX WebSocket"""
 
-    while True:
-        try:
-            msg = await get_queue_manager().to_ws.get()
+    auth_tasks: set[asyncio.Task] = set()
 
+    async def handle(msg: Union[MessageModel, DTO]) -> None:
+        try:
             await send_to_websocket(
                 max_manager=max_manager,
                 msg=msg,
                 db_dependency=db_dependency,
                 bot=bot,
+                bot_db_dependency=bot_db_dependency,
             )
-            get_queue_manager().to_ws.task_done()
-
         except Exception as e:
             logger.error("[FROM BOT] Handling error: %s. Message: %s", e, msg)
 
+    while True:
+        msg = await get_queue_manager().to_ws.get()
+
+        # Logins wait for MAX for up to tens of seconds, other users' commands don't wait for them
+        if msg.type in AUTH_COMMANDS:
+            task = asyncio.create_task(handle(msg))
+            auth_tasks.add(task)
+            task.add_done_callback(auth_tasks.discard)
+        else:
+            await handle(msg)
+
+        get_queue_manager().to_ws.task_done()
+
 
 async def handle_from_ws(
     bot: Bot, db_dependency: DBDependency, bot_db_dependency: DBDependency
 ) -> None:
-    """Listen for commands from the MAX WebSocket and send them to the bot"""
-
-    while True:
-        try:
-            msg = await get_queue_manager().to_bot.get()
-            await send_to_bot(
-                bot=bot,
-                db_dependency=db_dependency,
-                msg=msg,
-                bot_db_dependency=bot_db_dependency,
-            )
-            get_queue_manager().to_bot.task_done()
-
-        except Exception as e:
-            logger.error("[FROM WS] Handling error: %s. Message: %s", e, msg)
+    """
+    Listen for commands from the MAX WebSocket and send them to the bot.
+    Messages are handled by a pool of workers sharded by MAX chat
+    """
+
+    async def handle(msg: Union[MessageModel, ChatMsgMessage, list[MessageModel]]) -> None:
+        await send_to_bot(
+            bot=bot,
+            db_dependency=db_dependency,
+            msg=msg,
+            bot_db_dependency=bot_db_dependency,
+        )
+
+    consumer = ShardedConsumer(
+        source=get_queue_manager().to_bot,
+        handler=handle,
+        workers=config.bridge.workers,
+        shard_queue_size=config.bridge.shard_queue_size,
+        stats_interval=config.bridge.stats_interval,
+        name="FROM WS",
+    )
+
+    await consumer.run()
 
 
 async def send_to_bot(
     bot: Bot,
     db_dependency: DBDependency,
-    msg: Union[MessageModel, list[MessageModel]],
+    msg: Union[MessageModel, ChatMsgMessage, list[MessageModel]],
     bot_db_dependency: DBDependency,
 ) -> None:
     """Catch messages from the MAX Clients and send them to the bot"""
@@ -86,21 +124,15 @@ async def send_to_bot(
 
     if isinstance(msg, list):
         if isinstance(msg[0], FetchChatsMessage):
-            async with db_dependency.db_session() as session:
-                db = MaxRepository(session=session)
-
-                for raw_fcmsg in msg:
-                    fcmsg = FetchChatsMessage.model_validate(raw_fcmsg.model_dump())
-
-                    await db.save_user_chat(
-                        owner_id=fcmsg.user_id,
-                        chat_id=fcmsg.chat_id,
-                        chat_title=fcmsg.chat_title,
-                    )
+            await save_chats(db_dependency, msg)
 
             return
 
-    # idk why not using isinstance FIXME: fix
+    # The hot path, built and checked once when it was received
+    if isinstance(msg, ChatMsgMessage):
+        await forward_chat_message(bot, msg)
+        return
+
     match msg.type:
         case "phone_sent":
             psmsg = PhoneSentMessage.model_validate(msg.model_dump())
@@ -136,42 +168,6 @@ async def send_to_bot(
 
             await bot.send_message(scmsg.user_id, Phrases.max_login_success())
 
-        case "new_chat_message":
-            cmmsg = ChatMsgMessage.model_validate(msg.model_dump())
-
-            async with db_dependency.db_session() as session:
-                db = MaxRepository(session=session)
-
-                connected_groups = await db.get_groups_include_any(cmmsg.chat_id)
-
-            if not connected_groups:
-                logger.error("No subscribed groups for a chat: %s", cmmsg.chat_id)
-
-                return
-
-            ids = [group.group_id for group in connected_groups]
-
-            if cmmsg.replied_msg:
-                await forward_message_to_group(
-                    bot=bot,
-                    tg_group_ids=ids,
-                    sender_name=cmmsg.sender_id,
-                    max_chat=cmmsg.chat_id,
-                    message_text=cmmsg.text,
-                    replied_sender_name=cmmsg.replied_msg.sender_id,
-                    replied_text=cmmsg.replied_msg.text,
-                    medias=cmmsg.attaches,
-                )
-            else:
-                await forward_message_to_group(
-                    bot=bot,
-                    tg_group_ids=ids,
-                    sender_name=cmmsg.sender_id,
-                    max_chat=cmmsg.chat_id,
-                    message_text=cmmsg.text,
-                    medias=cmmsg.attaches,
-                )
-
         case "send_chat_list":
             pass
 
@@ -184,8 +180,100 @@ async def send_to_bot(
             logger.error(f"Unknown action: {msg.type}")
 
 
+async def forward_chat_message(bot: Bot, msg: ChatMsgMessage) -> None:
+    """Forward a MAX chat message to every subscribed group, once per group"""
+
+    trace = msg.trace
+
+    if trace is not None:
+        trace.mark("queue", time.time() - trace.enqueued_at)
+        started_at = time.perf_counter()
+
+    routing = get_routing_index()
+    routing.join(msg.user_id, msg.chat_id)
+
+    # Routes are kept in memory, no DB lookups on the hot path.
+    # Groups of every bridged member are served by whichever copy comes first
+    groups = routing.lookup_chat(msg.chat_id)
+
+    if not groups:
+        logger.debug("No subscribed groups for a chat: %s", msg.chat_id)
+
+        if trace is not None:
+            trace.mark("routing", time.perf_counter() - started_at)
+            get_tracer().expect_sends(trace, 0)
+
+        _ack(msg)
+
+        return
+
+    ids = get_dedup_store().claim(msg.chat_id, msg.message_id, groups)
+
+    if trace is not None:
+        trace.mark("routing", time.perf_counter() - started_at)
+
+    if ids:
+        # Rendered once, sending to every group is network I/O only
+        started_at = time.perf_counter()
+        plan = build_send_plan(msg)
+
+        if trace is not None:
+            trace.mark("render", time.perf_counter() - started_at)
+            get_tracer().expect_sends(trace, len(ids))
+
+        # Out of the outbox once every group got it, dead-lettered if one didn't
+        await forward_message_to_group(
+            bot=bot,
+            tg_group_ids=list(ids),
+            plan=plan,
+            trace=trace,
+            on_done=lambda delivered: _ack(msg, delivered),
+        )
+
+    else:
+        if trace is not None:
+            get_tracer().expect_sends(trace, 0)
+
+        _ack(msg)
+
+    # A reconnect catches up only on messages after this one
+    get_high_water_marks().advance(
+        msg.user_id,
+        msg.chat_id,
+        message_position(msg.timestamp, msg.message_id),
+    )
+
+
+def _ack(msg: ChatMsgMessage, delivered: bool = True) -> None:
+    """The message is handled, the outbox won't replay it"""
+
+    if msg.outbox_id is None:
+        return
+
+    if delivered:
+        get_outbox().ack(msg.outbox_id)
+    else:
+        get_outbox().fail(msg.outbox_id)
+
+
+async def save_chats(db_dependency: DBDependency, chats: list[FetchChatsMessage]):
+    """Save the chat list of an account and remember it as a member of those chats"""
+
+    get_routing_index().set_chats(chats[0].user_id, (chat.chat_id for chat in chats))
+
+    # The whole list is saved in one transaction
+    async with db_dependency.db_session() as session:
+        db = MaxRepository(session=session)
+
+        await db.save_user_chats(owner_id=chats[0].user_id, chats=chats)
+
+
 async def send_to_websocket(
-    max_manager: MaxManager, msg: MessageModel, db_dependency: DBDependency, bot: Bot
+    max_manager: MaxManager,
+    msg: MessageModel,
+    db_dependency: DBDependency,
+    bot: Bot,
+    bot_db_dependency: DBDependency,
 ) -> None:
     """Catch messages from the bot and send them to the Max"""
 
@@ -195,10 +283,30 @@ async def send_to_websocket(
 
     match msg.type:
         case "start_auth":
-            await max_manager.start_auth(
-                msg.user_id, StartAuthMessage.model_validate(msg.model_dump()).phone
+            # The reply is awaited by seq, no hand-off through the bot queue
+            try:
+                short_token = await max_manager.start_auth(
+                    msg.user_id,
+                    StartAuthMessage.model_validate(msg.model_dump()).phone,
+                )
+            except (MaxRequestError, TimeoutError, ConnectionError) as e:
+                await _report_request_error(bot, msg.user_id, e)
+                return
+
+            logger.info(
+                "📃 Phone number confirmed, waiting for sms code...| Short Token: %s | User ID: %s",
+                short_token,
+                msg.user_id,
             )
 
+            # Save account with the short token
+            async with db_dependency.db_session() as session:
+                db = MaxRepository(session=session)
+
+                await db.save_account(msg.user_id, short_token)
+
+            await bot.send_message(msg.user_id, Phrases.max_request_sms())
+
         case "verify_code":
             vcmsg = VerifyCodeMessage.model_validate(msg.model_dump())
 
@@ -209,11 +317,38 @@ async def send_to_websocket(
                     db = MaxRepository(session=session)
                     token = await db.get_user_token(vcmsg.user_id)
 
-            await max_manager.check_code(
-                key=msg.user_id,
-                short_token=token,
-                code=vcmsg.code,
-            )
+            try:
+                full_token = await max_manager.check_code(
+                    key=msg.user_id,
+                    short_token=token,
+                    code=vcmsg.code,
+                )
+            except (MaxRequestError, TimeoutError, ConnectionError) as e:
+                await _report_request_error(bot, msg.user_id, e)
+                return
+
+            # Update user token
+            async with db_dependency.db_session() as session:
+                db = MaxRepository(session=session)
+
+                await db.set_user_token(vcmsg.user_id, full_token)
+
+            async with bot_db_dependency.db_session() as session:
+                db = Database(session=session)
+
+                await db.update_connection_state(vcmsg.user_id, True)
+
+            await bot.send_message(vcmsg.user_id, Phrases.max_login_success())
+
+            try:
+                chats = await max_manager.fetch_chats(vcmsg.user_id)
+            except (MaxRequestError, TimeoutError, ConnectionError) as e:
+                logger.error("[FROM BOT] Failed to fetch chats of %s: %s", vcmsg.user_id, e)
+                await bot.send_message(vcmsg.user_id, ErrorPhrases.chats_not_fetched())
+                return
+
+            if chats:
+                await save_chats(db_dependency, chats)
 
         case "sub_group":
             scdto = SubscribeGroupDTO.model_validate(msg.model_dump())
@@ -304,6 +439,8 @@ async def send_to_websocket(
                     Phrases.group_disconnected_success(scdto.group_title),
                 )
 
+                await _release_chat(max_manager, group.connected_chat_id, scdto.group_id)
+
             else:
                 await bot.send_message(
                     scdto.group_id,
@@ -331,6 +468,8 @@ async def send_to_websocket(
                     )
                     return
 
+                previous_chat_id = group.connected_chat_id
+
                 r = await db.connect_group_to_chat(
                     group_id=scdto.group_id,
                     chat_id=scdto.chat_id,
@@ -343,11 +482,40 @@ async def send_to_websocket(
                     )
 
                     await max_manager.subscribe_to_chat(
-                        key=scdto.owner_id, chat_id=scdto.chat_id
+                        key=scdto.owner_id,
+                        chat_id=scdto.chat_id,
+                        consumer=scdto.group_id,
                     )
 
+                    if previous_chat_id != scdto.chat_id:
+                        await _release_chat(
+                            max_manager, previous_chat_id, scdto.group_id
+                        )
+
                 else:
                     await bot.send_message(
                         scdto.group_id,
                         ErrorPhrases.something_went_wrong(),
                     )
+
+
+async def _report_request_error(bot: Bot, user_id: int, error: Exception) -> None:
+    """Tell the user that MAX rejected the request or didn't answer"""
+
+    logger.error("[FROM BOT] MAX request failed for %s: %s", user_id, error)
+
+    if isinstance(error, MaxRequestError) and error.localized_message:
+        await bot.send_message(user_id, error.localized_message)
+    else:
+        await bot.send_message(user_id, ErrorPhrases.something_went_wrong())
+
+
+async def _release_chat(
+    max_manager: MaxManager, chat_id: Union[int, str, None], group_id: int
+) -> None:
+    """The group is no longer connected to the chat, drop its subscription"""
+
+    if chat_id is None or chat_id == ANY_CHAT_CODE:
+        return
+
+    await max_manager.unsubscribe_from_chat(int(chat_id), group_id)
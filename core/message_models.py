@@ -1,13 +1,17 @@
-from typing import Literal, Optional
+from dataclasses import dataclass
+from typing import Any, ClassVar, Literal, Optional
 from pydantic import BaseModel
 
+from core.tracing import Trace
+
 
 class MessageModel(BaseModel):
     type: str
     user_id: int
 
 
-class Attach(BaseModel):
+@dataclass(frozen=True, slots=True)
+class Attach:
     base_url: str
     type: Literal["photo"] = "photo"
 
@@ -53,18 +57,59 @@ class SubscribeToChatMessage(MessageModel):
     chat_id: str
 
 
-class ChatMsgMessage(MessageModel):
-    """Base message model for any chat messages"""
+@dataclass(slots=True, kw_only=True)
+class ChatMsgMessage:
+    """
+    Chat message on the bridge hot path. Not a pydantic model: it's built and
+    checked once in `from_max()`, then passed as is through the queue, the outbox
+    and the worker pipes
+    """
+
+    type: ClassVar[str] = "new_chat_message"
 
-    type: Literal["new_chat_message"] = "new_chat_message"
+    user_id: int
     sender_id: int
     chat_id: int
     message_id: str
     timestamp: int
     sender_name: Optional[str] = None
     text: Optional[str] = None
-    attaches: Optional[list[Attach]] = None
+    attaches: tuple[Attach, ...] = ()
     replied_msg: Optional["ChatMsgMessage"] = None
+    # Only sampled messages are traced, see `core/tracing.py`
+    trace: Optional[Trace] = None
+    # Set once the message is in the outbox, see `core/outbox.py`
+    outbox_id: Optional[int] = None
+
+    @classmethod
+    def from_max(
+        cls,
+        data: dict[str, Any],
+        chat_id: int,
+        user_id: int,
+        attaches: tuple[Attach, ...] = (),
+        replied_msg: Optional["ChatMsgMessage"] = None,
+    ) -> "ChatMsgMessage":
+        """Build from raw MAX message data, ValueError if it's malformed"""
+
+        try:
+            text = data.get("text")
+
+            if text is not None and not isinstance(text, str):
+                raise TypeError(f"text is {type(text).__name__}")
+
+            return cls(
+                user_id=int(user_id),
+                sender_id=int(data["sender"]),
+                chat_id=int(chat_id),
+                message_id=str(data["id"]),
+                timestamp=int(data["time"]),
+                text=text,
+                attaches=attaches,
+                replied_msg=replied_msg,
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Malformed MAX message {data.get('id')}: {e!r}") from e
 
 
 class ErrorMessage(MessageModel):
@@ -0,0 +1,259 @@
+"""
+Bridge metrics in the Prometheus text format
+
+Counters and histograms are plain numbers updated in place, there are no locks,
+timers or background tasks. Everything that is already counted somewhere
+(queue sizes, frames per opcode, client states) is read by collectors only
+when the endpoint is scraped, so nobody scraping costs nothing.
+
+```
+SEND_SECONDS = get_metrics().histogram("max2tg_send_seconds", "...", ("method",))
+SEND_SECONDS.observe(0.12, "sendMessage")
+```
+
+With `metrics.enabled` the bridge serves them on http://`metrics.host`:`metrics.port`/metrics
+"""
+
+import inspect
+import logging
+
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Iterable, Optional, Union
+
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+
+@dataclass(slots=True)
+class Family:
+    """One metric with all its samples, as it is rendered"""
+
+    name: str
+    type: str
+    help: str
+    # (name suffix, labels, value)
+    samples: list[tuple[str, dict[str, str], float]] = field(default_factory=list)
+
+    def with_labels(self, **labels: str) -> "Family":
+        return Family(
+            self.name,
+            self.type,
+            self.help,
+            [(suffix, {**labels, **own}, value) for suffix, own, value in self.samples],
+        )
+
+
+Collector = Callable[[], Union[Iterable[Family], Awaitable[Iterable[Family]]]]
+
+
+class Counter:
+    __slots__ = ("name", "help", "labelnames", "_values")
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+        # label values -> value
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self) -> Family:
+        return Family(
+            self.name,
+            "counter",
+            self.help,
+            [
+                ("", dict(zip(self.labelnames, labels)), value)
+                for labels, value in self._values.items()
+            ],
+        )
+
+
+class Histogram:
+    __slots__ = ("name", "help", "labelnames", "buckets", "_series")
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+
+        # label values -> [count per bucket (last is +Inf), sum]
+        self._series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def collect(self) -> Family:
+        metric = Family(self.name, "histogram", self.help)
+
+        for labels, (counts, total) in self._series.items():
+            base = dict(zip(self.labelnames, labels))
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                metric.samples.append(("_bucket", {**base, "le": str(bound)}, cumulative))
+
+            metric.samples.append(("_sum", base, total))
+            metric.samples.append(("_count", base, cumulative))
+
+        return metric
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: dict[str, Union[Counter, Histogram]] = {}
+        self._collectors: list[Collector] = []
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector: Collector) -> None:
+        """Called on every scrape, may be async"""
+
+        self._collectors.append(collector)
+
+    def remove_collector(self, collector: Collector) -> None:
+        if collector in self._collectors:
+            self._collectors.remove(collector)
+
+    async def collect(self) -> list[Family]:
+        families = [metric.collect() for metric in self._metrics.values()]
+
+        for collector in self._collectors:
+            try:
+                result = collector()
+
+                if inspect.isawaitable(result):
+                    result = await result
+
+                families.extend(result)
+            except Exception as e:
+                logger.error("Metrics collector %s failed: %s", collector, e)
+
+        return families
+
+    async def render(self) -> str:
+        # Families with the same name (e.g. from worker processes) are rendered together
+        merged: dict[str, Family] = {}
+
+        for metric in await self.collect():
+            existing = merged.get(metric.name)
+
+            if existing is None:
+                merged[metric.name] = Family(
+                    metric.name, metric.type, metric.help, list(metric.samples)
+                )
+            else:
+                existing.samples.extend(metric.samples)
+
+        lines = []
+
+        for metric in merged.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+
+            for suffix, labels, value in metric.samples:
+                lines.append(f"{metric.name}{suffix}{_labels(labels)} {_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: Any) -> Any:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+
+        self._metrics[metric.name] = metric
+        return metric
+
+
+def family(
+    name: str,
+    help: str,
+    values: dict[tuple[tuple[str, str], ...], float],
+    type: str = "gauge",
+) -> Family:
+    """Build a metric for a collector from {(("label", "value"), ...): value}"""
+
+    return Family(name, type, help, [("", dict(labels), v) for labels, v in values.items()])
+
+
+def _labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    pairs = ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items())
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _value(value: float) -> str:
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """Serve GET /metrics. Stop with `await runner.cleanup()`"""
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(
+            body=(await get_metrics().render()).encode(),
+            headers={"Content-Type": CONTENT_TYPE},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    logger.info("📈 Metrics are served on http://%s:%s/metrics", host, port)
+
+    return runner
+
+
+_metrics: Optional[MetricsRegistry] = None
+
+
+def get_metrics() -> MetricsRegistry:
+    global _metrics
+
+    if _metrics is None:
+        _metrics = MetricsRegistry()
+
+    return _metrics
@@ -0,0 +1,371 @@
+"""
+Durable outbox of bridged chat messages
+
+Every chat message received from MAX is written to a SQLite table before it goes
+to the bot queue, and marked delivered by its ID once all its Telegram sends are done.
+Whatever is not marked delivered is put into the bot queue again on the next start,
+so a restart or a crash doesn't lose queued forwards (a message may be sent twice).
+
+A message some group didn't get after every retry is moved to `outbox_failed`
+instead. It isn't replayed, a group the bot can't send to would fail on every start.
+
+Writes are group-committed: messages and acks collected during `flush_interval`
+(or up to `batch_size` of them) are written in one transaction, in a thread.
+The database is in WAL mode with `synchronous=NORMAL`, so a commit doesn't fsync:
+committed messages survive a crash of the bridge, not a power loss before a checkpoint.
+
+High-water marks of forwarded messages (`core/high_water.py`) are saved in the same
+commits and loaded on start, so catch-up works after a restart too.
+"""
+
+import asyncio
+import logging
+import pickle
+import sqlite3
+import time
+
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Optional
+
+from core.high_water import Position, get_high_water_marks
+from core.message_models import ChatMsgMessage
+from core.metrics import family, get_metrics
+
+from config import config
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    delivered_at REAL,
+    payload BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_undelivered ON outbox (id) WHERE delivered_at IS NULL;
+CREATE TABLE IF NOT EXISTS outbox_failed (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    failed_at REAL NOT NULL,
+    payload BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS high_water (
+    owner_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (owner_id, chat_id)
+);
+"""
+
+# Delivered rows are kept for a while, deleted at most once per this many seconds
+PRUNE_INTERVAL = 60
+
+OUTBOX_EVENTS = get_metrics().counter(
+    "max2tg_outbox_total",
+    "Outbox events: appended, committed, acked, failed, replayed",
+    ("event",),
+)
+COMMIT_SECONDS = get_metrics().histogram(
+    "max2tg_outbox_commit_seconds",
+    "Time of one group commit",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25),
+)
+
+
+class Outbox:
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 500,
+        flush_interval: float = 0.02,
+        retention: float = 3600,
+    ):
+        self.path = Path(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention = retention
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._sink: Optional[Callable[[Any], Awaitable[None]]] = None
+        self._ids = 0
+
+        # Waiting for the next commit
+        self._batch: list[ChatMsgMessage] = []
+        self._acks: list[int] = []
+        self._failed: list[int] = []
+        self._wake = asyncio.Event()
+
+        self._writer: Optional[asyncio.Task] = None
+        # The commit running in a thread, it isn't interrupted by cancelling the writer
+        self._writing: Optional[asyncio.Future] = None
+        self._replay: Optional[asyncio.Task] = None
+        self._pruned_at = 0.0
+
+        # Appended and not acked yet, this run
+        self.unacked = 0
+
+    async def start(self, sink: Callable[[Any], Awaitable[None]]) -> None:
+        """
+        Open the database and start writing. Committed messages are passed to `sink`,
+        messages left undelivered by the previous run are passed to it first
+        """
+
+        self._sink = sink
+
+        await asyncio.to_thread(self._open)
+
+        get_high_water_marks().load(await asyncio.to_thread(self._load_marks))
+        undelivered = await asyncio.to_thread(self._load_undelivered)
+
+        self._writer = asyncio.create_task(self._run())
+        self._writer.add_done_callback(self._writer_done)
+
+        if undelivered:
+            logger.info("📮 Replaying %s undelivered messages from the outbox", len(undelivered))
+            self._replay = asyncio.create_task(self._replay_messages(undelivered))
+
+    def append(self, msg: ChatMsgMessage) -> None:
+        """Queue the message for the next commit, it goes to the sink after that"""
+
+        self._ids += 1
+        msg.outbox_id = self._ids
+
+        self._batch.append(msg)
+        self.unacked += 1
+        OUTBOX_EVENTS.inc("appended")
+
+        self._wake.set()
+
+    def ack(self, outbox_id: int) -> None:
+        """The message is delivered, it won't be replayed"""
+
+        self._acks.append(outbox_id)
+        self.unacked -= 1
+        OUTBOX_EVENTS.inc("acked")
+
+        self._wake.set()
+
+    def fail(self, outbox_id: int) -> None:
+        """Not every group got the message, it's dead-lettered and won't be replayed"""
+
+        self._failed.append(outbox_id)
+        self.unacked -= 1
+        OUTBOX_EVENTS.inc("failed")
+
+        logger.error(
+            "📮 Message %s wasn't delivered to every group, moved to outbox_failed", outbox_id
+        )
+
+        self._wake.set()
+
+    async def close(self) -> None:
+        """Write what is left and close the database"""
+
+        for task in (self._replay, self._writer):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        if self._writing is not None:
+            await asyncio.gather(self._writing, return_exceptions=True)
+
+        if self._db is None:
+            return
+
+        # Messages of the last batch never reached the queue, they are replayed on the next start
+        marks = get_high_water_marks().pop_dirty()
+
+        if self._batch or self._acks or self._failed or marks:
+            await asyncio.to_thread(
+                self._write, self._batch, self._acks, marks, self._failed
+            )
+
+        await asyncio.to_thread(self._db.close)
+        self._db = None
+
+    async def _run(self) -> None:
+        while True:
+            await self._wake.wait()
+
+            # Let the batch grow for a moment, one commit covers all of it
+            if len(self._batch) < self.batch_size:
+                await asyncio.sleep(self.flush_interval)
+
+            self._wake.clear()
+
+            batch, self._batch = self._batch, []
+            acks, self._acks = self._acks, []
+            failed, self._failed = self._failed, []
+            marks = get_high_water_marks().pop_dirty()
+
+            self._writing = asyncio.ensure_future(
+                asyncio.to_thread(self._write, batch, acks, marks, failed)
+            )
+
+            try:
+                await asyncio.shield(self._writing)
+            except Exception as e:
+                # Still forwarded, only without the guarantee
+                logger.error("Failed to write %s messages to the outbox: %s", len(batch), e)
+
+            for msg in batch:
+                try:
+                    await self._sink(msg)
+                except Exception as e:
+                    logger.error("Failed to queue outbox message %s: %s", msg.outbox_id, e)
+
+    def _writer_done(self, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+
+        # Nothing is committed or forwarded after this until a restart
+        logger.critical("📮 Outbox writer stopped: %r", task.exception())
+
+    async def _replay_messages(self, messages: list[ChatMsgMessage]) -> None:
+        for msg in messages:
+            await self._sink(msg)
+            OUTBOX_EVENTS.inc("replayed")
+
+    # [==================== IN A THREAD ====================]
+
+    def _open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        # Only one thread at a time uses the connection: the writer, or `close()` after it
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+        # Dead letters keep their IDs, new messages don't reuse them
+        self._ids = self._db.execute(
+            "SELECT MAX(COALESCE((SELECT MAX(id) FROM outbox), 0), "
+            "COALESCE((SELECT MAX(id) FROM outbox_failed), 0))"
+        ).fetchone()[0]
+
+    def _load_marks(self) -> dict[tuple[int, int], Position]:
+        rows = self._db.execute(
+            "SELECT owner_id, chat_id, time, message_id FROM high_water"
+        ).fetchall()
+
+        return {
+            (owner, chat): (time_ms, message_id)
+            for owner, chat, time_ms, message_id in rows
+        }
+
+    def _load_undelivered(self) -> list[ChatMsgMessage]:
+        rows = self._db.execute(
+            "SELECT id, payload FROM outbox WHERE delivered_at IS NULL ORDER BY id"
+        ).fetchall()
+
+        messages = []
+
+        for outbox_id, payload in rows:
+            try:
+                msg = pickle.loads(payload)
+            except Exception as e:
+                logger.error("Broken outbox message %s dropped: %s", outbox_id, e)
+                continue
+
+            msg.outbox_id = outbox_id
+            # Timings of the previous run mean nothing now
+            msg.trace = None
+            messages.append(msg)
+
+        self.unacked += len(messages)
+
+        return messages
+
+    def _write(
+        self,
+        batch: list[ChatMsgMessage],
+        acks: list[int],
+        marks: list[tuple[int, int, Position]] = (),
+        failed: list[int] = (),
+    ) -> None:
+        started_at = time.perf_counter()
+        now = time.time()
+
+        with self._db:
+            if batch:
+                self._db.executemany(
+                    "INSERT INTO outbox (id, created_at, payload) VALUES (?, ?, ?)",
+                    [
+                        (msg.outbox_id, now, pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+                        for msg in batch
+                    ],
+                )
+
+            if acks:
+                self._db.executemany(
+                    "UPDATE outbox SET delivered_at = ? WHERE id = ?",
+                    [(now, outbox_id) for outbox_id in acks],
+                )
+
+            if failed:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO outbox_failed (id, created_at, failed_at, payload) "
+                    "SELECT id, created_at, ?, payload FROM outbox WHERE id = ?",
+                    [(now, outbox_id) for outbox_id in failed],
+                )
+                self._db.executemany(
+                    "DELETE FROM outbox WHERE id = ?", [(outbox_id,) for outbox_id in failed]
+                )
+
+            if marks:
+                self._db.executemany(
+                    "INSERT INTO high_water (owner_id, chat_id, time, message_id) "
+                    "VALUES (?, ?, ?, ?) ON CONFLICT (owner_id, chat_id) "
+                    "DO UPDATE SET time = excluded.time, message_id = excluded.message_id",
+                    [
+                        (owner, chat, time_ms, message_id)
+                        for owner, chat, (time_ms, message_id) in marks
+                    ],
+                )
+
+            if now - self._pruned_at > PRUNE_INTERVAL:
+                self._pruned_at = now
+                self._db.execute(
+                    "DELETE FROM outbox WHERE delivered_at < ?", (now - self.retention,)
+                )
+                self._db.execute(
+                    "DELETE FROM outbox_failed WHERE failed_at < ?", (now - self.retention,)
+                )
+
+        COMMIT_SECONDS.observe(time.perf_counter() - started_at)
+        OUTBOX_EVENTS.inc("committed", amount=len(batch))
+
+
+_outbox: Optional[Outbox] = None
+
+
+def get_outbox() -> Outbox:
+    global _outbox
+
+    if _outbox is None:
+        _outbox = Outbox(
+            path=config.outbox.path,
+            batch_size=config.outbox.batch_size,
+            flush_interval=config.outbox.flush_interval,
+            retention=config.outbox.retention,
+        )
+
+    return _outbox
+
+
+def _collect_outbox():
+    if _outbox is None:
+        return []
+
+    return [
+        family(
+            "max2tg_outbox_unacked",
+            "Messages in the outbox not delivered yet",
+            {(): _outbox.unacked},
+        )
+    ]
+
+
+get_metrics().add_collector(_collect_outbox)
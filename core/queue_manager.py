@@ -1,5 +1,52 @@
 import asyncio
 
+from typing import TYPE_CHECKING, Any, Callable, Optional
+
+from core.backpressure import Backpressure
+from core.message_models import ChatMsgMessage
+from core.metrics import family, get_metrics
+
+from config import config
+
+if TYPE_CHECKING:
+    from core.outbox import Outbox
+
+
+class MonitoredQueue(asyncio.Queue):
+    """Remembers the deepest it has ever been. Queued items can be dropped or replaced"""
+
+    def __init__(self, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.high_water = 0
+
+    def _put(self, item):
+        super()._put(item)
+
+        if len(self._queue) > self.high_water:
+            self.high_water = len(self._queue)
+
+    def evict(self, predicate: Callable[[Any], bool]) -> Optional[Any]:
+        """Remove the oldest item matching the predicate, None if there is none"""
+
+        for index, item in enumerate(self._queue):
+            if predicate(item):
+                del self._queue[index]
+                # The item will never be processed
+                self.task_done()
+                return item
+
+        return None
+
+    def replace(self, predicate: Callable[[Any], bool], new_item: Any) -> Optional[Any]:
+        """Put the item in place of the oldest one matching the predicate, returns that one"""
+
+        for index, item in enumerate(self._queue):
+            if predicate(item):
+                self._queue[index] = new_item
+                return item
+
+        return None
+
 
 class QueueManager:
     """
@@ -8,8 +55,47 @@ class QueueManager:
     """
 
     def __init__(self):
-        self.to_bot: asyncio.Queue = asyncio.Queue(maxsize=1000)
-        self.to_ws: asyncio.Queue = asyncio.Queue(maxsize=1000)
+        self.to_bot: MonitoredQueue = MonitoredQueue(maxsize=config.queues.to_bot_size)
+        self.to_ws: MonitoredQueue = MonitoredQueue(maxsize=1000)
+
+        # Producers of `to_bot` are MAX receive loops, they must not block on a full queue
+        self.to_bot_backpressure = Backpressure(
+            self.to_bot,
+            policies=config.queues.policies,
+            block_timeout=config.queues.block_timeout,
+            spill_file=config.queues.spill_file,
+            on_dropped=self._dropped,
+        )
+
+        # Chat messages go through it when it's started, see `core/outbox.py`
+        self.outbox: Optional["Outbox"] = None
+
+        # In a MAX worker: depth of the main process' `to_bot`, reported over the pipe
+        self.remote_to_bot_depth: Optional[int] = None
+
+    def to_bot_depth(self) -> int:
+        """Items waiting for the bot, the ones a MAX worker didn't forward yet included"""
+
+        if self.remote_to_bot_depth is None:
+            return self.to_bot.qsize()
+
+        return self.remote_to_bot_depth + self.to_bot.qsize()
+
+    async def put_to_bot(self, item: Any) -> None:
+        """Put into `to_bot`, a full queue is handled by the overflow policy of the item"""
+
+        # The outbox puts it into the queue once it's written
+        if self.outbox is not None and isinstance(item, ChatMsgMessage):
+            self.outbox.append(item)
+            return
+
+        await self.to_bot_backpressure.put(item)
+
+    def _dropped(self, item: Any) -> None:
+        """Dropped by an overflow policy on purpose, it isn't replayed from the outbox"""
+
+        if self.outbox is not None and getattr(item, "outbox_id", None) is not None:
+            self.outbox.ack(item.outbox_id)
 
 
 _queue_manager = None
@@ -22,3 +108,26 @@ def get_queue_manager() -> QueueManager:
         _queue_manager = QueueManager()
 
     return _queue_manager
+
+
+def _collect_queues():
+    if _queue_manager is None:
+        return []
+
+    queues = {"to_bot": _queue_manager.to_bot, "to_ws": _queue_manager.to_ws}
+
+    return [
+        family(
+            "max2tg_queue_depth",
+            "Items waiting in the queue",
+            {(("queue", name),): q.qsize() for name, q in queues.items()},
+        ),
+        family(
+            "max2tg_queue_high_water",
+            "Deepest the queue has been since the start",
+            {(("queue", name),): q.high_water for name, q in queues.items()},
+        ),
+    ]
+
+
+get_metrics().add_collector(_collect_queues)
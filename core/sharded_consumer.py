@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import time
+
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShardStats:
+    """Queue wait and processing time of one shard, in seconds"""
+
+    __slots__ = (
+        "processed",
+        "queue_wait_total",
+        "queue_wait_max",
+        "processing_total",
+        "processing_max",
+    )
+
+    def __init__(self):
+        self.processed = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.processing_total = 0.0
+        self.processing_max = 0.0
+
+    def add(self, queue_wait: float, processing: float) -> None:
+        self.processed += 1
+        self.queue_wait_total += queue_wait
+        self.processing_total += processing
+
+        if queue_wait > self.queue_wait_max:
+            self.queue_wait_max = queue_wait
+        if processing > self.processing_max:
+            self.processing_max = processing
+
+    def as_dict(self) -> dict[str, float]:
+        processed = self.processed or 1
+
+        return {
+            "processed": self.processed,
+            "queue_wait_avg": self.queue_wait_total / processed,
+            "queue_wait_max": self.queue_wait_max,
+            "processing_avg": self.processing_total / processed,
+            "processing_max": self.processing_max,
+        }
+
+
+class ShardedConsumer:
+    """
+    Drains a queue with several workers.
+
+    Items with the same shard key (MAX chat, or the account for non-chat messages)
+    always go to the same worker, so they are processed in order,
+    while items of different chats are processed in parallel.
+
+    The dispatcher never waits for one shard: items of a shard with a full queue
+    are parked in its overflow and moved into the queue as the worker frees it.
+    It waits only when `shard_queue_size * workers` items are parked in total,
+    so the source queue and its overflow policies still limit the memory.
+
+    An item is marked done in the source queue once its handler returns, so
+    `source.join()` waits for the items in the shards and their overflows too
+    """
+
+    def __init__(
+        self,
+        source: asyncio.Queue,
+        handler: Callable[[Any], Awaitable[None]],
+        workers: int,
+        shard_queue_size: int = 100,
+        stats_interval: float = 0,
+        name: str = "consumer",
+    ):
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+
+        self.source = source
+        self.handler = handler
+        self.name = name
+        self.stats_interval = stats_interval
+
+        self.shards: list[asyncio.Queue] = [
+            asyncio.Queue(maxsize=shard_queue_size) for _ in range(workers)
+        ]
+        # Items that didn't fit into the shard queue, in order
+        self.overflows: list[deque] = [deque() for _ in range(workers)]
+        self.stats: list[ShardStats] = [ShardStats() for _ in range(workers)]
+
+        self.max_parked = shard_queue_size * workers
+        self.parked = 0
+        self._unparked = asyncio.Event()
+
+    @staticmethod
+    def shard_key(item: Any) -> Optional[int]:
+        """Chat ID for chat messages, account (user ID) for lists and everything else"""
+
+        if isinstance(item, list):
+            return getattr(item[0], "user_id", None) if item else None
+
+        chat_id = getattr(item, "chat_id", None)
+
+        if chat_id is not None:
+            return chat_id
+
+        return getattr(item, "user_id", None)
+
+    def shard_of(self, item: Any) -> int:
+        key = self.shard_key(item)
+
+        if key is None:
+            return 0
+
+        return hash(key) % len(self.shards)
+
+    async def run(self) -> None:
+        """Dispatch items to the shards until cancelled"""
+
+        workers = [
+            asyncio.create_task(self._work(index)) for index in range(len(self.shards))
+        ]
+
+        if self.stats_interval > 0:
+            workers.append(asyncio.create_task(self._log_stats(self.stats_interval)))
+
+        try:
+            while True:
+                item = await self.source.get()
+                # Queue wait is counted from here, parking included
+                entry = (time.monotonic(), item)
+
+                try:
+                    await self._dispatch(self.shard_of(item), entry)
+                except BaseException:
+                    # Never reached a shard, nobody else marks it done
+                    self.source.task_done()
+                    raise
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _dispatch(self, index: int, entry: tuple[float, Any]) -> None:
+        shard = self.shards[index]
+        overflow = self.overflows[index]
+
+        while True:
+            # Once something is parked, newer items are parked after it to keep the order
+            if not overflow and not shard.full():
+                shard.put_nowait(entry)
+                return
+
+            if self.parked < self.max_parked:
+                break
+
+            self._unparked.clear()
+            await self._unparked.wait()
+
+        overflow.append(entry)
+        self.parked += 1
+
+    def _unpark(self, index: int) -> None:
+        overflow = self.overflows[index]
+        shard = self.shards[index]
+
+        while overflow and not shard.full():
+            shard.put_nowait(overflow.popleft())
+            self.parked -= 1
+            self._unparked.set()
+
+    async def _log_stats(self, interval: float) -> None:
+        """Log per-shard stats every `interval` seconds"""
+
+        while True:
+            await asyncio.sleep(interval)
+
+            for index, stats in enumerate(self.stats):
+                if not stats.processed:
+                    continue
+
+                s = stats.as_dict()
+
+                logger.info(
+                    "[%s] shard %s | depth %s | parked %s | processed %s | "
+                    "wait avg %.3fs max %.3fs | processing avg %.3fs max %.3fs",
+                    self.name,
+                    index,
+                    self.shards[index].qsize(),
+                    len(self.overflows[index]),
+                    s["processed"],
+                    s["queue_wait_avg"],
+                    s["queue_wait_max"],
+                    s["processing_avg"],
+                    s["processing_max"],
+                )
+
+    async def _work(self, index: int) -> None:
+        shard = self.shards[index]
+        stats = self.stats[index]
+
+        while True:
+            queued_at, item = await shard.get()
+            started_at = time.monotonic()
+
+            self._unpark(index)
+
+            try:
+                await self.handler(item)
+            except Exception as e:
+                logger.error("[%s] Handling error: %s. Message: %s", self.name, e, item)
+            finally:
+                stats.add(started_at - queued_at, time.monotonic() - started_at)
+                shard.task_done()
+                self.source.task_done()
@@ -0,0 +1,196 @@
+"""
+Stage tracing of bridged messages
+
+A sampled share (`tracing.sample_rate`) of the received chat messages carries a `Trace`.
+Every stage the message goes through adds its duration, in ms:
+
+- server:  MAX server timestamp → read from the socket (includes the clock skew)
+- decode:  decoding the frame
+- handler: building the message in `process_opcode128`
+- queue:   the outbox commit and waiting in `to_bot` until a bridge worker takes it
+- routing: routing lookup and dedup
+- render:  building the send plan
+- send:    every Telegram send, one per group
+- total:   read from the socket → the last send is done
+
+Finished traces are appended as JSON lines to a rotating file (`tracing.file`),
+a trace with a failed send is not written. `summarize()` reads them back
+for the admin command.
+"""
+
+import json
+import logging
+import random
+import statistics
+import time
+
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Optional
+
+from config import config
+
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("server", "decode", "handler", "queue", "routing", "render", "send", "total")
+PERCENTILES = (50, 95, 99)
+
+
+class Trace:
+    __slots__ = (
+        "chat_id",
+        "message_id",
+        "received_at",
+        "enqueued_at",
+        "stages",
+        "sends",
+        "pending",
+    )
+
+    def __init__(self, received_at: float, decode: float):
+        self.chat_id: Optional[int] = None
+        self.message_id: Optional[str] = None
+        # Wall clock, the trace may pass between processes
+        self.received_at = received_at
+        self.enqueued_at = 0.0
+
+        self.stages: dict[str, float] = {"decode": decode * 1000}
+        self.sends: list[float] = []
+        # Telegram sends not done yet
+        self.pending = 0
+
+    def mark(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = seconds * 1000
+
+    def as_dict(self) -> dict:
+        return {
+            "t": round(time.time(), 3),
+            "chat": self.chat_id,
+            "msg": self.message_id,
+            "stages": {k: round(v, 3) for k, v in self.stages.items()},
+            "send": [round(v, 3) for v in self.sends],
+        }
+
+
+class Tracer:
+    def __init__(
+        self,
+        sample_rate: float,
+        path: str,
+        max_bytes: int = 10_000_000,
+        backup_count: int = 3,
+    ):
+        self.sample_rate = sample_rate
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        # Created on the first trace, no file if nothing is traced
+        self._writer: Optional[logging.Logger] = None
+
+    def start(self, received_at: float, decode: float) -> Optional[Trace]:
+        """A new trace, or None if the message isn't sampled"""
+
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+
+        return Trace(received_at, decode)
+
+    def expect_sends(self, trace: Trace, count: int) -> None:
+        trace.pending = count
+
+        if count == 0:
+            self.finish(trace)
+
+    def send_done(self, trace: Trace, seconds: float) -> None:
+        trace.sends.append(seconds * 1000)
+        trace.pending -= 1
+
+        if trace.pending == 0:
+            self.finish(trace)
+
+    def finish(self, trace: Trace) -> None:
+        trace.mark("total", time.time() - trace.received_at)
+
+        try:
+            self._get_writer().info(json.dumps(trace.as_dict(), separators=(",", ":")))
+        except OSError as e:
+            logger.error("Failed to write a trace: %s", e)
+
+    def summarize(self, window: float) -> dict[str, tuple[int, tuple[float, ...]]]:
+        """Stage → (count, (p50, p95, p99)) over the traces of the last `window` seconds"""
+
+        since = time.time() - window
+        values: dict[str, list[float]] = {stage: [] for stage in STAGES}
+
+        # Oldest backup first
+        files = [Path(f"{self.path}.{n}") for n in range(self.backup_count, 0, -1)]
+        files.append(self.path)
+
+        for file in files:
+            if not file.exists():
+                continue
+
+            with file.open(encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        trace = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if trace.get("t", 0) < since:
+                        continue
+
+                    for stage, value in trace.get("stages", {}).items():
+                        values.setdefault(stage, []).append(value)
+
+                    values["send"].extend(trace.get("send", []))
+
+        return {
+            stage: (len(v), _percentiles(v)) for stage, v in values.items() if v
+        }
+
+    def _get_writer(self) -> logging.Logger:
+        if self._writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            handler = RotatingFileHandler(
+                self.path,
+                maxBytes=self.max_bytes,
+                backupCount=self.backup_count,
+                encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+
+            self._writer = logging.getLogger(f"{__name__}.file")
+            self._writer.setLevel(logging.INFO)
+            self._writer.propagate = False
+            self._writer.addHandler(handler)
+
+        return self._writer
+
+
+def _percentiles(values: list[float]) -> tuple[float, ...]:
+    if len(values) < 2:
+        return tuple(values[0] for _ in PERCENTILES)
+
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return tuple(cuts[p - 1] for p in PERCENTILES)
+
+
+_tracer: Optional[Tracer] = None
+
+
+def get_tracer() -> Tracer:
+    global _tracer
+
+    if _tracer is None:
+        _tracer = Tracer(
+            sample_rate=config.tracing.sample_rate,
+            path=config.tracing.file,
+            max_bytes=config.tracing.max_bytes,
+            backup_count=config.tracing.backup_count,
+        )
+
+    return _tracer
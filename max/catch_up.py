@@ -0,0 +1,157 @@
+"""
+Catching up on messages missed while the connection was down
+
+After a reconnect the client requests the history (opcode 49) of every chat
+that has a high-water mark, going backwards page by page until the mark is reached.
+Messages above the mark that were sent before the reconnect are forwarded
+oldest first. Newer ones already came over the live connection.
+
+Catch-up is paced by a token bucket shared by all accounts and waits while
+the bot queue is busy, so live messages are never held behind a backlog.
+In a MAX worker that is the queue of the main process, its depth is reported
+over the pipe (`core/queue_manager.py`).
+"""
+
+import asyncio
+import logging
+
+from typing import Any, Optional
+
+from core.high_water import Position, message_position
+from core.message_models import ChatMsgMessage
+from core.queue_manager import get_queue_manager
+
+from .utils.process_opcodes import add_message_to_queue, parse_chat_message
+from .utils.rate_limit import TokenBucket
+
+from config import config
+
+
+logger = logging.getLogger(__name__)
+
+# How often to check if the bot queue has room again, in seconds
+_QUEUE_POLL_INTERVAL = 0.1
+
+
+class CatchUp:
+    """Missed messages of one chat, between the high-water mark and the reconnect"""
+
+    def __init__(
+        self,
+        owner_id: int,
+        chat_id: int,
+        since: Position,
+        until: int,
+        page_size: int = None,
+        max_messages: int = None,
+    ):
+        self.owner_id = owner_id
+        self.chat_id = chat_id
+        self.since = since
+        self.until = until
+        self.page_size = page_size or config.max.catch_up_page_size
+        self.max_messages = max_messages or config.max.catch_up_max_messages
+
+        # Pages may overlap on the boundary, messages are kept by ID
+        self.messages: dict[str, ChatMsgMessage] = {}
+        self._next_from = until
+
+    async def add_page(self, raw_messages: list[dict[str, Any]]) -> Optional[int]:
+        """
+        Keep the missed messages of a history page.
+        Returns the timestamp to request the next page from, or None if the gap is covered
+        """
+
+        oldest = None
+
+        for data in raw_messages:
+            timestamp = data.get("time")
+
+            if timestamp is None:
+                continue
+
+            if oldest is None or timestamp < oldest:
+                oldest = timestamp
+
+            position = message_position(timestamp, data.get("id"))
+
+            if position <= self.since or timestamp > self.until:
+                continue
+
+            try:
+                msg = await parse_chat_message(data, self.chat_id, self.owner_id)
+            except Exception as e:
+                logger.warning(
+                    "%s -- Skipped a broken missed message in chat %s: %s",
+                    self.owner_id,
+                    self.chat_id,
+                    e,
+                )
+                continue
+
+            self.messages[msg.message_id] = msg
+
+        # Short page, the mark is reached, or no progress: nothing more to fetch
+        if (
+            oldest is None
+            or len(raw_messages) < self.page_size
+            or oldest <= self.since[0]
+            or oldest >= self._next_from
+        ):
+            return None
+
+        if len(self.messages) >= self.max_messages:
+            logger.warning(
+                "%s -- Chat %s missed more than %s messages, the older ones are skipped",
+                self.owner_id,
+                self.chat_id,
+                self.max_messages,
+            )
+            return None
+
+        self._next_from = oldest
+        return oldest
+
+    async def forward(self) -> None:
+        """Send the missed messages to the bot, oldest first, without crowding out live ones"""
+
+        messages = sorted(
+            self.messages.values(),
+            key=lambda m: message_position(m.timestamp, m.message_id),
+        )
+
+        if not messages:
+            return
+
+        logger.info(
+            "%s -- 📥 Catching up on %s missed message(s) in chat %s",
+            self.owner_id,
+            len(messages),
+            self.chat_id,
+        )
+
+        queue_manager = get_queue_manager()
+        limit = queue_manager.to_bot.maxsize * config.max.catch_up_queue_share
+        limiter = get_catch_up_limiter()
+
+        for msg in messages:
+            await limiter.acquire()
+
+            while limit and queue_manager.to_bot_depth() >= limit:
+                await asyncio.sleep(_QUEUE_POLL_INTERVAL)
+
+            await add_message_to_queue(msg)
+
+
+_catch_up_limiter: Optional[TokenBucket] = None
+
+
+def get_catch_up_limiter() -> TokenBucket:
+    """Global limit of caught up messages per second, shared by all clients"""
+
+    global _catch_up_limiter
+
+    if _catch_up_limiter is None:
+        _catch_up_limiter = TokenBucket(rate=config.max.catch_up_rate)
+
+    return _catch_up_limiter
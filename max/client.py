@@ -6,14 +6,19 @@ import asyncio
 import logging
 import websockets
 import itertools
-import json
+import time
 
-from typing import Any, Callable, Optional
+from typing import Any, Awaitable, Callable, Optional
 
 from functools import wraps
 
+from core.high_water import get_high_water_marks
+from core.metrics import get_metrics
+from core.tracing import get_tracer
 from core.message_models import (
+    ChatMsgMessage,
     ErrorMessage,
+    FetchChatsMessage,
 )
 
 from .templates.payloads import (
@@ -27,14 +32,23 @@ from .templates.payloads import (
     get_check_code_json,
 )
 
-from .utils.date import get_unix_now
+from .catch_up import CatchUp
+from .reconnect import ReconnectSupervisor
+from .utils.date import get_unix_now, get_unix_now_ms
+from .utils.json_codec import get_codec
+from .utils.opcode_registry import OpcodeRegistry, get_opcode_registry
+from .utils.pending_requests import MaxRequestError, PendingRequests
+from .utils.timer_wheel import Timer, get_timer_wheel
 from .utils.process_opcodes import (
+    add_message_to_queue,
+    parse_opcode17,
+    parse_opcode18,
+    parse_opcode19,
+    parse_opcode49,
     process_opcode128,
     process_opcode17,
     process_opcode18,
     process_opcode19,
-    process_opcode49,
-    process_opcode64,
 )
 
 from config import config
@@ -42,7 +56,15 @@ from config import config
 
 logger = logging.getLogger(__name__)
 
-PING_OPCODE = 1
+# Pings are driven by the shared timer wheel, in seconds
+PING_INTERVAL = 30
+SUBSCRIPTION_PING_INTERVAL = 60
+
+DECODE_SECONDS = get_metrics().histogram(
+    "max2tg_max_decode_seconds",
+    "Time to decode a MAX frame",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01),
+)
 
 
 def ensure_connected(method: Callable):
@@ -61,6 +83,7 @@ class MaxClient:
         tg_user_id: int,
         token: str = None,
         proxy: str | bool = True,
+        registry: OpcodeRegistry = None,
     ):
         self.websocket: Optional[websockets.ClientConnection] = None
         self.token = token
@@ -70,10 +93,44 @@ class MaxClient:
         self._ws_url = config.ws.url
         self._seq = 0
         self._counter = itertools.count(0, 1)
-        self._current_listening_chat: Optional[str] = None
-        self._ping_task: Optional[asyncio.Task] = None
-        self._chat_subscription_ping_task: Optional[asyncio.Task] = None
+        # Chats to stay subscribed to, kept over reconnects
+        self._subscriptions: set[int] = set()
+        self._ping_timer: Optional[Timer] = None
+        self._chat_subscription_ping_timer: Optional[Timer] = None
         self._recv_task: Optional[asyncio.Task] = None
+        self._codec = get_codec()
+        self._registry = registry or get_opcode_registry()
+
+        # When the frame being handled was read and how long it took to decode, for tracing
+        self.frame_received_at = 0.0
+        self.frame_decode_time = 0.0
+
+        # Restores the session when the connection drops
+        self._reconnect = ReconnectSupervisor(self)
+
+        # Replies awaited by the caller, matched by seq
+        self._pending = PendingRequests(timeout=config.max.request_timeout)
+        self._catch_up_tasks: set[asyncio.Task] = set()
+
+        # Called right after the connection dropped, before reconnecting
+        self.on_connection_lost: Optional[Callable[["MaxClient"], None]] = None
+
+    @property
+    def reconnecting(self) -> bool:
+        return self._reconnect.running
+
+    @property
+    def connected(self) -> bool:
+        return self.websocket is not None
+
+    @property
+    def listening_chats(self) -> frozenset[int]:
+        return frozenset(self._subscriptions)
+
+    def hand_over(self, chat_id: int):
+        """Don't subscribe to the chat again after a reconnect, another account took it"""
+
+        self._subscriptions.discard(chat_id)
 
     async def connect(self, auth_with_token: bool = False):
         """
@@ -104,73 +161,161 @@ class MaxClient:
             else:
                 # if token is not provided, we need to get it first
                 logger.info("🔑 No token provided, getting it...")
-                await self.websocket.send(get_useragent_header_json())
+                await self._send(get_useragent_header_json())
                 self._get_next_seq()
 
             logger.info("%s -- ✅ Connected to MAX WebSocket", self.user_tg_id)
 
             self._recv_task = asyncio.create_task(self._receive_message_from_ws())
-            self._ping_task = asyncio.create_task(self._send_ping())
+            self._ping_timer = get_timer_wheel().every(PING_INTERVAL, self._send_ping)
 
         except Exception as e:
             logger.error(
                 "%s -- ❌ Failed to connect to MAX WebSocket: %s", self.user_tg_id, e
             )
+
+            # Don't keep a half-open connection, so connect() can be called again
+            self.abort()
             raise
 
     async def disconnect(self):
         """Disconnect from the MAX WebSocket server"""
 
+        self._reconnect.cancel()
+        self._subscriptions.clear()
+
         if self.websocket:
-            await self.websocket.close()
-            if self._recv_task:
-                self._recv_task.cancel()
-            if self._ping_task:
-                self._ping_task.cancel()
-            if self._chat_subscription_ping_task:
-                self._chat_subscription_ping_task.cancel()
-                self.stop_listening_to_chat(self._current_listening_chat)
-
-            self.websocket = None
-            self._seq = 0
-            self._counter = itertools.count(0, 1)
-            self._current_listening_chat = None
+            websocket = self.websocket
+
+            # Stop the background tasks first, so closing isn't taken for a dropped connection
+            self._cancel_tasks()
+            self._reset()
+
+            try:
+                await websocket.close()
+            except asyncio.CancelledError:
+                # The closing handshake took too long, drop the connection
+                websocket.transport.abort()
+                raise
 
             logger.info("%s -- ❌ Disconnected from MAX WebSocket", self.user_tg_id)
 
-    @ensure_connected
-    async def listen_to_chat(self, chat_id: str):
-        """Listen to the specific chat for new messages. ps: not necessary"""
+    def abort(self):
+        """Drop the connection without the closing handshake. Used when `disconnect()` hangs"""
+
+        if self.websocket:
+            websocket = self.websocket
+
+            self._cancel_tasks()
+            self._reset()
+
+            websocket.transport.abort()
+
+            logger.warning("%s -- ❌ MAX WebSocket connection aborted", self.user_tg_id)
+
+    async def restore_session(self):
+        """
+        Connect again after the connection dropped:
+        authenticate with the token, subscribe to the chats that were listened to
+        and catch up on the messages missed meanwhile
+        """
+
+        # Messages after this moment come over the new connection
+        connected_at = get_unix_now_ms()
+
+        await self.connect(auth_with_token=self.token is not None)
+
+        try:
+            if self._subscriptions:
+                await self._refresh_subscriptions()
+                self._start_subscription_ping()
+
+            self.catch_up(connected_at)
+        except Exception:
+            self.abort()
+            raise
 
-        if chat_id == self._current_listening_chat:
+    def _connection_lost(self):
+        """Forget the dead connection and let the supervisor restore the session"""
+
+        self._cancel_tasks()
+        self._reset()
+
+        if self.on_connection_lost is not None:
+            try:
+                self.on_connection_lost(self)
+            except Exception as e:
+                logger.error("%s -- Connection lost callback failed: %s", self.user_tg_id, e)
+
+        self._reconnect.start()
+
+    def _cancel_tasks(self):
+        current = asyncio.current_task()
+
+        # Unfinished catch-ups start over from the high-water marks after the next reconnect
+        for task in (self._recv_task, *self._catch_up_tasks):
+            if task is not None and task is not current:
+                task.cancel()
+
+        for timer in (self._ping_timer, self._chat_subscription_ping_timer):
+            if timer is not None:
+                timer.cancel()
+
+        self._catch_up_tasks.clear()
+
+        self._recv_task = None
+        self._ping_timer = None
+        self._chat_subscription_ping_timer = None
+
+    def _reset(self):
+        self.websocket = None
+        self._seq = 0
+        self._counter = itertools.count(0, 1)
+        self._pending.fail_all()
+
+    async def listen_to_chat(self, chat_id: int):
+        """
+        Listen to the specific chat for new messages, along with the other chats. ps: not necessary
+        While disconnected, the chat is subscribed to after the reconnect
+        """
+
+        if chat_id in self._subscriptions:
             raise ValueError("You are already listening to this chat")
 
-        # Unsubscribe from the previous chat
-        if self._current_listening_chat is not None:
-            await self._subscribe_to_chat(self._current_listening_chat, False)
+        self._subscriptions.add(chat_id)
 
-        await self._subscribe_to_chat(chat_id, True)
-        self._current_listening_chat = chat_id
+        if self.websocket is None:
+            return
 
-        if self._chat_subscription_ping_task is None:
-            self._chat_subscription_ping_task = asyncio.create_task(
-                self._chat_subscription_ping()
-            )
+        await self._subscribe_to_chat(chat_id, True)
+        self._start_subscription_ping()
 
         logger.info(f"💭 Now listening to chat {chat_id}")
 
-    @ensure_connected
-    async def stop_listening_to_chat(self, chat_id: str):
+    async def stop_listening_to_chat(self, chat_id: int):
         """Stop listening to a chat"""
 
-        if chat_id != self._current_listening_chat:
+        if chat_id not in self._subscriptions:
             raise ValueError("You are not listening to this chat")
 
-        self._current_listening_chat = None
+        self._subscriptions.discard(chat_id)
+
+        if not self._subscriptions and self._chat_subscription_ping_timer is not None:
+            self._chat_subscription_ping_timer.cancel()
+            self._chat_subscription_ping_timer = None
+
+        if self.websocket is None:
+            return
 
         await self._subscribe_to_chat(chat_id, False)
 
-        logger.info(f"💭❌ Stopped listening to any chat. The last chat was: {chat_id}")
+        logger.info(f"💭❌ Stopped listening to chat {chat_id}")
+
+    def _start_subscription_ping(self):
+        if self._chat_subscription_ping_timer is None:
+            self._chat_subscription_ping_timer = get_timer_wheel().every(
+                SUBSCRIPTION_PING_INTERVAL, self._chat_subscription_ping
+            )
 
     @ensure_connected
     async def _subscribe_to_chat(self, chat_id: str, state: bool = True):
@@ -179,7 +324,7 @@ class MaxClient:
         """
 
         logger.debug("Start/stop pinging to chat %s... | state: %s", chat_id, state)
-        await self.websocket.send(
+        await self._send(
             get_subscribe_json(state, chat_id, self._get_next_seq())
         )
 
@@ -192,73 +337,118 @@ class MaxClient:
             chat_id,
             message_id,
         )
-        await self.websocket.send(
+        await self._send(
             get_read_last_message_json(
                 chat_id, message_id, get_unix_now(), self._get_next_seq()
             )
         )
 
     @ensure_connected
-    async def get_messages_from_chat(self, chat_id: int):
+    async def get_messages_from_chat(
+        self, chat_id: int, timestamp: int = None, messages_count: int = 30
+    ) -> list[ChatMsgMessage]:
         """
-        Get the last 30 messages from a chat
+        Get the last 30 messages from a chat, or the ones sent before the timestamp (in ms)
         It sends only when the chat was opened for the first time
         """
 
         logger.info("Getting messages from chat %s ...", chat_id)
-        await self.websocket.send(
-            get_messages_json(chat_id, get_unix_now(), self._get_next_seq())
+
+        if timestamp is None:
+            timestamp = get_unix_now_ms()
+
+        reply = await self._request(
+            lambda seq: get_messages_json(chat_id, timestamp, seq, messages_count), 49
         )
 
+        return parse_opcode49(reply, self.user_tg_id, chat_id)
+
+    def catch_up(self, until: int):
+        """Fetch the history of every forwarded chat since its high-water mark, in the background"""
+
+        for chat_id, mark in get_high_water_marks().chats(self.user_tg_id).items():
+            catch_up = CatchUp(self.user_tg_id, chat_id, since=mark, until=until)
+
+            task = asyncio.create_task(self._run_catch_up(catch_up))
+            self._catch_up_tasks.add(task)
+            task.add_done_callback(self._catch_up_tasks.discard)
+
+    async def _run_catch_up(self, catch_up: CatchUp):
+        timestamp = catch_up.until
+
+        try:
+            # Page backwards until the high-water mark is reached
+            while timestamp is not None:
+                reply = await self._request(
+                    lambda seq: get_messages_json(
+                        catch_up.chat_id, timestamp, seq, catch_up.page_size
+                    ),
+                    49,
+                )
+                timestamp = await catch_up.add_page(
+                    reply.get("payload", {}).get("messages", [])
+                )
+        except (
+            MaxRequestError,
+            TimeoutError,
+            ConnectionError,
+            websockets.exceptions.ConnectionClosed,
+        ) as e:
+            logger.warning(
+                "%s -- Failed to fetch missed messages of chat %s: %s",
+                self.user_tg_id,
+                catch_up.chat_id,
+                e,
+            )
+            return
+
+        await catch_up.forward()
+
     @ensure_connected
-    async def start_auth(self, phone: str):
-        """Start the authentication process"""
+    async def start_auth(self, phone: str) -> str:
+        """Start the authentication process. **Returns short token**"""
 
         logger.debug("Starting authentication...")
-        await self.websocket.send(get_start_auth_json(phone, self._get_next_seq()))
+
+        reply = await self._request(lambda seq: get_start_auth_json(phone, seq), 17)
+        short_token = parse_opcode17(reply)
+
+        if not short_token:
+            raise ValueError("No short token in the reply")
+
+        self.token = short_token
+        return short_token
 
     @ensure_connected
-    async def check_code(self, token: str, code: str):
-        """Verify the authentication code"""
+    async def check_code(self, token: str, code: str) -> str:
+        """Verify the authentication code. **Returns the final token**"""
 
         logger.debug("Verifying code... | token: %s", token)
-        await self.websocket.send(
-            get_check_code_json(token, code, self._get_next_seq())
+
+        reply = await self._request(
+            lambda seq: get_check_code_json(token, code, seq), 18
         )
+        full_token = parse_opcode18(reply)
+
+        if not full_token:
+            raise ValueError("No token in the reply")
+
+        # Short token is replaced with the final one, it's used to fetch chats from now on
+        self.token = full_token
+        logger.info("🔑 New Token received | %s", full_token)
+
+        return full_token
 
     @ensure_connected
     async def process_message(self, message: dict[str, Any]):
-        """Manage a received message"""
+        """Manage a received message. Handlers are looked up in the opcode registry"""
 
         logger.debug("Processing message: %s", message)
 
-        match message.get("opcode", -1):
-            case 17:
-                token = await process_opcode17(message, self.user_tg_id)
-
-                if not token:
-                    logger.error("User auth failed. User: %s", self.user_tg_id)
-                    return
-
-                self.token = token
-            case 18:
-                if await process_opcode18(message, self.user_tg_id):
-                    self.fetch_chats()
-            case 19:
-                await process_opcode19(message, self.user_tg_id)
-            case 49:
-                await process_opcode49(message, self.user_tg_id)
-            case 64:
-                await process_opcode64(message, self.user_tg_id)
-            case 128:
-                await process_opcode128(message, self.user_tg_id)
-            case -1:
-                logger.warning(f"Unknown opcode: {message}")
-            case _:
-                logger.warning(f"Unknown opcode: {message}")
+        await self._registry.dispatch(self, message)
 
     @ensure_connected
-    async def fetch_chats(self):
+    async def fetch_chats(self) -> list[FetchChatsMessage]:
         """
         Fetch chats using the provided auth token.
         Use if you are logging for the first time
@@ -267,7 +457,36 @@ class MaxClient:
         if self.token is None:
             raise ValueError("Need to set token first")
 
-        await self.websocket.send(get_token_json(self.token, self._get_next_seq()))
+        reply = await self._request(lambda seq: get_token_json(self.token, seq), 19)
+
+        return parse_opcode19(reply, self.user_tg_id)
+
+    @ensure_connected
+    async def _send_token(self):
+        """Send the token without waiting, the chat list comes to the bot queue"""
+
+        if self.token is None:
+            raise ValueError("Need to set token first")
+
+        await self._send(get_token_json(self.token, self._get_next_seq()))
+
+    async def _request(
+        self, build_frame: Callable[[int], bytes], opcode: int, timeout: float = None
+    ) -> dict[str, Any]:
+        """Send a frame and wait for the reply with the same seq and opcode"""
+
+        # Dropped and not restored yet
+        if self.websocket is None:
+            raise ConnectionError("Not connected to MAX")
+
+        seq = self._get_next_seq()
+        reply = self._pending.add(seq, opcode, timeout)
+
+        try:
+            await self._send(build_frame(seq))
+            return await asyncio.wait_for(reply, timeout or self._pending.timeout)
+        finally:
+            self._pending.discard(seq)
 
     @ensure_connected
     async def _handshake(self):
@@ -276,8 +495,8 @@ class MaxClient:
         if not self.token:
             raise ValueError("Need to set token first")
 
-        await self.websocket.send(get_useragent_header_json())
-        await self.websocket.send(get_token_json(self.token, self._get_next_seq()))
+        await self._send(get_useragent_header_json())
+        await self._send(get_token_json(self.token, self._get_next_seq()))
 
     @ensure_connected
     async def _receive_message_from_ws(self):
@@ -285,21 +504,34 @@ class MaxClient:
 
         while self.websocket is not None:
             try:
-                raw_message = await self.websocket.recv()
+                # Text frames are kept as bytes, the codec decodes them directly
+                raw_message = await self.websocket.recv(decode=False)
+                received_at = time.time()
 
                 if not raw_message:
                     continue
 
-                message = json.loads(raw_message)
+                # Nobody listens to this opcode or awaits it, don't even decode it
+                if self._registry.should_drop(raw_message, self._pending.opcodes):
+                    continue
+
+                started_at = time.perf_counter()
+                message = self._codec.loads(raw_message)
+                decode_time = time.perf_counter() - started_at
+                DECODE_SECONDS.observe(decode_time)
 
                 if not message:
                     continue
 
                 logger.debug(f"Received message from MAX: {message}")
 
+                # Somebody awaits this reply, errors included
+                if self._pending.resolve(message):
+                    continue
+
                 # Handle errors
                 if message.get("payload", {}).get("error", None):
-                    await self._add_message_to_queue(
+                    await add_message_to_queue(
                         ErrorMessage(
                             user_id=self.user_tg_id,
                             message=(
@@ -316,18 +548,21 @@ class MaxClient:
                         f"💀 Error: {message['payload']['error']}: {message['payload']['localizedMessage']} || {message['payload']['message']}"
                     )
 
+                self.frame_received_at = received_at
+                self.frame_decode_time = decode_time
+
                 await self.process_message(message)
 
-            except websockets.exceptions.ConnectionClosed:
-                logger.warning("Websocket connection closed. Reconnecting...")
-                await self.disconnect()
-                await self.connect()
-                # TODO: add reconnection limit
+            except websockets.exceptions.ConnectionClosed as e:
+                logger.warning(
+                    "%s -- Websocket connection closed: %s. Reconnecting...",
+                    self.user_tg_id,
+                    e,
+                )
+                self._connection_lost()
                 break
 
             except AttributeError as e:
-                if isinstance(message, dict) and message.get("opcode") == PING_OPCODE:
-                    continue
                 logger.error(e)
                 continue
 
@@ -335,29 +570,83 @@ class MaxClient:
                 logger.error(f"Error while reading messages from MAX: {e}")
                 continue
 
-    @ensure_connected
-    async def _send_ping(self):
-        """Send a ping to the server every 30 seconds"""
+    def _send_ping(self) -> Optional[Awaitable]:
+        """Send a ping to the server. Called by the timer wheel every 30 seconds"""
 
-        while self.websocket is not None:
-            await asyncio.sleep(30)
-            if self.websocket is None:
-                break
-            await self.websocket.send(get_ping_json(self._get_next_seq()))
+        if self.websocket is None:
+            return None
+
+        return self._send(get_ping_json(self._get_next_seq()))
+
+    def _chat_subscription_ping(self) -> Optional[Awaitable]:
+        """Refresh the subscriptions if you are listening to chats. Called every 1 minute"""
+
+        if self.websocket is None or not self._subscriptions:
+            return None
+
+        return self._refresh_subscriptions()
 
     @ensure_connected
-    async def _chat_subscription_ping(self):
-        """Send a ping to the server every 1 minute if you are listening to a chat"""
+    async def _refresh_subscriptions(self):
+        """
+        Subscribe to all chats in one batch. Opcode 75 takes one chat, so the frames
+        are built at once and written back to back
+        """
 
-        while self._current_listening_chat is not None:
-            await asyncio.sleep(60)
+        frames = [
+            get_subscribe_json(True, chat_id, self._get_next_seq())
+            for chat_id in self._subscriptions
+        ]
 
-            if self._current_listening_chat is None:
-                continue
+        logger.debug("Refreshing %s chat subscription(s)...", len(frames))
+
+        for frame in frames:
+            await self._send(frame)
+
+    async def _send(self, frame: bytes):
+        """Send an encoded frame. Frames are UTF-8 JSON, so they go out as text"""
 
-            await self._subscribe_to_chat(self._current_listening_chat, True)
+        await self.websocket.send(frame, text=True)
 
     def _get_next_seq(self) -> int:
         """Get the next sequence number."""
         self._seq = next(self._counter)
         return self._seq
+
+
+# [==================== OPCODE HANDLERS ====================]
+
+_registry = get_opcode_registry()
+
+
+@_registry.register(17)
+async def _on_auth_started(client: MaxClient, message: dict[str, Any]) -> None:
+    token = await process_opcode17(message, client.user_tg_id)
+
+    if not token:
+        logger.error("User auth failed. User: %s", client.user_tg_id)
+        return
+
+    client.token = token
+
+
+@_registry.register(18)
+async def _on_code_checked(client: MaxClient, message: dict[str, Any]) -> None:
+    token = await process_opcode18(message, client.user_tg_id)
+
+    if token:
+        # Short token is replaced with the final one, it's used to fetch chats from now on
+        client.token = token
+        await client._send_token()
+
+
+@_registry.register(19)
+async def _on_chats_fetched(client: MaxClient, message: dict[str, Any]) -> None:
+    await process_opcode19(message, client.user_tg_id)
+
+
+@_registry.register(128)
+async def _on_new_message(client: MaxClient, message: dict[str, Any]) -> None:
+    trace = get_tracer().start(client.frame_received_at, client.frame_decode_time)
+
+    await process_opcode128(message, client.user_tg_id, trace)
@@ -1,18 +1,43 @@
 import asyncio
 import logging
+import time
 
-import random
-from typing import Optional
+from collections import Counter
+from functools import wraps
+from typing import Callable, Optional
 
 from bot.db.db_dependency import DBDependency
 
+from core.message_models import ChatMsgMessage, FetchChatsMessage
+from core.metrics import Family, family, get_metrics
+
 from max.db.max_repo import MaxRepository
+from max.db.routing_index import get_routing_index
 
 from .client import MaxClient
+from .utils.date import get_unix_now_ms
+from .utils.rate_limit import TokenBucket
+from .worker_pool import WorkerPool, shard_of
+
+from config import config
 
 logger = logging.getLogger(__name__)
 
 
+def sharded(method: Callable):
+    """With worker processes, run the method in the worker of the account (`key`)"""
+
+    @wraps(method)
+    async def wrapper(self: "MaxManager", *args, **kwargs):
+        if self.pool is None:
+            return await method(self, *args, **kwargs)
+
+        key = kwargs["key"] if "key" in kwargs else args[0]
+        return await self.pool.call(key, method.__name__, *args, **kwargs)
+
+    return wrapper
+
+
 class MaxManager:
     """
     `MaxManager` объединяет несколько активных аккаунтов (сессий)
@@ -23,28 +48,119 @@ class MaxManager:
     А если функционала недостаточно, то его легко дополнить на основе существующих методов.
 
     Управление классов, на данный момент осуществляется в основном через `message_handler.py`
+
+    Если несколько аккаунтов состоят в одном чате, подписан на него (opcode 75)
+    только один из них — лидер. Когда соединение лидера падает,
+    чат сразу переходит к другому подключенному участнику.
+
+    Подписки считаются по потребителям (группам): чат отписывается,
+    только когда от него отключается последняя группа.
+
+    Если `max.workers` > 0, клиенты работают в отдельных процессах (см. `worker_pool.py`),
+    а методы с ключом вызываются в процессе, которому принадлежит аккаунт.
     """
 
-    def __init__(self, db_dependency: DBDependency):
+    def __init__(
+        self,
+        db_dependency: DBDependency,
+        workers: int = None,
+        shard: tuple[int, int] = None,
+    ):
         self.clients: dict[str, MaxClient] = {}
         self.db_dependency = db_dependency
 
+        # (worker index, workers count) when running inside a worker process
+        self.shard = shard
+
+        if workers is None:
+            workers = config.max.workers
+
+        self.pool = WorkerPool(workers) if workers > 0 and shard is None else None
+
+        # MAX chat ID -> TG User ID of the account subscribed to it.
+        # With worker processes both are kept here, for the accounts of every worker
+        self.leaders: dict[int, int] = {}
+        # MAX chat ID -> TG group IDs that need the subscription
+        self.consumers: dict[int, set[int]] = {}
+        # MAX chat IDs whose leader is subscribing right now
+        self._leading: set[int] = set()
+        self._failover_tasks: set[asyncio.Task] = set()
+
+        # In a worker: report a dropped account to the main process instead of electing here
+        self.on_client_lost: Optional[Callable[[int], None]] = None
+
+        if self.pool is not None:
+            self.pool.on_ready = self._on_worker_ready
+            self.pool.on_exit = self._on_worker_exit
+            self.pool.on_client_lost = self._on_remote_connection_lost
+
     async def startup(self):
         """
         Load saved accounts,
         use their token and owner TG ID to connect several account's at once
         """
 
+        # Subscriptions are restored as each worker gets ready
+        if self.pool is not None:
+            await self.pool.start()
+            return
+
         await self._load_clients()
 
-    async def shutdown(self):
+        # A worker subscribes only when the main process tells it to
+        if self.shard is None:
+            await self._restore_subscriptions()
+
+    async def shutdown(self, timeout: float = None) -> dict[int, BaseException]:
         """
-        Disconnect all active Client's
+        Disconnect all active Client's at once.
+        Connections that are not closed within `timeout` seconds are aborted.
+        Returns disconnect errors by TG User ID
         """
 
-        for client in self.clients.values():
-            await client.disconnect()
+        if timeout is None:
+            timeout = config.max.shutdown_timeout
+
+        if self.pool is not None:
+            await self.pool.stop(timeout)
+            return {}
+
+        if not self.clients:
+            return {}
+
+        tasks = {
+            asyncio.create_task(client.disconnect()): key
+            for key, client in self.clients.items()
+        }
+
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+
+        errors = {}
+
+        for task in done:
+            if task.exception() is not None:
+                errors[tasks[task]] = task.exception()
 
+        # Cancelled disconnects abort their connections
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        for key, error in errors.items():
+            logger.error("%s -- Failed to disconnect: %s", key, error)
+
+        logger.info(
+            "%s clients disconnected | %s aborted after %ss | %s errors",
+            len(done) - len(errors),
+            len(pending),
+            timeout,
+            len(errors),
+        )
+
+        return errors
+
+    @sharded
     async def add_client(self, key: int, token: str, save_in_db=True) -> None:
         """
         Create a new MaxClient with the existing token and add it to the manager
@@ -56,6 +172,7 @@ class MaxManager:
             raise ValueError("Client with this TG User ID already exists")
 
         client = MaxClient(token=token, tg_user_id=key)
+        client.on_connection_lost = self._on_connection_lost
 
         if save_in_db:
             async with self.db_dependency.db_session() as session:
@@ -67,13 +184,19 @@ class MaxManager:
                     logger.error("Failed save Client to DB")
                     return
 
+        connected_at = get_unix_now_ms()
         await client.connect(auth_with_token=True)
 
         self.clients[key] = client
 
-    async def start_auth(self, key: int, phone_number: str):
+        # Marks saved by the previous run: messages sent while the bridge was down
+        client.catch_up(connected_at)
+
+    @sharded
+    async def start_auth(self, key: int, phone_number: str) -> str:
         """
         To get token you need to login. an sms acception will be sent to your phone
+        Returns the short token
         The key is the User TG ID
         """
 
@@ -84,15 +207,24 @@ class MaxManager:
             raise Exception("Client with this TG User ID already exists")
 
         client = MaxClient(tg_user_id=key)
+        client.on_connection_lost = self._on_connection_lost
 
         await client.connect(auth_with_token=False)
-        await client.start_auth(phone_number)
+
+        try:
+            short_token = await client.start_auth(phone_number)
+        except Exception:
+            await client.disconnect()
+            raise
 
         self.clients[key] = client
 
-    async def check_code(self, key: int, short_token: str, code: str):
+        return short_token
+
+    @sharded
+    async def check_code(self, key: int, short_token: str, code: str) -> str:
         """
-        Verify code and get token
+        Verify code and get token. Returns the final token
         The key is User TG ID
         """
 
@@ -104,9 +236,26 @@ class MaxManager:
         if client is None:
             raise ValueError("Client with this TG User ID doesn't exist")
 
-        await client.check_code(short_token, code)
+        return await client.check_code(short_token, code)
 
-    async def get_messages_from_chat(self, key: int, chat_id: int):
+    @sharded
+    async def fetch_chats(self, key: int) -> list[FetchChatsMessage]:
+        """
+        Get the chat list of a user
+        The key is User TG ID
+        """
+
+        client = self.get_client(key)
+
+        if client is None:
+            raise ValueError("Client with this TG User ID doesn't exist")
+
+        return await client.fetch_chats()
+
+    @sharded
+    async def get_messages_from_chat(
+        self, key: int, chat_id: int
+    ) -> list[ChatMsgMessage]:
         """
         Get messages from a specific chat for a user
         The key is User TG ID
@@ -117,20 +266,259 @@ class MaxManager:
         if client is None:
             raise ValueError("Client with this TG User ID doesn't exist")
 
-        await client.get_messages_from_chat(chat_id)
+        return await client.get_messages_from_chat(chat_id)
 
-    async def subscribe_to_chat(self, key: int, chat_id: str):
+    async def subscribe_to_chat(self, key: int, chat_id: int, consumer: int = None):
         """
-        Subscribe to a chat to listen for new messages
+        Subscribe to a chat to listen for new messages.
+        If another account already leads the chat, it stays the only one subscribed
+        The consumer is the TG group that needs the chat
         The key is User TG ID
         """
 
+        if self.pool is not None:
+            # Claimed before the call, a concurrent subscribe sees the leader
+            if chat_id not in self.leaders:
+                self.leaders[chat_id] = key
+
+                try:
+                    await self.pool.call(key, "listen", key, chat_id)
+                except BaseException:
+                    if self.leaders.get(chat_id) == key:
+                        del self.leaders[chat_id]
+                    raise
+
+            if consumer is not None:
+                self.consumers.setdefault(chat_id, set()).add(consumer)
+
+            return
+
         client = self.get_client(key)
 
         if client is None:
             raise ValueError("Client with this TG User ID doesn't exist")
 
-        await client.listen_to_chat(chat_id)
+        if consumer is not None:
+            self.consumers.setdefault(chat_id, set()).add(consumer)
+
+        leader = self.clients.get(self.leaders.get(chat_id))
+
+        if leader is not None and (
+            chat_id in leader.listening_chats or chat_id in self._leading
+        ):
+            logger.info(
+                "%s -- Chat %s is already listened by %s", key, chat_id, leader.user_tg_id
+            )
+            return
+
+        await self._lead(client, chat_id)
+
+    async def unsubscribe_from_chat(self, chat_id: int, consumer: int):
+        """
+        The group doesn't need the chat anymore.
+        The chat is unsubscribed when its last consumer is gone
+        """
+
+        consumers = self.consumers.get(chat_id)
+
+        if consumers is not None:
+            consumers.discard(consumer)
+
+            if consumers:
+                return
+
+            del self.consumers[chat_id]
+
+        key = self.leaders.get(chat_id)
+
+        if self.pool is not None:
+            if key is not None:
+                del self.leaders[chat_id]
+                await self.pool.call(key, "stop_listening", key, chat_id)
+            return
+
+        await self.stop_listening(key, chat_id)
+
+    # [==================== CALLED BY THE MAIN PROCESS IN A WORKER ====================]
+
+    async def listen(self, key: int, chat_id: int):
+        """Subscribe the account to the chat, the main process made it the leader"""
+
+        client = self.get_client(key)
+
+        if client is None:
+            raise ValueError("Client with this TG User ID doesn't exist")
+
+        await self._lead(client, chat_id)
+
+    async def stop_listening(self, key: Optional[int], chat_id: int):
+        self.leaders.pop(chat_id, None)
+        client = self.clients.get(key)
+
+        if client is not None and chat_id in client.listening_chats:
+            await client.stop_listening_to_chat(chat_id)
+
+    async def take_over(self, key: int, chat_id: int) -> bool:
+        """Lead the chat if the account is connected. False if it can't"""
+
+        client = self.clients.get(key)
+
+        if client is None or not client.connected or client.reconnecting:
+            return False
+
+        await self._lead(client, chat_id)
+        return True
+
+    async def hand_over(self, key: int, chat_id: int):
+        """Another account leads the chat now, don't resubscribe after reconnecting"""
+
+        self.leaders.pop(chat_id, None)
+        client = self.clients.get(key)
+
+        if client is not None:
+            client.hand_over(chat_id)
+
+    async def _lead(self, client: MaxClient, chat_id: int):
+        """Subscribe the client to the chat and make it the chat's leader"""
+
+        # Claimed before subscribing, a concurrent subscribe sees the leader
+        previous = self.leaders.get(chat_id)
+        self.leaders[chat_id] = client.user_tg_id
+        self._leading.add(chat_id)
+
+        try:
+            if chat_id not in client.listening_chats:
+                await client.listen_to_chat(chat_id)
+        except BaseException:
+            if self.leaders.get(chat_id) == client.user_tg_id:
+                if previous is None:
+                    del self.leaders[chat_id]
+                else:
+                    self.leaders[chat_id] = previous
+            raise
+        finally:
+            self._leading.discard(chat_id)
+
+        logger.info("%s -- 👑 Leads chat %s", client.user_tg_id, chat_id)
+
+    def _elect(self, chat_id: int, exclude: int) -> Optional[MaxClient]:
+        """Pick the connected member of the chat with the fewest subscriptions"""
+
+        candidates = [
+            client
+            for key in get_routing_index().members(chat_id)
+            if key != exclude
+            and (client := self.clients.get(key)) is not None
+            and client.connected
+            and not client.reconnecting
+        ]
+
+        return min(candidates, key=lambda c: len(c.listening_chats), default=None)
+
+    def _on_connection_lost(self, client: MaxClient):
+        """Hand the chats of a dropped leader over to other members"""
+
+        key = client.user_tg_id
+
+        if self.on_client_lost is not None:
+            self.on_client_lost(key)
+            return
+
+        for chat_id in [c for c, k in self.leaders.items() if k == key]:
+            successor = self._elect(chat_id, exclude=key)
+
+            # Nobody can take it, the leader resubscribes after reconnecting
+            if successor is None:
+                continue
+
+            client.hand_over(chat_id)
+            self.leaders[chat_id] = successor.user_tg_id
+
+            task = asyncio.create_task(self._fail_over(successor, chat_id, key))
+            self._failover_tasks.add(task)
+            task.add_done_callback(self._failover_tasks.discard)
+
+    async def _fail_over(self, successor: MaxClient, chat_id: int, old_key: int):
+        try:
+            await self._lead(successor, chat_id)
+
+            logger.info(
+                "🔀 Chat %s failed over from %s to %s",
+                chat_id,
+                old_key,
+                successor.user_tg_id,
+            )
+        except Exception as e:
+            logger.error(
+                "%s -- Failed to take over chat %s: %s", successor.user_tg_id, chat_id, e
+            )
+
+            if self.leaders.get(chat_id) == successor.user_tg_id:
+                del self.leaders[chat_id]
+
+    # [==================== LEADERSHIP ACROSS WORKERS ====================]
+
+    def _on_remote_connection_lost(self, key: int):
+        """An account in a worker dropped, hand its chats over to members on any worker"""
+
+        for chat_id in [c for c, k in self.leaders.items() if k == key]:
+            task = asyncio.create_task(self._fail_over_remote(chat_id, key))
+            self._failover_tasks.add(task)
+            task.add_done_callback(self._failover_tasks.discard)
+
+    async def _fail_over_remote(self, chat_id: int, old_key: int):
+        # Members leading the fewest chats are asked first.
+        # Nobody can take it: the old leader resubscribes after reconnecting
+        led = Counter(self.leaders.values())
+        candidates = sorted(
+            (k for k in get_routing_index().members(chat_id) if k != old_key),
+            key=lambda k: led[k],
+        )
+
+        for key in candidates:
+            try:
+                if not await self.pool.call(key, "take_over", key, chat_id):
+                    continue
+            except Exception as e:
+                logger.error("%s -- Failed to take over chat %s: %s", key, chat_id, e)
+                continue
+
+            self.leaders[chat_id] = key
+            logger.info("🔀 Chat %s failed over from %s to %s", chat_id, old_key, key)
+
+            try:
+                await self.pool.call(old_key, "hand_over", old_key, chat_id)
+            except Exception as e:
+                # A worker that is gone starts without subscriptions anyway
+                logger.warning("%s -- Failed to hand over chat %s: %s", old_key, chat_id, e)
+
+            return
+
+    def _on_worker_exit(self, index: int):
+        """Chats led from a crashed worker go to members on the other workers meanwhile"""
+
+        for key in {k for k in self.leaders.values() if self.pool.worker_of(k) == index}:
+            self._on_remote_connection_lost(key)
+
+    async def _on_worker_ready(self, index: int):
+        """Subscribe the chats of a started (or restarted) worker's accounts"""
+
+        # A restarted worker lost its subscriptions, its chats get a leader again
+        lost = {c for c, k in self.leaders.items() if self.pool.worker_of(k) == index}
+
+        for chat_id in lost:
+            del self.leaders[chat_id]
+
+        for group_id, owner_id, chat_id in get_routing_index().routes():
+            if self.pool.worker_of(owner_id) != index and chat_id not in lost:
+                continue
+
+            try:
+                await self.subscribe_to_chat(owner_id, chat_id, consumer=group_id)
+            except Exception as e:
+                logger.error(
+                    "%s -- Failed to subscribe to chat %s: %s", owner_id, chat_id, e
+                )
 
     async def remove_client(self, key: int):
         """
@@ -138,11 +526,87 @@ class MaxManager:
         The key is User TG ID
         """
 
+        # The main process routes by membership too, not only the worker of the account
+        get_routing_index().leave_all(key)
+
+        if self.pool is not None:
+            await self.pool.call(key, "remove_client", key)
+            self._on_remote_connection_lost(key)
+            return
+
         if key not in self.clients:
             raise ValueError("Client with this TG User ID doesn't exist")
 
         del self.clients[key]
 
+        for chat_id in [c for c, k in self.leaders.items() if k == key]:
+            del self.leaders[chat_id]
+
+    async def _restore_subscriptions(self):
+        """Subscribe to the chats that saved groups are connected to"""
+
+        for group_id, owner_id, chat_id in get_routing_index().routes():
+            if owner_id not in self.clients:
+                continue
+
+            try:
+                await self.subscribe_to_chat(owner_id, chat_id, consumer=group_id)
+            except Exception as e:
+                logger.error(
+                    "%s -- Failed to subscribe to chat %s: %s", owner_id, chat_id, e
+                )
+
+    async def collect_metrics(self) -> list[Family]:
+        """
+        Metrics collector: client states. With worker processes,
+        everything the workers measured, labeled by worker
+        """
+
+        if self.pool is not None:
+            results = await asyncio.gather(
+                *(
+                    self.pool.call_worker(index, "collect_metrics")
+                    for index in range(self.pool.workers)
+                ),
+                return_exceptions=True,
+            )
+
+            families = []
+
+            for index, result in enumerate(results):
+                if isinstance(result, BaseException):
+                    logger.warning("No metrics from MAX worker %s: %s", index, result)
+                    continue
+
+                families.extend(f.with_labels(worker=str(index)) for f in result)
+
+            return families
+
+        clients = list(self.clients.values())
+
+        families = [
+            family(
+                "max2tg_max_clients",
+                "MAX clients by connection state",
+                {
+                    (("state", "connected"),): sum(c.connected for c in clients),
+                    (("state", "reconnecting"),): sum(c.reconnecting for c in clients),
+                    (("state", "total"),): len(clients),
+                },
+            ),
+            family(
+                "max2tg_max_subscribed_chats",
+                "MAX chats this process is subscribed to",
+                {(): len(self.leaders)},
+            ),
+        ]
+
+        # A worker process also reports its own queues, frames, decode and DB times
+        if self.shard is not None:
+            families.extend(await get_metrics().collect())
+
+        return families
+
     def get_client(self, key: int) -> Optional[MaxClient]:
         """
         Get a MaxClient by its TG User ID
@@ -167,16 +631,44 @@ class MaxManager:
 
             accounts = await db.get_all_accounts()
 
+        if self.shard is not None:
+            index, workers = self.shard
+            accounts = [acc for acc in accounts if shard_of(acc.tg_id, workers) == index]
+
         if len(accounts) == 0:
             logger.info("No saved accounts")
             return
 
-        for acc in accounts:
-            # Add delay between connections to avoid rate limiting
-            await asyncio.sleep(random.randint(1, 2))
-
-            try:
-                await self.add_client(acc.tg_id, acc.token, save_in_db=False)
-            except Exception as e:
-                logger.error(f"Failed to load account {acc.tg_id}: {e}")
-                continue
+        # Accounts with subscribed groups are bridged first
+        subscribed = get_routing_index().owners()
+        accounts = sorted(accounts, key=lambda acc: acc.tg_id not in subscribed)
+
+        bucket = TokenBucket(
+            rate=config.max.startup_rate,
+            burst=config.max.startup_burst,
+            jitter=config.max.startup_jitter,
+        )
+        handshakes = asyncio.Semaphore(config.max.startup_max_in_flight)
+
+        async def load(acc) -> bool:
+            # Limit connection rate to avoid rate limiting
+            await bucket.acquire()
+
+            async with handshakes:
+                try:
+                    await self.add_client(acc.tg_id, acc.token, save_in_db=False)
+                    return True
+                except Exception as e:
+                    logger.error(f"Failed to load account {acc.tg_id}: {e}")
+                    return False
+
+        started_at = time.monotonic()
+
+        results = await asyncio.gather(*(load(acc) for acc in accounts))
+
+        logger.info(
+            "%s/%s accounts connected in %.1fs",
+            sum(results),
+            len(accounts),
+            time.monotonic() - started_at,
+        )
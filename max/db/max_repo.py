@@ -1,19 +1,45 @@
 import logging
+import time
 
-from typing import Optional, List
+from functools import wraps
+from typing import Callable, Iterable, Optional, List
 
 from sqlalchemy import delete, select, update, or_
 from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from core.message_models import FetchChatsMessage
+from core.metrics import get_metrics
+
 from max.models.max_account import MaxBase, MaxAccount
 from max.models.groups import Chat, Group
+from max.db.routing_index import ANY_CHAT_CODE, get_routing_index
 
 
 log = logging.getLogger(__name__)
 
-ANY_CHAT_CODE = "any"
+QUERY_SECONDS = get_metrics().histogram(
+    "max2tg_db_query_seconds",
+    "Time of MaxRepository calls",
+    ("method",),
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
+
+
+def timed(method: Callable):
+    """Record the time of the call in `QUERY_SECONDS`"""
+
+    @wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        started_at = time.perf_counter()
+
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            QUERY_SECONDS.observe(time.perf_counter() - started_at, method.__name__)
+
+    return wrapper
 
 
 async def init_max_db(engine):
@@ -26,6 +52,7 @@ class MaxRepository:
     def __init__(self, session: AsyncSession):
         self.session = session
 
+    @timed
     async def save_account(self, user_tg_id: int, token: str) -> Optional[MaxAccount]:
         """Add new account if it doesn't exist. Returns the new user object"""
         try:
@@ -46,6 +73,7 @@ class MaxRepository:
             await self.session.rollback()
             return None
 
+    @timed
     async def get_account(self, user_tg_id: int) -> Optional[MaxAccount]:
         """Get user by Telegram ID"""
 
@@ -58,6 +86,7 @@ class MaxRepository:
             log.error(f"Error getting account {user_tg_id}: {e}")
             return None
 
+    @timed
     async def get_all_accounts(self) -> List[MaxAccount]:
         """Get all accounts"""
 
@@ -70,6 +99,7 @@ class MaxRepository:
             log.error(f"Error getting MAX accounts: {e}")
             return []
 
+    @timed
     async def set_user_token(self, user_tg_id: int, token: str) -> bool:
         """Set user token"""
         try:
@@ -86,6 +116,7 @@ class MaxRepository:
             await self.session.rollback()
             return False
 
+    @timed
     async def get_user_token(self, user_tg_id: int) -> Optional[str]:
         """Get user token"""
         try:
@@ -99,6 +130,7 @@ class MaxRepository:
 
     # ---
 
+    @timed
     async def add_group(
         self,
         owner_id: int,
@@ -119,12 +151,17 @@ class MaxRepository:
             )
             result = await self.session.execute(stmt)
             await self.session.commit()
-            return result.rowcount > 0
+
+            if result.rowcount > 0:
+                get_routing_index().add(owner_id, group_id, chat_id)
+                return True
+            return False
         except SQLAlchemyError as e:
             log.error(f"Error saving group {group_id}: {e}")
             await self.session.rollback()
             return False
 
+    @timed
     async def save_user_chat(
         self,
         owner_id: int,
@@ -153,6 +190,48 @@ class MaxRepository:
             await self.session.rollback()
             return False
 
+    @timed
+    async def save_user_chats(
+        self, owner_id: int, chats: Iterable[FetchChatsMessage]
+    ) -> bool:
+        """
+        Save the whole chat list of an account in one statement and one transaction.
+        Already saved chats get a new title, last message ID and messages count
+        """
+
+        rows = [
+            {
+                "user_tg_id": owner_id,
+                "chat_title": chat.chat_title,
+                "chat_id": chat.chat_id,
+                "last_message_id": chat.last_message_id,
+                "messages_count": chat.messages_count,
+            }
+            for chat in chats
+        ]
+
+        if not rows:
+            return True
+
+        try:
+            stmt = insert(Chat)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Chat.chat_id],
+                set_={
+                    "chat_title": stmt.excluded.chat_title,
+                    "last_message_id": stmt.excluded.last_message_id,
+                    "messages_count": stmt.excluded.messages_count,
+                },
+            )
+            await self.session.execute(stmt, rows)
+            await self.session.commit()
+            return True
+        except SQLAlchemyError as e:
+            log.error(f"Error saving {len(rows)} chats of user {owner_id}: {e}")
+            await self.session.rollback()
+            return False
+
+    @timed
     async def connect_group_to_chat(self, group_id: int, chat_id: int) -> bool:
         try:
             stmt = (
@@ -162,23 +241,33 @@ class MaxRepository:
             )
             result = await self.session.execute(stmt)
             await self.session.commit()
-            return result.rowcount > 0
+
+            if result.rowcount > 0:
+                get_routing_index().connect(group_id, chat_id)
+                return True
+            return False
         except SQLAlchemyError as e:
             log.error(f"Error connecting group {group_id} to chat {chat_id}: {e}")
             await self.session.rollback()
             return False
 
+    @timed
     async def remove_group(self, group_id: int) -> bool:
         try:
             stmt = delete(Group).where(Group.group_id == group_id)
             result = await self.session.execute(stmt)
             await self.session.commit()
-            return result.rowcount > 0
+
+            if result.rowcount > 0:
+                get_routing_index().remove(group_id)
+                return True
+            return False
         except SQLAlchemyError as e:
             log.error(f"Error removing group {group_id}: {e}")
             await self.session.rollback()
             return False
 
+    @timed
     async def get_subscribed_groups(self, chat_id: int) -> Optional[list[Group]]:
         """Get all TG Groups subscribed to the MAX chat"""
 
@@ -191,6 +280,7 @@ class MaxRepository:
             log.error(f"Error getting subscribed TG Groups: {e}")
             return []
 
+    @timed
     async def get_groups_include_any(self, chat_id: int) -> Optional[list[Group]]:
         """Get all TG Groups"""
 
@@ -208,6 +298,26 @@ class MaxRepository:
             log.error(f"Error getting TG Groups: {e}")
             return []
 
+    @timed
+    async def get_all_groups(self) -> list[Group]:
+        """Get all TG Groups"""
+
+        try:
+            result = await self.session.execute(select(Group))
+            return result.scalars().all()
+        except SQLAlchemyError as e:
+            log.error(f"Error getting TG Groups: {e}")
+            return []
+
+    async def load_routing_index(self) -> None:
+        """Fill the in-memory chat → group routes from the saved groups"""
+
+        groups = await self.get_all_groups()
+        get_routing_index().load(groups)
+
+        log.info("Routing index loaded: %s groups", len(groups))
+
+    @timed
     async def get_group(self, group_id: int) -> Optional[Group]:
         """Get TG Group if there is a group with this ID"""
         try:
@@ -219,6 +329,7 @@ class MaxRepository:
             log.error(f"Error getting TG Group: {e}")
             return None
 
+    @timed
     async def get_max_available_chats(self, owner_id: int) -> Optional[list[Chat]]:
         try:
             stmt = select(Chat).where(Chat.user_tg_id == owner_id)
@@ -0,0 +1,201 @@
+"""
+In-memory routes from MAX chats to the Telegram groups they are forwarded to
+
+Loaded once at startup (`MaxRepository.load_routing_index()`) and kept
+up to date by `MaxRepository.add_group / remove_group / connect_group_to_chat`,
+so forwarding a message doesn't touch the database.
+
+Routes are scoped by owner: a group only receives chats of its owner's account,
+including the groups connected to "any" chat.
+
+Chat members are the bridged accounts known to be in a MAX chat, learned from
+chat lists and received messages. They let one copy of a message shared by
+several accounts reach the groups of all of them. Every chat list of an account
+replaces its memberships, a removed client leaves all its chats. A chat list
+holds at most 40 chats (`chatsCount`), older chats are joined again by their messages.
+"""
+
+from typing import Iterable, Optional, Union
+
+from max.models.groups import Group
+
+
+ANY_CHAT_CODE = "any"
+
+ChatId = Union[int, str]
+
+
+class RoutingIndex:
+    def __init__(self):
+        # (owner TG ID, MAX chat ID) -> TG group IDs
+        self._routes: dict[tuple[int, int], set[int]] = {}
+        # owner TG ID -> TG group IDs connected to any chat
+        self._wildcards: dict[int, set[int]] = {}
+        # TG group ID -> (owner TG ID, MAX chat ID or "any")
+        self._groups: dict[int, tuple[int, Optional[ChatId]]] = {}
+        # MAX chat ID -> owner TG IDs whose accounts are in the chat
+        self._members: dict[int, set[int]] = {}
+        # owner TG ID -> MAX chat IDs the account is in
+        self._chats: dict[int, set[int]] = {}
+
+    def load(self, groups: Iterable[Group]) -> None:
+        """Replace all routes with the given groups"""
+
+        self._routes.clear()
+        self._wildcards.clear()
+        self._groups.clear()
+
+        for group in groups:
+            self.add(group.user_tg_id, group.group_id, group.connected_chat_id)
+
+    def add(self, owner_id: int, group_id: int, chat_id: Optional[ChatId]) -> None:
+        """Add a group, or move it if it is already routed"""
+
+        self.remove(group_id)
+
+        self._groups[group_id] = (owner_id, chat_id)
+
+        if chat_id is None:
+            return
+
+        if chat_id == ANY_CHAT_CODE:
+            self._wildcards.setdefault(owner_id, set()).add(group_id)
+        else:
+            self._routes.setdefault((owner_id, int(chat_id)), set()).add(group_id)
+
+    def remove(self, group_id: int) -> None:
+        route = self._groups.pop(group_id, None)
+
+        if route is None:
+            return
+
+        owner_id, chat_id = route
+
+        if chat_id is None:
+            return
+
+        if chat_id == ANY_CHAT_CODE:
+            key, table = owner_id, self._wildcards
+        else:
+            key, table = (owner_id, int(chat_id)), self._routes
+
+        groups = table.get(key)
+
+        if groups is not None:
+            groups.discard(group_id)
+
+            if not groups:
+                del table[key]
+
+    def connect(self, group_id: int, chat_id: ChatId) -> None:
+        """Connect an already routed group to another chat"""
+
+        route = self._groups.get(group_id)
+
+        if route is not None:
+            self.add(route[0], group_id, chat_id)
+
+    def lookup(self, owner_id: int, chat_id: int) -> set[int]:
+        """TG groups of the owner that receive messages of the MAX chat"""
+
+        groups = self._routes.get((owner_id, chat_id))
+        wildcards = self._wildcards.get(owner_id)
+
+        if groups and wildcards:
+            return groups | wildcards
+
+        return set(groups or wildcards or ())
+
+    def join(self, owner_id: int, chat_id: int) -> None:
+        """Remember that the owner's account is a member of the chat"""
+
+        members = self._members.get(chat_id)
+
+        if members is None:
+            self._members[chat_id] = {owner_id}
+        else:
+            members.add(owner_id)
+
+        chats = self._chats.get(owner_id)
+
+        if chats is None:
+            self._chats[owner_id] = {chat_id}
+        else:
+            chats.add(chat_id)
+
+    def set_chats(self, owner_id: int, chat_ids: Iterable[int]) -> None:
+        """The owner's account is a member of exactly these chats, from its chat list"""
+
+        chat_ids = set(chat_ids)
+
+        for chat_id in self._chats.get(owner_id, set()) - chat_ids:
+            self._leave(owner_id, chat_id)
+
+        for chat_id in chat_ids:
+            self.join(owner_id, chat_id)
+
+    def leave_all(self, owner_id: int) -> None:
+        """The owner's account is gone from every chat"""
+
+        for chat_id in list(self._chats.get(owner_id, ())):
+            self._leave(owner_id, chat_id)
+
+    def _leave(self, owner_id: int, chat_id: int) -> None:
+        members = self._members.get(chat_id)
+
+        if members is not None:
+            members.discard(owner_id)
+
+            if not members:
+                del self._members[chat_id]
+
+        chats = self._chats.get(owner_id)
+
+        if chats is not None:
+            chats.discard(chat_id)
+
+            if not chats:
+                del self._chats[owner_id]
+
+    def members(self, chat_id: int) -> set[int]:
+        return self._members.get(chat_id, set())
+
+    def lookup_chat(self, chat_id: int) -> set[int]:
+        """TG groups of all known members that receive messages of the MAX chat"""
+
+        groups = set()
+
+        for owner_id in self._members.get(chat_id, ()):
+            groups |= self.lookup(owner_id, chat_id)
+
+        return groups
+
+    def routes(self) -> list[tuple[int, int, int]]:
+        """(TG group ID, owner TG ID, MAX chat ID) of groups connected to a specific chat"""
+
+        return [
+            (group_id, owner_id, int(chat_id))
+            for group_id, (owner_id, chat_id) in self._groups.items()
+            if chat_id is not None and chat_id != ANY_CHAT_CODE
+        ]
+
+    def owners(self) -> set[int]:
+        """Owners that have at least one group connected to a chat"""
+
+        return {
+            owner_id
+            for owner_id, chat_id in self._groups.values()
+            if chat_id is not None
+        }
+
+
+_routing_index = None
+
+
+def get_routing_index() -> RoutingIndex:
+    global _routing_index
+
+    if _routing_index is None:
+        _routing_index = RoutingIndex()
+
+    return _routing_index
@@ -0,0 +1,106 @@
+"""
+Reconnecting dropped MAX connections
+
+Every client gets its own supervisor that retries with exponential backoff
+and full jitter. All supervisors share one token bucket, so when the MAX edge
+drops every socket at once we come back at a bounded rate instead of all together.
+"""
+
+import asyncio
+import logging
+import random
+
+from typing import TYPE_CHECKING, Optional
+
+from .utils.rate_limit import TokenBucket
+
+from config import config
+
+if TYPE_CHECKING:
+    from .client import MaxClient
+
+
+logger = logging.getLogger(__name__)
+
+
+class ReconnectSupervisor:
+    def __init__(
+        self,
+        client: "MaxClient",
+        limiter: Optional[TokenBucket] = None,
+        base_delay: float = None,
+        max_delay: float = None,
+    ):
+        self.client = client
+        self.limiter = limiter or get_reconnect_limiter()
+        self.base_delay = base_delay or config.max.reconnect_base_delay
+        self.max_delay = max_delay or config.max.reconnect_max_delay
+
+        self.attempts = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> None:
+        """Start reconnecting in the background, if not already"""
+
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self) -> None:
+        if self.running and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+        self._task = None
+
+    def next_delay(self) -> float:
+        """Full jitter: random delay up to the exponential backoff"""
+
+        backoff = min(self.max_delay, self.base_delay * 2**self.attempts)
+        return random.uniform(0, backoff)
+
+    async def _run(self) -> None:
+        self.attempts = 0
+
+        while True:
+            await asyncio.sleep(self.next_delay())
+            await self.limiter.acquire()
+
+            try:
+                await self.client.restore_session()
+
+                logger.info(
+                    "%s -- 🔁 Reconnected after %s attempt(s)",
+                    self.client.user_tg_id,
+                    self.attempts + 1,
+                )
+                return
+
+            except Exception as e:
+                self.attempts += 1
+
+                logger.warning(
+                    "%s -- Reconnect attempt %s failed: %s",
+                    self.client.user_tg_id,
+                    self.attempts,
+                    e,
+                )
+
+
+_reconnect_limiter: Optional[TokenBucket] = None
+
+
+def get_reconnect_limiter() -> TokenBucket:
+    """Global limit of reconnects per second, shared by all clients"""
+
+    global _reconnect_limiter
+
+    if _reconnect_limiter is None:
+        _reconnect_limiter = TokenBucket(
+            rate=config.max.reconnect_rate,
+            burst=config.max.reconnect_burst,
+        )
+
+    return _reconnect_limiter
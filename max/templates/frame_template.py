@@ -0,0 +1,112 @@
+"""
+Precompiled outbound frames
+
+A frame is serialized once with `Slot` markers in place of the variable fields
+and turned into a bytes format string. `render()` only formats the values into it,
+ints go straight through `%d`. The output is exactly what
+`json_codec.dumps()` would produce for the full frame.
+"""
+
+from json.encoder import encode_basestring
+from typing import Any, Callable
+
+from ..utils.json_codec import dumps
+
+
+_BOOLS = {True: b"true", False: b"false"}
+
+
+def _encode_str(value: str) -> bytes:
+    # Same escaping as every codec backend: only quotes, backslashes and control chars
+    return encode_basestring(value).encode()
+
+
+_ENCODERS = {bool: _BOOLS.__getitem__, str: _encode_str}
+
+
+class Slot:
+    """
+    Placeholder for a variable field of a `FrameTemplate`
+
+    `kind` is the type of the value: `int` (default), `bool` or `str`.
+    Any other kind is encoded with the codec as is
+    """
+
+    __slots__ = ("name", "kind")
+
+    def __init__(self, name: str, kind: type = int):
+        self.name = name
+        self.kind = kind
+
+    @property
+    def marker(self) -> str:
+        return f"\x00slot:{self.name}\x00"
+
+
+class FrameTemplate:
+    """
+    Example:
+    ```
+    ping = FrameTemplate({"ver": 11, "seq": Slot("seq"), "payload": {}})
+    ping.render(5)  # b'{"ver":11,"seq":5,"payload":{}}'
+    ```
+    """
+
+    def __init__(self, frame: dict[str, Any]):
+        slots: list[Slot] = []
+        raw = dumps(_replace_slots(frame, slots))
+
+        self.names: tuple[str, ...] = tuple(slot.name for slot in slots)
+
+        chunks = []
+        self._encoders: tuple[tuple[int, Callable[[Any], bytes]], ...] = ()
+
+        for index, slot in enumerate(slots):
+            head, sep, raw = raw.partition(dumps(slot.marker))
+
+            if not sep:
+                raise ValueError(f"Slot {slot.name} was not found in the frame")
+
+            chunks.append(head.replace(b"%", b"%%"))
+
+            if slot.kind is int:
+                chunks.append(b"%d")
+            else:
+                chunks.append(b"%b")
+                self._encoders += ((index, _ENCODERS.get(slot.kind, dumps)),)
+
+        chunks.append(raw.replace(b"%", b"%%"))
+
+        self._format = b"".join(chunks)
+
+    def render(self, *values: Any) -> bytes:
+        """Build the frame. Values go in the order their slots appear in the frame"""
+
+        if len(values) != len(self.names):
+            raise TypeError(f"Expected values for {self.names}, got {len(values)}")
+
+        if not self._encoders:
+            return self._format % values
+
+        values = list(values)
+
+        for index, encoder in self._encoders:
+            values[index] = encoder(values[index])
+
+        return self._format % tuple(values)
+
+
+def _replace_slots(value: Any, slots: list[Slot]) -> Any:
+    """Copy the frame replacing slots with their markers (in serialization order)"""
+
+    if isinstance(value, Slot):
+        slots.append(value)
+        return value.marker
+
+    if isinstance(value, dict):
+        return {key: _replace_slots(item, slots) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [_replace_slots(item, slots) for item in value]
+
+    return value
@@ -1,28 +1,66 @@
-import json
+"""
+Outbound MAX frames
+
+Only frames that render faster than the codec encodes them are precompiled
+`FrameTemplate`s: ping and history (int fields only) and the user agent frame.
+With orjson, frames with string fields encode faster as a plain dict,
+see `python -m benchmarks.payloads_bench`
+"""
+
 import uuid
 import re
 
+from .frame_template import FrameTemplate, Slot
+from ..utils.json_codec import dumps
+
+
+_PING = FrameTemplate(
+    {
+        "ver": 11,
+        "cmd": 0,
+        "seq": Slot("seq"),
+        "opcode": 1,
+        "payload": {"interactive": False},
+    }
+)
+
 
-def get_ping_json(seq: int) -> str:
+def get_ping_json(seq: int) -> bytes:
     """**OPCODE 1**
     Ping
 
     Returns:
-        str: JSON
+        bytes: JSON
     """
 
-    return json.dumps(
-        {
-            "ver": 11,
-            "cmd": 0,
-            "seq": seq,
-            "opcode": 1,
-            "payload": {"interactive": False},
-        }
-    )
+    return _PING.render(seq)
 
 
-def get_useragent_header_json(useragent: str = None) -> str:
+_USERAGENT_HEADER = FrameTemplate(
+    {
+        "ver": 11,
+        "cmd": 0,
+        "seq": 0,
+        "opcode": 6,
+        "payload": {
+            "userAgent": {
+                "deviceType": "WEB",
+                "locale": "ru",
+                "deviceLocale": "ru",
+                "osVersion": "Windows",
+                "deviceName": "Edge",
+                "headerUserAgent": Slot("useragent", str),
+                "appVersion": "25.11.1",
+                "screen": "1080x1920 1.0x",
+                "timezone": "Europe/Moscow",
+            },
+            "deviceId": Slot("device_id", str),
+        },
+    }
+)
+
+
+def get_useragent_header_json(useragent: str = None) -> bytes:
     """**OPCODE 6**
     This is the first sending package to the websocket server. Used for initial connection.
 
@@ -44,7 +82,7 @@ def get_useragent_header_json(useragent: str = None) -> str:
         useragent (str, optional): If you need a custom useragent. If None used default
 
     Returns:
-        str: JSON
+        bytes: JSON
 
 
     """
@@ -53,31 +91,10 @@ def get_useragent_header_json(useragent: str = None) -> str:
         or "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/140.0.0.0 Safari/537.36 Edg/140.0.0.0"
     )
 
-    return json.dumps(
-        {
-            "ver": 11,
-            "cmd": 0,
-            "seq": 0,
-            "opcode": 6,
-            "payload": {
-                "userAgent": {
-                    "deviceType": "WEB",
-                    "locale": "ru",
-                    "deviceLocale": "ru",
-                    "osVersion": "Windows",
-                    "deviceName": "Edge",
-                    "headerUserAgent": useragent,
-                    "appVersion": "25.11.1",
-                    "screen": "1080x1920 1.0x",
-                    "timezone": "Europe/Moscow",
-                },
-                "deviceId": str(uuid.uuid4()),
-            },
-        }
-    )
+    return _USERAGENT_HEADER.render(useragent, str(uuid.uuid4()))
 
 
-def get_token_json(token: str, seq: int = 1) -> str:
+def get_token_json(token: str, seq: int = 1) -> bytes:
     """**OPCODE 19**
     The second package that send to the websocket server. Used for user auth and receive its chat list and more
 
@@ -91,9 +108,9 @@ def get_token_json(token: str, seq: int = 1) -> str:
         seq (int, optional): Sequence number. Defaults to 1.
 
     Returns:
-        str: JSON
+        bytes: JSON
     """
-    return json.dumps(
+    return dumps(
         {
             "ver": 11,
             "cmd": 0,
@@ -112,7 +129,7 @@ def get_token_json(token: str, seq: int = 1) -> str:
     )
 
 
-def get_subscribe_json(state: bool, chat_id: int, seq: int) -> str:
+def get_subscribe_json(state: bool, chat_id: int, seq: int) -> bytes:
     """**OPCODE 75**
     Somewhy when a user changes the chat this package is sent
     honestly idk why and what does it affect
@@ -125,10 +142,10 @@ def get_subscribe_json(state: bool, chat_id: int, seq: int) -> str:
 
 
     Returns:
-        str: JSON
+        bytes: JSON
     """
 
-    return json.dumps(
+    return dumps(
         {
             "ver": 11,
             "cmd": 0,
@@ -141,7 +158,7 @@ def get_subscribe_json(state: bool, chat_id: int, seq: int) -> str:
 
 def get_read_last_message_json(
     chat_id: int, message_id: str, timestamp: int, seq: int
-) -> str:
+) -> bytes:
     """**OPCODE 50**
     Read the last message in chat
 
@@ -169,10 +186,10 @@ def get_read_last_message_json(
         seq (int): Sequence number
 
     Returns:
-        str: JSON
+        bytes: JSON
     """
 
-    return json.dumps(
+    return dumps(
         {
             "ver": 11,
             "cmd": 0,
@@ -188,9 +205,26 @@ def get_read_last_message_json(
     )
 
 
+_MESSAGES = FrameTemplate(
+    {
+        "ver": 11,
+        "cmd": 0,
+        "seq": Slot("seq"),
+        "opcode": 49,
+        "payload": {
+            "chatId": Slot("chat_id"),
+            "from": Slot("timestamp"),
+            "forward": 0,
+            "backward": Slot("messages_count"),
+            "getMessages": True,
+        },
+    }
+)
+
+
 def get_messages_json(
     chat_id: int, timestamp: int, seq: int, messages_count: int = 30
-) -> str:
+) -> bytes:
     """**OPCODE 49**
     Get last 30 messages from a certain chat. idk do you send subscription first or not
 
@@ -240,30 +274,16 @@ def get_messages_json(
         seq (int): Sequence code
 
     Returns:
-        str: JSON
+        bytes: JSON
     """
 
-    return json.dumps(
-        {
-            "ver": 11,
-            "cmd": 0,
-            "seq": seq,
-            "opcode": 49,
-            "payload": {
-                "chatId": chat_id,
-                "from": timestamp,
-                "forward": 0,
-                "backward": messages_count,
-                "getMessages": True,
-            },
-        }
-    )
+    return _MESSAGES.render(seq, chat_id, timestamp, messages_count)
 
 
 # [==================== AUTH ====================]
 
 
-def get_start_auth_json(phone: str, seq: int) -> str:
+def get_start_auth_json(phone: str, seq: int) -> bytes:
     """**OPCODE 17**
     Used for start authentication
 
@@ -304,28 +324,24 @@ def get_start_auth_json(phone: str, seq: int) -> str:
         seq (int): Sequence number
 
     Returns:
-        str: JSON
+        bytes: JSON
     """
 
     if not re.match(r"^\+7\d{10}$", phone):
         raise ValueError(f"Phone number must be in format +7xxxxxxxxxx, got: {phone}")
 
-    return json.dumps(
+    return dumps(
         {
             "ver": 11,
             "cmd": 0,
             "seq": seq,
             "opcode": 17,
-            "payload": {
-                "phone": phone,
-                "type": "START_AUTH",
-                "language": "ru",
-            },
+            "payload": {"phone": phone, "type": "START_AUTH", "language": "ru"},
         }
     )
 
 
-def get_check_code_json(token: str, code: str, seq: int) -> str:
+def get_check_code_json(token: str, code: str, seq: int) -> bytes:
     """**OPCODE 18**
         Used for check code
 
@@ -370,10 +386,10 @@ def get_check_code_json(token: str, code: str, seq: int) -> str:
             seq (int): Sequence code
 
         Returns:
-            str: JSON
+            bytes: JSON
     """
 
-    return json.dumps(
+    return dumps(
         {
             "ver": 11,
             "cmd": 0,
@@ -388,7 +404,7 @@ def get_check_code_json(token: str, code: str, seq: int) -> str:
     )
 
 
-def get_received_message_response_json(seq: int, chat_id: int, message_id: str) -> str:
+def get_received_message_response_json(seq: int, chat_id: int, message_id: str) -> bytes:
     """**OPCODE 128**
     Used for received message response. somehow MAX web version send this data to server
     Interesting fact: This is the only sending data with cmd=1 and received data with cmd=0
@@ -399,10 +415,10 @@ def get_received_message_response_json(seq: int, chat_id: int, message_id: str)
         message_id (str): Message ID
 
     Returns:
-        str: JSON
+        bytes: JSON
     """
 
-    return json.dumps(
+    return dumps(
         {
             "ver": 11,
             "cmd": 1,
@@ -7,6 +7,12 @@ def get_unix_now() -> int:
     return int(datetime.now(timezone.utc).timestamp())
 
 
+def get_unix_now_ms() -> int:
+    """Get UNIX timestamp in milliseconds, like message times in MAX"""
+
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
 def utc_to_unix(date: str) -> int:
     """Convert UTC to UNIX, UTC is format YYYY-MM-DD HH:MM:SS"""
 
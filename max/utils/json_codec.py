@@ -0,0 +1,128 @@
+"""
+JSON codec for MAX WebSocket frames
+
+Inbound frames are decoded straight from the `bytes` returned by
+`websocket.recv(decode=False)`, outbound frames are encoded to UTF-8 `bytes`
+and sent as text frames. All backends produce the same compact output
+(no spaces, non-ASCII kept as UTF-8), so frames don't depend on what is installed.
+
+Backends, in order of preference: `orjson`, `msgspec`, stdlib `json`.
+"""
+
+import json
+import logging
+
+from typing import Any, Optional
+
+from config import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class JsonCodec:
+    """Stdlib `json` backend. Always available"""
+
+    name = "json"
+
+    def loads(self, data: bytes | str) -> Any:
+        """Decode a frame. Raises `ValueError` on malformed JSON"""
+
+        return json.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        """Encode a frame to compact UTF-8 JSON"""
+
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class OrjsonCodec(JsonCodec):
+    name = "orjson"
+
+    def loads(self, data: bytes | str) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+
+class MsgspecCodec(JsonCodec):
+    name = "msgspec"
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def loads(self, data: bytes | str) -> Any:
+        return self._decoder.decode(data)
+
+    def dumps(self, obj: Any) -> bytes:
+        return self._encoder.encode(obj)
+
+
+def available_codecs() -> dict[str, JsonCodec]:
+    """All installed backends, fastest first"""
+
+    codecs = {}
+
+    if orjson is not None:
+        codecs[OrjsonCodec.name] = OrjsonCodec()
+    if msgspec is not None:
+        codecs[MsgspecCodec.name] = MsgspecCodec()
+
+    codecs[JsonCodec.name] = JsonCodec()
+
+    return codecs
+
+
+_codec: Optional[JsonCodec] = None
+
+
+def get_codec() -> JsonCodec:
+    """
+    Get the shared codec. The backend is chosen once by `ws.json_backend`:
+    `auto` picks the fastest installed one
+    """
+
+    global _codec
+
+    if _codec is None:
+        codecs = available_codecs()
+        backend = config.ws.json_backend
+
+        if backend == "auto":
+            _codec = next(iter(codecs.values()))
+        elif backend in codecs:
+            _codec = codecs[backend]
+        else:
+            logger.warning(
+                "JSON backend %s is not installed, falling back to stdlib json",
+                backend,
+            )
+            _codec = codecs[JsonCodec.name]
+
+        logger.info("Using %s JSON backend for MAX frames", _codec.name)
+
+    return _codec
+
+
+def loads(data: bytes | str) -> Any:
+    """Decode a frame with the shared codec"""
+
+    return get_codec().loads(data)
+
+
+def dumps(obj: Any) -> bytes:
+    """Encode a frame with the shared codec"""
+
+    return get_codec().dumps(obj)
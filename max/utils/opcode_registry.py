@@ -0,0 +1,156 @@
+"""
+Opcode → handler registry for inbound MAX frames
+
+Any module can register a handler:
+```
+from max.utils.opcode_registry import get_opcode_registry
+
+@get_opcode_registry().register(64)
+async def on_message_sent(client: MaxClient, message: dict) -> None: ...
+```
+
+Frames with an opcode nobody listens to (1 acks, presence, typing...)
+are dropped by `MaxClient` before decoding, using `peek_opcode()`,
+and only counted. Replies to requests in flight are never dropped, see
+`max/utils/pending_requests.py`.
+"""
+
+import logging
+import re
+
+from collections import Counter
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Container, Optional
+
+from core.metrics import family, get_metrics
+
+if TYPE_CHECKING:
+    from max.client import MaxClient
+
+
+logger = logging.getLogger(__name__)
+
+OpcodeHandler = Callable[["MaxClient", dict[str, Any]], Awaitable[None]]
+
+# The header always goes first: {"ver":11,"cmd":1,"seq":123,"opcode":128,"payload":...
+_OPCODE_RE = re.compile(rb'"opcode"\s*:\s*(-?\d+)')
+_HEADER_SIZE = 128
+
+_ERROR_MARKER = b'"error"'
+
+
+def peek_opcode(raw: bytes) -> Optional[int]:
+    """Read the opcode from the frame header without decoding. None if not found"""
+
+    match = _OPCODE_RE.search(raw, 0, _HEADER_SIZE)
+
+    if match is None:
+        return None
+
+    return int(match.group(1))
+
+
+class OpcodeRegistry:
+    def __init__(self):
+        self._handlers: dict[int, list[OpcodeHandler]] = {}
+
+        # Frames per opcode, across all clients
+        self.received: Counter[int] = Counter()
+        self.dropped: Counter[int] = Counter()
+
+    def register(self, opcode: int) -> Callable[[OpcodeHandler], OpcodeHandler]:
+        """Decorator, see `add()`"""
+
+        def decorator(handler: OpcodeHandler) -> OpcodeHandler:
+            self.add(opcode, handler)
+            return handler
+
+        return decorator
+
+    def add(self, opcode: int, handler: OpcodeHandler) -> None:
+        """Add a handler. Several handlers of one opcode run in the order they were added"""
+
+        self._handlers.setdefault(opcode, []).append(handler)
+
+    def remove(self, opcode: int, handler: OpcodeHandler) -> None:
+        handlers = self._handlers.get(opcode, [])
+
+        if handler in handlers:
+            handlers.remove(handler)
+
+        if not handlers:
+            self._handlers.pop(opcode, None)
+
+    def __contains__(self, opcode: int) -> bool:
+        return opcode in self._handlers
+
+    def should_drop(self, raw: bytes, awaited: Container[int] = ()) -> bool:
+        """
+        Check a raw frame before decoding. Frames of unknown opcodes are counted and dropped,
+        unless they carry an error that has to be reported or their opcode is `awaited`
+        """
+
+        opcode = peek_opcode(raw)
+
+        if (
+            opcode is None
+            or opcode in self._handlers
+            or opcode in awaited
+            or _ERROR_MARKER in raw
+        ):
+            return False
+
+        self.received[opcode] += 1
+        self.dropped[opcode] += 1
+        return True
+
+    async def dispatch(self, client: "MaxClient", message: dict[str, Any]) -> None:
+        """Run all handlers of the message opcode"""
+
+        opcode = message.get("opcode", -1)
+        self.received[opcode] += 1
+
+        handlers = self._handlers.get(opcode)
+
+        if not handlers:
+            self.dropped[opcode] += 1
+            logger.debug("No handlers for opcode %s", opcode)
+            return
+
+        for handler in handlers:
+            await handler(client, message)
+
+
+_registry = None
+
+
+def get_opcode_registry() -> OpcodeRegistry:
+    global _registry
+
+    if _registry is None:
+        _registry = OpcodeRegistry()
+
+    return _registry
+
+
+def _collect_frames():
+    if _registry is None:
+        return []
+
+    # Counted anyway, only turned into metrics on a scrape
+    return [
+        family(
+            "max2tg_max_frames_total",
+            "MAX frames received, per opcode",
+            {(("opcode", str(op)),): n for op, n in _registry.received.items()},
+            type="counter",
+        ),
+        family(
+            "max2tg_max_frames_dropped_total",
+            "MAX frames nobody handles, per opcode",
+            {(("opcode", str(op)),): n for op, n in _registry.dropped.items()},
+            type="counter",
+        ),
+    ]
+
+
+get_metrics().add_collector(_collect_frames)
@@ -0,0 +1,155 @@
+"""
+Requests waiting for their replies, matched by `seq`
+
+MAX echoes the `seq` and opcode of a request in its reply, so a reply can be handed
+straight to the caller that is awaiting it instead of going through the bot queue.
+A reply that comes after its request was given up on (timed out, cancelled) is dropped:
+the caller has already handled the failure. Replies to frames that weren't sent
+as requests go to the opcode registry as usual.
+
+Opcodes of the requests in flight are counted in `opcodes`, the registry doesn't drop
+frames of those before decoding even if it has no handlers for them.
+"""
+
+import asyncio
+
+from collections import Counter, OrderedDict
+from typing import Any, Optional
+
+
+# Given up requests remembered for their late replies
+ABANDONED_LIMIT = 1000
+
+
+class MaxRequestError(Exception):
+    """MAX answered a request with an error"""
+
+    def __init__(self, payload: dict[str, Any]):
+        self.payload = payload
+        self.error = payload.get("error")
+        self.localized_message = payload.get("localizedMessage")
+
+        super().__init__(f"{self.error}: {self.localized_message} || {payload.get('message')}")
+
+    def __reduce__(self):
+        # Passed between processes by the worker pool
+        return type(self), (self.payload,)
+
+
+class PendingRequests:
+    def __init__(self, timeout: float = 10):
+        self.timeout = timeout
+
+        # seq -> (expected opcode, deadline, future). Inserted in the order they were sent
+        self._pending: dict[int, tuple[int, float, asyncio.Future]] = {}
+        # seq -> opcode of requests given up on, oldest first
+        self._abandoned: OrderedDict[int, int] = OrderedDict()
+        # Opcode -> requests waiting for a reply with it, no zero counts
+        self.opcodes: Counter[int] = Counter()
+
+    def add(self, seq: int, opcode: int, timeout: float = None) -> asyncio.Future:
+        """Register a request before sending it. The future gets the whole reply"""
+
+        loop = asyncio.get_running_loop()
+
+        self.sweep()
+
+        future = loop.create_future()
+        deadline = loop.time() + (timeout or self.timeout)
+        self._pending[seq] = (opcode, deadline, future)
+        self.opcodes[opcode] += 1
+
+        return future
+
+    def resolve(self, message: dict[str, Any]) -> bool:
+        """
+        Hand the reply to its request. True if it's consumed: handed over,
+        or a late reply to a request given up on. False if it was never requested
+        """
+
+        seq = message.get("seq")
+        entry = self._pending.get(seq)
+
+        if entry is None:
+            if seq in self._abandoned and self._abandoned[seq] == message.get("opcode"):
+                del self._abandoned[seq]
+                return True
+
+            return False
+
+        if entry[0] != message.get("opcode"):
+            return False
+
+        self._pop(seq)
+
+        future = entry[2]
+
+        if future.done():
+            return False
+
+        payload = message.get("payload") or {}
+
+        if payload.get("error"):
+            future.set_exception(MaxRequestError(payload))
+        else:
+            future.set_result(message)
+
+        return True
+
+    def discard(self, seq: int) -> None:
+        """The caller is done with the request. If no reply came, a late one is dropped"""
+
+        entry = self._pop(seq)
+
+        if entry is not None:
+            self._abandon(seq, entry[0])
+
+    def sweep(self) -> int:
+        """Drop requests past their deadline. Returns how many were dropped"""
+
+        now = asyncio.get_running_loop().time()
+        expired = [seq for seq, (_, deadline, _) in self._pending.items() if deadline <= now]
+
+        for seq in expired:
+            opcode, _, future = self._pop(seq)
+            self._abandon(seq, opcode)
+
+            if not future.done():
+                future.set_exception(TimeoutError(f"No reply to request {seq}"))
+                # Nobody may be awaiting it anymore
+                future.exception()
+
+        return len(expired)
+
+    def fail_all(self, error: Optional[BaseException] = None) -> None:
+        """The connection is gone, no reply will come"""
+
+        for _, _, future in self._pending.values():
+            if not future.done():
+                future.set_exception(error or ConnectionError("Connection lost"))
+                future.exception()
+
+        self._pending.clear()
+        self.opcodes.clear()
+        # Replies of the old connection won't come either
+        self._abandoned.clear()
+
+    def _pop(self, seq: int) -> Optional[tuple[int, float, asyncio.Future]]:
+        entry = self._pending.pop(seq, None)
+
+        if entry is not None:
+            self.opcodes[entry[0]] -= 1
+
+            if not self.opcodes[entry[0]]:
+                del self.opcodes[entry[0]]
+
+        return entry
+
+    def _abandon(self, seq: int, opcode: int) -> None:
+        self._abandoned[seq] = opcode
+
+        if len(self._abandoned) > ABANDONED_LIMIT:
+            self._abandoned.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._pending)
@@ -1,5 +1,6 @@
 import logging
-from typing import Any, Union
+import time
+from typing import Any, Optional, Union
 
 from core.message_models import (
     MessageModel,
@@ -11,14 +12,21 @@ from core.message_models import (
 )
 
 from core.queue_manager import get_queue_manager
+from core.tracing import Trace
 
 logger = logging.getLogger(__name__)
 
 
+def parse_opcode17(message: dict[str, Any]) -> Optional[str]:
+    """Short token from the opcode 17 reply"""
+
+    return message.get("payload", {}).get("token")
+
+
 async def process_opcode17(message: dict[str, Any], tg_user_id: int) -> str:
     """Process opcode 17: start auth, phone confirmation. **Returns short token**"""
 
-    short_token = message.get("payload", {}).get("token")
+    short_token = parse_opcode17(message)
 
     if short_token:
         await add_message_to_queue(
@@ -30,26 +38,32 @@ async def process_opcode17(message: dict[str, Any], tg_user_id: int) -> str:
     return short_token
 
 
-async def process_opcode18(message: dict[str, Any], tg_user_id: int) -> bool:
-    """Process opcode 18: SMS confirmation and final token. **Returns True if token received**"""
+def parse_opcode18(message: dict[str, Any]) -> Optional[str]:
+    """Final token from the opcode 18 reply"""
 
     token_attrs = message.get("payload", {}).get("tokenAttrs")
 
     if token_attrs:
-        token = token_attrs.get("LOGIN", {}).get("token")
+        return token_attrs.get("LOGIN", {}).get("token")
+
+
+async def process_opcode18(message: dict[str, Any], tg_user_id: int) -> Optional[str]:
+    """Process opcode 18: SMS confirmation and final token. **Returns the final token**"""
 
+    token = parse_opcode18(message)
+
+    if token:
         await add_message_to_queue(
             SMSConfirmedMessage(user_id=tg_user_id, full_token=token)
         )
 
         logger.info("🔑 New Token received | %s", token)
-        return True
+        return token
 
 
-async def process_opcode19(message: dict[str, Any], tg_user_id: int) -> None:
-    """Process opcode 19: chat list"""
+def parse_opcode19(message: dict[str, Any], tg_user_id: int) -> list[FetchChatsMessage]:
+    """Chat list from the opcode 19 reply"""
 
-    logger.debug("Collecting user information | Fetching chats...")
     chats = []
 
     for chat in message.get("payload", {}).get("chats", []):
@@ -73,35 +87,36 @@ async def process_opcode19(message: dict[str, Any], tg_user_id: int) -> None:
             )
         )
 
-        await add_message_to_queue(chats)
+    return chats
 
 
-async def process_opcode49(message: dict[str, Any], tg_user_id: int) -> None:
-    """Process opcode 49: get last 30 chat messages"""
+async def process_opcode19(message: dict[str, Any], tg_user_id: int) -> None:
+    """Process opcode 19: chat list"""
+
+    logger.debug("Collecting user information | Fetching chats...")
+
+    chats = parse_opcode19(message, tg_user_id)
+
+    if chats:
+        await add_message_to_queue(chats)
 
-    payload = message.get("payload", {})
 
-    logger.debug("Collecting messages from chat...")
+def parse_opcode49(
+    message: dict[str, Any], tg_user_id: int, chat_id: int
+) -> list[ChatMsgMessage]:
+    """Messages from the opcode 49 reply. The reply doesn't name the chat, the caller knows it"""
 
     msgs = []
 
-    for msg_data in payload.get("messages", []):
+    for msg_data in message.get("payload", {}).get("messages", []):
         # NOTE: Attr "attaches" on default messages usually have chat events
         #       like joinByLink, leave, add
         #       But on linked messages it may contain media (like photo)
         #       Now we're not extracting photos beacuse it would be a lot of media
 
-        msgs.append(
-            ChatMsgMessage(
-                user_id=tg_user_id,
-                sender_id=msg_data.get("sender"),
-                message_id=msg_data.get("id"),
-                timestamp=msg_data.get("time"),
-                text=msg_data.get("text"),
-            )
-        )
+        msgs.append(ChatMsgMessage.from_max(msg_data, chat_id, tg_user_id))
 
-    await add_message_to_queue(msgs)
+    return msgs
 
 
 async def process_opcode64(message: dict[str, Any], tg_user_id: int) -> None:
@@ -117,26 +132,45 @@ async def process_opcode64(message: dict[str, Any], tg_user_id: int) -> None:
     )
 
     await add_message_to_queue(
-        ChatMsgMessage(
-            user_id=tg_user_id,
-            sender_id=payload.get("sender"),
-            message_id=payload.get("id"),
-            timestamp=payload.get("time"),
-            text=payload.get("text"),
-        )
+        ChatMsgMessage.from_max(payload, payload.get("chatId"), tg_user_id)
     )
 
 
-async def process_opcode128(message: dict[str, Any], tg_user_id: int) -> None:
+async def process_opcode128(
+    message: dict[str, Any], tg_user_id: int, trace: Optional[Trace] = None
+) -> None:
     """Process opcode 128: Receive new message from anywhere"""
 
+    started_at = time.perf_counter()
     payload = message.get("payload", {})
-    message_data = payload.get("message", {})
 
     logger.debug(
         "New message received from chat %s ...", payload.get("chatId", "NOT CHAT")
     )
 
+    msg = await parse_chat_message(
+        payload.get("message", {}), payload.get("chatId"), tg_user_id
+    )
+
+    if trace is not None:
+        trace.chat_id = msg.chat_id
+        trace.message_id = msg.message_id
+        trace.mark("handler", time.perf_counter() - started_at)
+
+        if msg.timestamp:
+            trace.mark("server", trace.received_at - msg.timestamp / 1000)
+
+        msg.trace = trace
+        trace.enqueued_at = time.time()
+
+    await add_message_to_queue(msg)
+
+
+async def parse_chat_message(
+    message_data: dict[str, Any], chat_id: int, tg_user_id: int
+) -> ChatMsgMessage:
+    """Build a chat message with its attaches and replied message from raw MAX message data"""
+
     attaches = []
     replied_msg = None
 
@@ -146,35 +180,22 @@ async def process_opcode128(message: dict[str, Any], tg_user_id: int) -> None:
         replied_msg_raw = message_data.get("link").get("message", {})
 
         if replied_msg_raw:
-            replied_msg = ChatMsgMessage(
-                user_id=tg_user_id,
-                chat_id=payload.get("chatId"),
-                sender_id=replied_msg_raw.get("sender"),
-                message_id=replied_msg_raw.get("id"),
-                timestamp=replied_msg_raw.get("time"),
-                text=replied_msg_raw.get("text"),
-            )
+            replied_msg = ChatMsgMessage.from_max(replied_msg_raw, chat_id, tg_user_id)
 
         attaches.extend(await extract_all_attaches(replied_msg_raw))
 
-    await add_message_to_queue(
-        ChatMsgMessage(
-            user_id=tg_user_id,
-            chat_id=payload.get("chatId"),
-            sender_id=message_data.get("sender"),
-            message_id=message_data.get("id"),
-            timestamp=message_data.get("time"),
-            text=message_data.get("text"),
-            attaches=attaches,
-            replied_msg=replied_msg,
-        )
+    # Checked here once, nothing down the bridge validates it again
+    return ChatMsgMessage.from_max(
+        message_data, chat_id, tg_user_id, tuple(attaches), replied_msg
     )
 
 
-async def add_message_to_queue(message: Union[list[MessageModel], MessageModel]):
-    """Add a message to the bot queue"""
+async def add_message_to_queue(
+    message: Union[list[MessageModel], list[ChatMsgMessage], MessageModel, ChatMsgMessage],
+):
+    """Add a message to the bot queue, without blocking for long if it is full"""
 
-    await get_queue_manager().to_bot.put(message)
+    await get_queue_manager().put_to_bot(message)
 
 
 async def extract_all_attaches(message: dict[str, Any]) -> list[Attach]:
@@ -189,7 +210,11 @@ async def extract_all_attaches(message: dict[str, Any]) -> list[Attach]:
         if attach.get("_type") != "PHOTO":
             continue
 
-        at = Attach(base_url=attach.get("baseUrl"))
-        attaches.append(at)
+        base_url = attach.get("baseUrl")
+
+        if not isinstance(base_url, str):
+            raise ValueError(f"Photo attach without a URL: {attach}")
+
+        attaches.append(Attach(base_url=base_url))
 
     return attaches
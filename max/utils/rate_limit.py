@@ -0,0 +1,42 @@
+import asyncio
+import random
+import time
+
+
+class TokenBucket:
+    """
+    Async token bucket: `rate` tokens per second, up to `burst` at once.
+    Every acquire additionally waits a random `0..jitter` seconds,
+    so callers released together don't hit the server in the same instant
+    """
+
+    def __init__(self, rate: float, burst: int = 1, jitter: float = 0.0):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.jitter = jitter
+
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # Waiters are served one by one, in the order they came
+        async with self._lock:
+            self._refill()
+
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+
+            self._tokens -= 1
+
+        if self.jitter > 0:
+            await asyncio.sleep(random.uniform(0, self.jitter))
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
@@ -0,0 +1,216 @@
+"""
+Hierarchical timer wheel shared by all MAX clients
+
+One task drives the keepalive and subscription pings of every client instead of
+a sleeping task per client and ping. Timers are kept in `levels` wheels of `slots`
+slots: the first wheel has one slot per tick, every next one covers a whole turn
+of the previous wheel per slot. Scheduling and cancelling are O(1), far timers
+are moved down to finer wheels as their time comes.
+
+Periodic timers get evenly spread phases (golden ratio sequence), so clients
+connected at the same moment don't ping in the same tick forever.
+"""
+
+import asyncio
+import inspect
+import logging
+import math
+
+from typing import Any, Callable, Optional
+
+
+logger = logging.getLogger(__name__)
+
+TimerCallback = Callable[[], Any]
+
+# Fractional part of the golden ratio, consecutive multiples are spread evenly over [0, 1)
+_GOLDEN = (math.sqrt(5) - 1) / 2
+
+
+class Timer:
+    __slots__ = ("expires", "callback", "interval", "cancelled")
+
+    def __init__(self, expires: int, callback: TimerCallback, interval: int = 0):
+        # In ticks
+        self.expires = expires
+        self.callback = callback
+        self.interval = interval
+        self.cancelled = False
+
+    def cancel(self) -> None:
+        """The timer is dropped when its slot comes up"""
+
+        self.cancelled = True
+
+
+class TimerWheel:
+    def __init__(self, tick: float = 1.0, slots: int = 64, levels: int = 3):
+        self.tick = tick
+        self.slots = slots
+        self.levels = levels
+
+        self._wheels: list[list[list[Timer]]] = [
+            [[] for _ in range(slots)] for _ in range(levels)
+        ]
+        # Timers beyond the last wheel, checked once per its turn
+        self._overflow: list[Timer] = []
+        self._now = 0
+        self._phase = 0
+
+        self._task: Optional[asyncio.Task] = None
+        self._callbacks: set[asyncio.Task] = set()
+
+        self.fired = 0
+
+    @property
+    def now(self) -> int:
+        return self._now
+
+    def schedule(self, delay: float, callback: TimerCallback) -> Timer:
+        """Call back once after `delay` seconds"""
+
+        timer = Timer(self._now + self._ticks(delay), callback)
+        self._insert(timer)
+        self.start()
+        return timer
+
+    def every(
+        self, interval: float, callback: TimerCallback, phase: float = None
+    ) -> Timer:
+        """
+        Call back every `interval` seconds. The first call is after `phase` seconds,
+        by default spread evenly between the timers
+        """
+
+        ticks = self._ticks(interval)
+
+        if phase is None:
+            self._phase += 1
+            offset = int((self._phase * _GOLDEN) % 1 * ticks) or ticks
+        else:
+            offset = self._ticks(phase)
+
+        timer = Timer(self._now + offset, callback, interval=ticks)
+        self._insert(timer)
+        self.start()
+        return timer
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def advance(self) -> None:
+        """Move one tick forward and fire the timers that are due"""
+
+        self._now += 1
+
+        # Bring the timers of the next turn down from the coarser wheels
+        span = 1
+
+        for level in range(1, self.levels):
+            span *= self.slots
+
+            if self._now % span:
+                break
+
+            self._cascade(self._wheels[level], (self._now // span) % self.slots)
+        else:
+            if self._now % (span * self.slots) == 0 and self._overflow:
+                overflow, self._overflow = self._overflow, []
+
+                for timer in overflow:
+                    self._insert(timer)
+
+        slot = self._wheels[0][self._now % self.slots]
+
+        if not slot:
+            return
+
+        timers = slot[:]
+        slot.clear()
+
+        for timer in timers:
+            if timer.cancelled:
+                continue
+
+            self._fire(timer)
+
+            if timer.interval and not timer.cancelled:
+                timer.expires += timer.interval
+                self._insert(timer)
+
+    def _cascade(self, wheel: list[list[Timer]], index: int) -> None:
+        timers = wheel[index]
+        wheel[index] = []
+
+        for timer in timers:
+            if not timer.cancelled:
+                self._insert(timer)
+
+    def _insert(self, timer: Timer) -> None:
+        # Due now only when cascading, the current slot is processed right after
+        remaining = max(timer.expires - self._now, 0)
+        timer.expires = self._now + remaining
+
+        span = 1
+
+        for level in range(self.levels):
+            if remaining < span * self.slots:
+                index = (timer.expires // span) % self.slots
+                self._wheels[level][index].append(timer)
+                return
+
+            span *= self.slots
+
+        self._overflow.append(timer)
+
+    def _fire(self, timer: Timer) -> None:
+        self.fired += 1
+
+        try:
+            result = timer.callback()
+        except Exception as e:
+            logger.error("Timer callback failed: %s", e)
+            return
+
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            self._callbacks.add(task)
+            task.add_done_callback(self._callback_done)
+
+    def _callback_done(self, task: asyncio.Task) -> None:
+        self._callbacks.discard(task)
+
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Timer callback failed: %s", task.exception())
+
+    def _ticks(self, seconds: float) -> int:
+        return max(math.ceil(seconds / self.tick), 1)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        started_at = loop.time() - self._now * self.tick
+
+        while True:
+            # Sleep to the next tick boundary, so ticks don't drift
+            await asyncio.sleep(
+                max(started_at + (self._now + 1) * self.tick - loop.time(), 0)
+            )
+            self.advance()
+
+
+_timer_wheel: Optional[TimerWheel] = None
+
+
+def get_timer_wheel() -> TimerWheel:
+    global _timer_wheel
+
+    if _timer_wheel is None:
+        _timer_wheel = TimerWheel()
+
+    return _timer_wheel
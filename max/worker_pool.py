@@ -0,0 +1,538 @@
+"""
+Running MAX clients in worker processes
+
+With `max.workers` > 0 the `MaxManager` of the main process doesn't hold any sockets.
+It starts N worker processes, each running its own `MaxManager` for a shard of
+the accounts (`shard_of(tg_id)`), and forwards every call to the worker of the account.
+
+Leaders and consumers of every chat are kept in the main process, next to the
+`RoutingIndex`, so an account on any worker can take a chat over. Workers only
+listen to the chats they are told to, and report accounts whose connection dropped
+(`("lost", tg_id)`) so the main process fails their chats over.
+
+Workers stream parsed bridge events (chat messages, chat lists, errors) back over
+a pipe into the main `to_bot` queue. The main process sends the high-water marks of
+forwarded messages to the workers (all of the shard when a worker starts, then every
+move), so catch-up after a reconnect or a restart works the same. It also reports the
+depth of its `to_bot` every `DEPTH_REPORT_INTERVAL`, catch-up in the workers yields
+to live messages by it.
+
+Each end of a pipe has a writer thread, so sending never blocks the event loop, and
+a reader thread that hands messages to the loop without waiting for them.
+
+A worker that dies is started again for the same shard and reconnects its accounts,
+its chats are led from the other workers meanwhile and resubscribed when it is ready.
+
+Limitations:
+- a worker's copy of the `RoutingIndex` is loaded when it starts and is only used
+  to order its connections, routing is done in the main process
+- failover asks the candidates one by one, a round trip to a worker each
+- the pipe queues are unbounded, the `to_bot` backpressure only applies after them
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+
+from multiprocessing.connection import Connection
+from multiprocessing.process import BaseProcess
+from typing import Any, Awaitable, Callable, Optional
+
+from bot.db.db_dependency import DBDependency
+
+from core.high_water import Position, get_high_water_marks
+from core.queue_manager import get_queue_manager
+
+from max.db.max_repo import MaxRepository
+
+from config import Settings, config
+
+
+logger = logging.getLogger(__name__)
+
+_CONTEXT = multiprocessing.get_context("spawn")
+
+# Restart delay of a crashed worker doubles up to the max while it keeps crashing
+RESTART_BASE_DELAY = 1
+RESTART_MAX_DELAY = 60
+# A worker that lived this long is considered healthy again, in seconds
+RESTART_RESET_AFTER = 60
+# How often the depth of the bot queue is checked and sent to the workers, in seconds
+DEPTH_REPORT_INTERVAL = 0.1
+
+
+def shard_of(key: int, workers: int) -> int:
+    """Worker of the account"""
+
+    return hash(key) % workers
+
+
+# Ends the writer and the dispatcher of a channel, never sent over the pipe
+_CLOSE = object()
+
+
+class Channel:
+    """
+    Pickled messages over a pipe, without blocking the event loop either way.
+
+    `send()` only queues the message, a writer thread writes it to the pipe.
+    A reader thread hands received messages to the event loop, where they are
+    handled one at a time, in order. The reader doesn't wait for the handlers,
+    so two processes writing into each other's full pipes can't deadlock
+    """
+
+    def __init__(
+        self,
+        conn: Connection,
+        handler: Callable[[Any], Awaitable[None]],
+        on_closed: Callable[[], None] = None,
+    ):
+        self.conn = conn
+        self.handler = handler
+        self.on_closed = on_closed
+
+        self._loop = asyncio.get_running_loop()
+        self._inbox: asyncio.Queue = asyncio.Queue()
+        self._outbox: queue.SimpleQueue = queue.SimpleQueue()
+        self._closed = False
+
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        self._reader.start()
+        self._writer.start()
+
+    def send(self, message: Any) -> bool:
+        """Queue the message for the writer. False if the channel is closed"""
+
+        if self._closed:
+            return False
+
+        self._outbox.put(message)
+        return True
+
+    def close(self) -> None:
+        """Close the pipe once the queued messages are written"""
+
+        if self._closed:
+            return
+
+        self._closed = True
+        self._outbox.put(_CLOSE)
+
+    def flush(self, timeout: float) -> None:
+        """Wait for the writer to finish after `close()`. Blocking, run it in a thread"""
+
+        self._writer.join(timeout)
+
+    def _write(self) -> None:
+        while True:
+            message = self._outbox.get()
+
+            if message is _CLOSE:
+                break
+
+            try:
+                self.conn.send(message)
+            except OSError as e:
+                logger.warning("Failed to send to the pipe: %s", e)
+                break
+            except Exception as e:
+                # Not picklable, nothing was written
+                logger.error("Failed to send %s to the pipe: %s", type(message).__name__, e)
+
+        self.conn.close()
+
+    def _read(self) -> None:
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            except Exception as e:
+                logger.error("Failed to read a message from the pipe: %s", e)
+                continue
+
+            self._to_loop(message)
+
+        self._to_loop(_CLOSE)
+
+    def _to_loop(self, message: Any) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._inbox.put_nowait, message)
+        except RuntimeError:
+            # The loop is closed, nobody handles it anymore
+            pass
+
+    async def _dispatch(self) -> None:
+        while True:
+            message = await self._inbox.get()
+
+            if message is _CLOSE:
+                break
+
+            try:
+                await self.handler(message)
+            except Exception as e:
+                logger.error("Failed to handle a message from the pipe: %s", e)
+
+        if self.on_closed is not None:
+            self.on_closed()
+
+
+class WorkerPool:
+    def __init__(self, workers: int):
+        if workers < 1:
+            raise ValueError("At least one worker is required")
+
+        self.workers = workers
+
+        self._processes: list[Optional[BaseProcess]] = [None] * workers
+        self._channels: list[Optional[Channel]] = [None] * workers
+        self._started_at = [0.0] * workers
+        self._crashes = [0] * workers
+        self.restarts = 0
+
+        # call ID -> (worker index, future)
+        self._calls: dict[int, tuple[int, asyncio.Future]] = {}
+        self._call_ids = itertools.count()
+        self._restart_tasks: set[asyncio.Task] = set()
+        self._ready_tasks: set[asyncio.Task] = set()
+        self._depth_task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+        # Called with the worker index once its clients are connected, after a restart too
+        self.on_ready: Optional[Callable[[int], Awaitable[None]]] = None
+        # Called with the worker index when it exits unexpectedly
+        self.on_exit: Optional[Callable[[int], None]] = None
+        # Called with the TG ID of an account whose connection dropped in a worker
+        self.on_client_lost: Optional[Callable[[int], None]] = None
+
+    def worker_of(self, key: int) -> int:
+        return shard_of(key, self.workers)
+
+    async def start(self) -> None:
+        for index in range(self.workers):
+            self._spawn(index)
+
+        get_high_water_marks().on_advance = self._send_mark
+        self._depth_task = asyncio.create_task(self._report_depth())
+
+        logger.info("🧩 Started %s MAX worker processes", self.workers)
+
+    async def call(self, key: int, method: str, *args, **kwargs) -> Any:
+        """Call a `MaxManager` method in the worker of the account"""
+
+        return await self._call(self.worker_of(key), method, args, kwargs)
+
+    async def call_worker(self, index: int, method: str, *args, **kwargs) -> Any:
+        """Call a `MaxManager` method in the worker with the index"""
+
+        return await self._call(index, method, args, kwargs)
+
+    async def call_all(self, method: str, *args, **kwargs) -> list[Any]:
+        """Call a `MaxManager` method in every worker"""
+
+        return await asyncio.gather(
+            *(self._call(index, method, args, kwargs) for index in range(self.workers))
+        )
+
+    async def stop(self, timeout: float) -> None:
+        """Let the workers disconnect their clients, kill the ones that don't exit in time"""
+
+        self._stopping = True
+
+        for task in (*self._restart_tasks, *self._ready_tasks, self._depth_task):
+            if task is not None:
+                task.cancel()
+
+        for channel in self._channels:
+            if channel is not None:
+                channel.send(("stop",))
+
+        processes = [p for p in self._processes if p is not None]
+
+        await asyncio.gather(
+            *(asyncio.to_thread(p.join, timeout) for p in processes)
+        )
+
+        for process in processes:
+            if process.is_alive():
+                logger.warning("%s didn't stop in time, terminating", process.name)
+                process.terminate()
+
+        for channel in self._channels:
+            if channel is not None:
+                channel.close()
+
+        get_high_water_marks().on_advance = None
+
+    def _spawn(self, index: int) -> None:
+        parent_conn, child_conn = _CONTEXT.Pipe()
+
+        marks = {
+            key: position
+            for key, position in get_high_water_marks().items().items()
+            if self.worker_of(key[0]) == index
+        }
+
+        process = _CONTEXT.Process(
+            target=run_worker,
+            args=(index, self.workers, child_conn, config, marks),
+            name=f"max-worker-{index}",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+
+        channel = Channel(parent_conn, self._handle)
+        channel.on_closed = lambda: self._on_exit(index, channel)
+        channel.start()
+
+        self._processes[index] = process
+        self._channels[index] = channel
+        self._started_at[index] = time.monotonic()
+
+    async def _call(self, index: int, method: str, args: tuple, kwargs: dict) -> Any:
+        channel = self._channels[index]
+
+        if channel is None:
+            raise ConnectionError(f"MAX worker {index} is restarting")
+
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = (index, future)
+
+        try:
+            if not channel.send(("call", call_id, method, args, kwargs)):
+                raise ConnectionError(f"MAX worker {index} is gone")
+
+            return await future
+        finally:
+            self._calls.pop(call_id, None)
+
+    async def _handle(self, message: tuple) -> None:
+        match message:
+            case ("event", item):
+                await get_queue_manager().put_to_bot(item)
+
+            case ("result", call_id, value, error):
+                entry = self._calls.get(call_id)
+
+                if entry is None or entry[1].done():
+                    return
+
+                if error is not None:
+                    entry[1].set_exception(error)
+                else:
+                    entry[1].set_result(value)
+
+            case ("ready", index, clients):
+                logger.info("🧩 MAX worker %s is ready with %s clients", index, clients)
+
+                # It calls the worker, the result comes through this same handler
+                if self.on_ready is not None:
+                    task = asyncio.create_task(self.on_ready(index))
+                    self._ready_tasks.add(task)
+                    task.add_done_callback(self._ready_tasks.discard)
+
+            case ("lost", key):
+                if self.on_client_lost is not None:
+                    self.on_client_lost(key)
+
+    async def _report_depth(self) -> None:
+        """Let the workers know how busy the bot queue is, when it changes"""
+
+        queue = get_queue_manager().to_bot
+        # A restarted worker has a new channel and gets the depth again
+        reported: list[Optional[tuple[Channel, int]]] = [None] * self.workers
+
+        while True:
+            depth = queue.qsize()
+
+            for index, channel in enumerate(self._channels):
+                if channel is None or reported[index] == (channel, depth):
+                    continue
+
+                if channel.send(("depth", depth)):
+                    reported[index] = (channel, depth)
+
+            await asyncio.sleep(DEPTH_REPORT_INTERVAL)
+
+    def _send_mark(self, owner_id: int, chat_id: int, position: Position) -> None:
+        channel = self._channels[self.worker_of(owner_id)]
+
+        if channel is not None:
+            channel.send(("mark", owner_id, chat_id, position))
+
+    def _on_exit(self, index: int, channel: Channel) -> None:
+        if self._channels[index] is not channel:
+            return
+
+        self._channels[index] = None
+        channel.close()
+
+        for call_id, (worker, future) in list(self._calls.items()):
+            if worker == index and not future.done():
+                future.set_exception(ConnectionError(f"MAX worker {index} exited"))
+
+        if self._stopping:
+            return
+
+        if self.on_exit is not None:
+            self.on_exit(index)
+
+        if time.monotonic() - self._started_at[index] > RESTART_RESET_AFTER:
+            self._crashes[index] = 0
+
+        delay = min(RESTART_MAX_DELAY, RESTART_BASE_DELAY * 2 ** self._crashes[index])
+        self._crashes[index] += 1
+
+        logger.error(
+            "💀 MAX worker %s exited with code %s, restarting its shard in %ss",
+            index,
+            self._processes[index].exitcode,
+            delay,
+        )
+
+        task = asyncio.create_task(self._restart(index, delay))
+        self._restart_tasks.add(task)
+        task.add_done_callback(self._restart_tasks.discard)
+
+    async def _restart(self, index: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+
+        if self._stopping:
+            return
+
+        self._processes[index].join(0)
+        self._spawn(index)
+        self.restarts += 1
+
+
+# [==================== WORKER PROCESS ====================]
+
+
+def run_worker(
+    index: int,
+    workers: int,
+    conn: Connection,
+    settings: Settings,
+    marks: dict[tuple[int, int], Position],
+) -> None:
+    """Entry point of a worker process. Settings of the main process replace the ones read from the file"""
+
+    for name in type(settings).model_fields:
+        setattr(config, name, getattr(settings, name))
+
+    logging.basicConfig(
+        level=logging.INFO,
+        datefmt=config.logging.date_format,
+        format=f"[worker {index}] {config.logging.log_format}",
+    )
+
+    try:
+        asyncio.run(_serve(index, workers, conn, marks))
+    except KeyboardInterrupt:
+        pass
+
+
+async def _serve(
+    index: int, workers: int, conn: Connection, marks: dict[tuple[int, int], Position]
+) -> None:
+    # The worker runs a regular in-process manager for its shard
+    from .clients_manager import MaxManager
+
+    # Rate limits are global, every worker gets its share
+    for name in ("startup_rate", "reconnect_rate", "catch_up_rate"):
+        setattr(config.max, name, getattr(config.max, name) / workers)
+
+    # Before the clients connect, their first catch-up needs them
+    get_high_water_marks().load(marks)
+
+    db_dependency = DBDependency(db_url=config.max.db_url)
+
+    async with db_dependency.db_session() as session:
+        await MaxRepository(session).load_routing_index()
+
+    manager = MaxManager(db_dependency, shard=(index, workers))
+    # Chats are handed over by the main process, it knows the accounts of every worker
+    manager.on_client_lost = lambda key: channel.send(("lost", key))
+    stopped = asyncio.Event()
+    calls: set[asyncio.Task] = set()
+
+    async def call(call_id: int, method: str, args: tuple, kwargs: dict) -> None:
+        try:
+            result = await getattr(manager, method)(*args, **kwargs)
+            channel.send(("result", call_id, result, None))
+        except Exception as e:
+            channel.send(("result", call_id, None, _portable(e)))
+
+    async def handle(message: tuple) -> None:
+        match message:
+            case ("call", call_id, method, args, kwargs):
+                task = asyncio.create_task(call(call_id, method, args, kwargs))
+                calls.add(task)
+                task.add_done_callback(calls.discard)
+
+            case ("mark", owner_id, chat_id, position):
+                get_high_water_marks().advance(owner_id, chat_id, position)
+
+            case ("depth", depth):
+                get_queue_manager().remote_to_bot_depth = depth
+
+            case ("stop",):
+                stopped.set()
+
+    # The main process is gone, nobody needs the clients anymore
+    channel = Channel(conn, handle, on_closed=stopped.set)
+    channel.start()
+
+    forwarder = asyncio.create_task(_forward_events(channel))
+
+    try:
+        await manager.startup()
+        channel.send(("ready", index, len(manager.clients)))
+
+        await stopped.wait()
+    finally:
+        await manager.shutdown()
+
+        forwarder.cancel()
+        await asyncio.gather(forwarder, return_exceptions=True)
+
+        await db_dependency.dispose()
+
+        # Results and events still queued for the writer are sent before exiting
+        channel.close()
+        await asyncio.to_thread(channel.flush, 5)
+
+
+async def _forward_events(channel: Channel) -> None:
+    """Stream everything the clients put to the bot queue to the main process"""
+
+    to_bot = get_queue_manager().to_bot
+
+    while True:
+        item = await to_bot.get()
+
+        channel.send(("event", item))
+        to_bot.task_done()
+
+
+def _portable(error: Exception) -> Exception:
+    """Errors are pickled to the main process, fall back to a plain one if it can't be"""
+
+    try:
+        pickle.dumps(error)
+        return error
+    except Exception:
+        return RuntimeError(f"{type(error).__name__}: {error}")